@@ -1,8 +1,12 @@
 from typing import Any
+from datetime import datetime
 from pydantic import BaseModel
+from langchain_core.messages import AIMessage
 from langchain_core.runnables import RunnableConfig
 from .agent_classes import Reflections
 from database.db import db
+from database.db_classes import LLMTokenUsage
+from database.usage_recorder import usage_recorder
 
 
 class ExtraOptions(BaseModel):
@@ -34,3 +38,19 @@ def format_reflections(reflections: Reflections, extra: ExtraOptions | None = No
 
     return f"{style_string}\n\n{fact_string}"
 
+
+def record_llm_usage(user_id: str, ai_message: AIMessage):
+    """
+    Buffers the token usage of an llm answer for the llm_token_usage collection, written in the background.
+    Answers replayed from the response cache carry no usage, they cost nothing and are not recorded.
+    """
+    usage = ai_message.usage_metadata
+    if not usage:
+        return
+    model_name = ai_message.response_metadata.get('model_name') or ai_message.response_metadata.get('model')
+    usage_recorder.record('llm_token_usage', LLMTokenUsage(user_id=user_id,
+                                                           model_name=model_name or 'unknown',
+                                                           timestamp=datetime.now(),
+                                                           prompt_tokens=usage['input_tokens'],
+                                                           completion_tokens=usage['output_tokens'],
+                                                           total_tokens=usage['total_tokens']))
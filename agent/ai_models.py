@@ -1,36 +1,167 @@
 import os
+import time
 from typing import Literal
+import httpx
+from langchain_core.language_models import BaseChatModel
+from langchain_core.runnables import Runnable, RunnableBinding
 from langchain_openai import ChatOpenAI
 from langchain_ollama import ChatOllama
 
 llm_provider = Literal["qwen", "ollama", "deepseek", "aliyun_eas", "fireworks"]
 
-def get_llm(llm:llm_provider, model:str, temperature:float):
+
+# one keep-alive connection pool shared by the clients of every openai compatible provider,
+# so back-to-back requests to the same provider reuse a warm TLS connection
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", 100))
+LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+LLM_HTTP_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY_SECONDS", 60))
+# reasoning models can take minutes to finish, only connecting is bounded tightly
+LLM_HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("LLM_HTTP_CONNECT_TIMEOUT_SECONDS", 10))
+LLM_HTTP_READ_TIMEOUT_SECONDS = float(os.getenv("LLM_HTTP_READ_TIMEOUT_SECONDS", 600))
+
+_http_client: httpx.AsyncClient | None = None
+# (provider, model, temperature) -> chat model, the instances are shared and must not be mutated
+_llm_clients: dict[tuple, ChatOpenAI | ChatOllama] = {}
+# id of a shared chat model -> its provider
+_llm_providers: dict[int, str] = {}
+
+_pool_stats = {
+    "requests": 0,
+    "responses": 0,
+    "tcp_connects": 0,
+    "tls_handshakes": 0,
+    "connect_seconds": 0.0,
+    "clients_created": 0,
+    "client_cache_hits": 0,
+}
+
+
+async def _on_request(request: httpx.Request):
+    _pool_stats["requests"] += 1
+    started_at = {}
+
+    # httpcore reports the setup of new connections through the `trace` request extension,
+    # requests sent on a pooled connection report none of these events
+    async def trace(event_name: str, info: dict):
+        if event_name in ("connection.connect_tcp.started", "connection.start_tls.started"):
+            started_at[event_name] = time.perf_counter()
+        elif event_name == "connection.connect_tcp.complete":
+            _pool_stats["tcp_connects"] += 1
+            _pool_stats["connect_seconds"] += time.perf_counter() - started_at.pop("connection.connect_tcp.started")
+        elif event_name == "connection.start_tls.complete":
+            _pool_stats["tls_handshakes"] += 1
+            _pool_stats["connect_seconds"] += time.perf_counter() - started_at.pop("connection.start_tls.started")
+
+    request.extensions["trace"] = trace
+
+
+async def _on_response(response: httpx.Response):
+    _pool_stats["responses"] += 1
+
+
+def get_http_client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=LLM_HTTP_MAX_CONNECTIONS,
+                                max_keepalive_connections=LLM_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                                keepalive_expiry=LLM_HTTP_KEEPALIVE_EXPIRY_SECONDS),
+            timeout=httpx.Timeout(LLM_HTTP_READ_TIMEOUT_SECONDS, connect=LLM_HTTP_CONNECT_TIMEOUT_SECONDS),
+            event_hooks={"request": [_on_request], "response": [_on_response]})
+    return _http_client
+
+
+def _openai_compatible(model: str, api_key: str | None, base_url: str | None, temperature: float) -> ChatOpenAI:
+    return ChatOpenAI(model=model,
+                      api_key=api_key,
+                      base_url=base_url,
+                      temperature=temperature,
+                      # report token usage on streamed answers too, it carries the cached prompt token counts
+                      stream_usage=True,
+                      # retries, with backoff and failover, are done by agent/resilience.py
+                      max_retries=0,
+                      http_async_client=get_http_client())
+
+
+def _create_llm(llm: llm_provider, model: str, temperature: float):
 
     if llm == "qwen":
-        return ChatOpenAI(model=model, 
-                            api_key=os.getenv('DASHSCOPE_API_KEY'),
-                            base_url=os.getenv('DASHSCOPE_BASE_URL'),
-                            temperature=temperature)
+        return _openai_compatible(model=model,
+                                  api_key=os.getenv('DASHSCOPE_API_KEY'),
+                                  base_url=os.getenv('DASHSCOPE_BASE_URL'),
+                                  temperature=temperature)
 
     if llm == "deepseek":
-        return ChatOpenAI(model=model, 
-                            api_key=os.getenv('DEEPSEEK_API_KEY'),
-                            base_url=os.getenv('DEEPSEEK_BASE_URL'),
-                            temperature=temperature)
+        return _openai_compatible(model=model,
+                                  api_key=os.getenv('DEEPSEEK_API_KEY'),
+                                  base_url=os.getenv('DEEPSEEK_BASE_URL'),
+                                  temperature=temperature)
 
     if llm == "ollama":
         return ChatOllama(model="deepseek-r1:14b",
                           temperature=temperature)
-    
+
     if llm == 'aliyun_eas':
-        return ChatOpenAI(model=model, 
-                          api_key=os.getenv('aliyun_eas_eno_ds_r1_qwen_32b_api_key'),
-                          base_url=os.getenv('aliyun_eas_eno_ds_r1_qwen_32b_api_base'),
-                          temperature=temperature)
+        return _openai_compatible(model=model,
+                                  api_key=os.getenv('aliyun_eas_eno_ds_r1_qwen_32b_api_key'),
+                                  base_url=os.getenv('aliyun_eas_eno_ds_r1_qwen_32b_api_base'),
+                                  temperature=temperature)
 
     if llm == 'fireworks':
-        return ChatOpenAI(model='accounts/fireworks/models/deepseek-r1', 
-                          api_key=os.getenv('FIREWORKS_API_KEY'),
-                          base_url=os.getenv('FIREWORKS_API_BASE'),
-                          temperature=temperature)
\ No newline at end of file
+        return _openai_compatible(model='accounts/fireworks/models/deepseek-r1',
+                                  api_key=os.getenv('FIREWORKS_API_KEY'),
+                                  base_url=os.getenv('FIREWORKS_API_BASE'),
+                                  temperature=temperature)
+
+
+def get_llm(llm: llm_provider, model: str, temperature: float):
+    """
+    Returns the chat model of a provider, built once per (provider, model, temperature) and then reused,
+    so every node call shares the same clients and the same warm connection pool.
+    """
+    key = (llm, model, temperature)
+    client = _llm_clients.get(key)
+    if client is not None:
+        _pool_stats["client_cache_hits"] += 1
+        return client
+
+    client = _create_llm(llm, model, temperature)
+    if client is not None:
+        _llm_clients[key] = client
+        _llm_providers[id(client)] = llm
+        _pool_stats["clients_created"] += 1
+    return client
+
+
+def unwrap_chat_model(llm: Runnable) -> tuple[BaseChatModel, dict]:
+    """The chat model and the arguments bound to it, e.g. the tools of `bind_tools`."""
+    kwargs = {}
+    while isinstance(llm, RunnableBinding):
+        kwargs = {**llm.kwargs, **kwargs}
+        llm = llm.bound
+    return llm, kwargs
+
+
+def llm_provider_of(chat_model: BaseChatModel) -> str | None:
+    """The provider of a chat model returned by `get_llm`, None for other models."""
+    return _llm_providers.get(id(chat_model))
+
+
+def get_llm_pool_stats() -> dict:
+    requests = _pool_stats["requests"]
+    return {
+        **_pool_stats,
+        "clients": len(_llm_clients),
+        # share of the requests that were sent on an already open connection
+        "connection_reuse_rate": 1 - _pool_stats["tcp_connects"] / requests if requests else 0.0,
+    }
+
+
+async def close_llm_clients():
+    """Closes the shared connection pool, called on shutdown."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+    _llm_clients.clear()
+    _llm_providers.clear()
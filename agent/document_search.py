@@ -0,0 +1,107 @@
+import os
+import asyncio
+import hashlib
+from datetime import datetime
+
+from database.usage_recorder import usage_recorder
+from database.db_classes import EmbeddingTokenUsage
+from database.vector_store import VectorChunk, get_user_vector_store
+from .agent_classes import Article
+from .embeddings import get_embedder
+from .editor.retrieval import chunk_markdown, CHUNK_SEPARATOR
+
+
+# 开启后, 每次对话的文章都会在后台写入用户的向量索引, think 和 reply_to_general_input 节点会从中检索相关片段
+VECTOR_INDEX_ENABLED = os.getenv("VECTOR_INDEX_ENABLED", "false") == "true"
+VECTOR_SEARCH_TOP_K = int(os.getenv("VECTOR_SEARCH_TOP_K", 6))
+# results less similar than this are not worth sending
+VECTOR_SEARCH_MIN_SCORE = float(os.getenv("VECTOR_SEARCH_MIN_SCORE", 0.3))
+
+# users whose documents are being indexed, so each user has at most one indexing task at a time
+_indexing_in_progress: set[str] = set()
+# keep references to the background tasks so they are not garbage collected
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def index_user_documents(user_id: str, articles: list[Article]):
+    """
+    Adds the documents not indexed yet to the user's vector store. A new version of a file replaces
+    the previous one, so the store holds the latest version of every file the user has worked with.
+    """
+    embedder = get_embedder()
+    store = await asyncio.to_thread(get_user_vector_store, user_id, embedder.model_name, embedder.dimension)
+
+    for article in articles:
+        if not article.content.strip():
+            continue
+        document_hash = hashlib.sha256(article.content.encode('utf-8')).hexdigest()
+        if store.has_document(document_hash):
+            continue
+
+        chunks = chunk_markdown(article.content)
+        texts = [chunk.render() for chunk in chunks]
+        vectors = await embedder.embed(texts)
+
+        tokens = embedder.count_tokens(texts)
+        if tokens:
+            usage_recorder.record('embedding_token_usage', EmbeddingTokenUsage(user_id=user_id,
+                                                                               model_name=embedder.model_name,
+                                                                               timestamp=datetime.now(),
+                                                                               total_tokens=tokens))
+
+        previous_hash = store.files.get(article.file_name)
+        await asyncio.to_thread(store.add,
+                                [VectorChunk(document_hash=document_hash,
+                                             file_name=article.file_name,
+                                             start_line=chunk.start_line,
+                                             end_line=chunk.end_line,
+                                             text=text)
+                                 for chunk, text in zip(chunks, texts)],
+                                vectors)
+        if previous_hash and previous_hash != document_hash:
+            await asyncio.to_thread(store.delete_document, previous_hash)
+
+
+async def _index_in_background(user_id: str, articles: list[Article]):
+    try:
+        await index_user_documents(user_id, articles)
+    except Exception as e:
+        print(f"    Failed to index documents of user {user_id}: {e}")
+    finally:
+        _indexing_in_progress.discard(user_id)
+
+
+def schedule_document_indexing(user_id: str, articles: list[Article]):
+    if not VECTOR_INDEX_ENABLED or user_id in _indexing_in_progress:
+        return
+    _indexing_in_progress.add(user_id)
+
+    task = asyncio.create_task(_index_in_background(user_id, articles))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def search_user_documents(user_id: str, query: str, exclude_file_names: set[str],
+                                top_k: int = VECTOR_SEARCH_TOP_K) -> list[Article]:
+    """
+    The chunks of the user's indexed documents most similar to `query`, grouped into one article per file
+    in line order. Files in `exclude_file_names` are already in the prompt and are skipped.
+    """
+    if not VECTOR_INDEX_ENABLED or not query.strip():
+        return []
+
+    embedder = get_embedder()
+    store = await asyncio.to_thread(get_user_vector_store, user_id, embedder.model_name, embedder.dimension)
+    query_vector = (await embedder.embed([query]))[0]
+    exclude_hashes = {store.files[file_name] for file_name in exclude_file_names if file_name in store.files}
+    results = await asyncio.to_thread(store.search, query_vector, top_k, exclude_hashes)
+
+    files: dict[str, list] = {}
+    for result in results:
+        if result.score >= VECTOR_SEARCH_MIN_SCORE and result.file_name not in exclude_file_names:
+            files.setdefault(result.file_name, []).append(result)
+
+    return [Article(file_name=file_name,
+                    content=CHUNK_SEPARATOR.join(result.text for result in sorted(chunks, key=lambda r: r.start_line)),
+                    file_category="editable")
+            for file_name, chunks in files.items()]
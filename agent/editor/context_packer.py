@@ -0,0 +1,246 @@
+import os
+import re
+import math
+from typing import Literal
+from pydantic import BaseModel
+from langchain_core.messages import AnyMessage
+
+from ..agent_classes import Article
+from ..llm_utils import parse_setting_pairs
+
+
+# prompt token budgets of the editor nodes by model, the rest of the context window is left for the output
+DEFAULT_PROMPT_BUDGETS = {
+    'qwen-turbo': 64000,
+    'deepseek-r1': 32000,
+}
+DEFAULT_PROMPT_BUDGET = 16000
+
+
+PROMPT_BUDGETS = {**DEFAULT_PROMPT_BUDGETS,
+                  **parse_setting_pairs(os.getenv("EDITOR_PROMPT_BUDGETS", ""), "EDITOR_PROMPT_BUDGETS", int)}
+
+# a truncated document shorter than this is not worth sending, it is dropped instead
+MIN_TRUNCATED_TOKENS = int(os.getenv("EDITOR_MIN_TRUNCATED_TOKENS", 200))
+
+# tags and file name lines around each document, and the text around each list of documents
+DOCUMENT_OVERHEAD_TOKENS = 20
+SECTION_OVERHEAD_TOKENS = 80
+
+# CJK characters, kana, hangul and full width forms are about one token each,
+# other text is about four characters per token
+_WIDE_CHARACTERS = re.compile(r'[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Estimates the number of tokens of `text` without a tokenizer, it slightly overestimates
+    the counts of the qwen and deepseek tokenizers on both english and chinese text.
+    """
+    if not text:
+        return 0
+    wide = len(_WIDE_CHARACTERS.findall(text))
+    return wide + math.ceil((len(text) - wide) / 4)
+
+
+def estimate_message_tokens(messages: list[AnyMessage]) -> int:
+    tokens = 0
+    for message in messages:
+        content = message.content if isinstance(message.content, str) else str(message.content)
+        # role and separators
+        tokens += estimate_tokens(content) + 4
+    return tokens
+
+
+def truncated_marker(omitted_lines: int) -> str:
+    return f"[... {omitted_lines} lines omitted to fit the context ...]"
+
+
+def _cut_at_line(text: str, max_chars: int, from_end: bool = False) -> str:
+    """Cuts `text` to at most `max_chars` characters at a line boundary when there is one."""
+    if from_end:
+        part = text[len(text) - max_chars:]
+        newline = part.find('\n')
+        return part[newline + 1:] if newline != -1 else part
+    part = text[:max_chars]
+    newline = part.rfind('\n')
+    return part[:newline] if newline != -1 else part
+
+
+def truncate_head(text: str, max_tokens: int) -> str:
+    """Keeps the beginning of `text`."""
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    head = _cut_at_line(text, int(len(text) * max_tokens / tokens))
+    omitted_lines = text.count('\n') - head.count('\n')
+    return f"{head}\n{truncated_marker(omitted_lines)}"
+
+
+def truncate_head_tail(text: str, max_tokens: int) -> str:
+    """Keeps the beginning and the end of `text`, where introductions and conclusions usually are."""
+    tokens = estimate_tokens(text)
+    if tokens <= max_tokens:
+        return text
+    chars = int(len(text) * max_tokens / tokens)
+    head = _cut_at_line(text, chars * 2 // 3)
+    tail = _cut_at_line(text, chars // 3, from_end=True)
+    omitted_lines = text.count('\n') - head.count('\n') - tail.count('\n')
+    return f"{head}\n{truncated_marker(omitted_lines)}\n{tail}"
+
+
+TRUNCATION_STRATEGIES = {
+    'head': truncate_head,
+    'head_tail': truncate_head_tail,
+}
+
+TruncationStrategy = Literal['head', 'head_tail']
+
+_packer_stats: dict[str, dict] = {}
+
+
+class DroppedDocument(BaseModel):
+    file_name: str
+    tier: str
+    tokens: int
+    # 0 when the document was dropped entirely
+    kept_tokens: int
+
+
+class PackedContext(BaseModel):
+    budget: int
+    used_tokens: int
+    reference_articles: list[Article]
+    other_articles: list[Article]
+    dropped: list[DroppedDocument]
+
+    def omission_note(self) -> str:
+        """Tells the model which documents it only sees in part or not at all."""
+        if not self.dropped:
+            return ""
+        truncated = [d.file_name for d in self.dropped if d.kept_tokens]
+        omitted = [d.file_name for d in self.dropped if not d.kept_tokens]
+        note = "\nSome of the user's documents did not fit in the context."
+        if truncated:
+            note += f"\nOnly parts of these documents are shown: {', '.join(truncated)}"
+        if omitted:
+            note += f"\nThese documents are not shown: {', '.join(omitted)}"
+        return note + "\n"
+
+
+def allocate_tokens(sizes: list[int], budget: int) -> list[int]:
+    """
+    Splits `budget` between documents of the given sizes: documents smaller than an equal share are kept whole,
+    and the documents that are larger share the rest equally.
+    """
+    allocation = [0] * len(sizes)
+    remaining = budget
+    pending = sorted(range(len(sizes)), key=lambda i: sizes[i])
+    while pending:
+        share = remaining // len(pending)
+        smallest = pending[0]
+        if sizes[smallest] > share:
+            for i in pending:
+                allocation[i] = share
+            break
+        allocation[smallest] = sizes[smallest]
+        remaining -= sizes[smallest]
+        pending.pop(0)
+    return allocation
+
+
+def pack_tier(articles: list[Article], budget: int, tier: str,
+              strategy: TruncationStrategy) -> tuple[list[Article], list[DroppedDocument], int]:
+    """
+    Fits one tier of documents into `budget` tokens. When the documents don't fit, the larger ones are truncated,
+    and when a truncated document would fall below MIN_TRUNCATED_TOKENS, the last documents of the tier are dropped
+    until it doesn't. Returns the packed articles (in their original order), the dropped documents and the tokens used.
+    """
+    if not articles:
+        return [], [], 0
+
+    sizes = [estimate_tokens(article.content) for article in articles]
+    overheads = [DOCUMENT_OVERHEAD_TOKENS + estimate_tokens(article.file_name) for article in articles]
+    kept = list(range(len(articles)))
+    budget -= SECTION_OVERHEAD_TOKENS
+
+    while kept:
+        available = budget - sum(overheads[i] for i in kept)
+        allocation = allocate_tokens([sizes[i] for i in kept], max(available, 0))
+        if all(tokens >= min(sizes[i], MIN_TRUNCATED_TOKENS) for i, tokens in zip(kept, allocation)):
+            break
+        kept.pop()
+
+    allocated = dict(zip(kept, allocation)) if kept else {}
+    truncate = TRUNCATION_STRATEGIES[strategy]
+
+    packed = []
+    dropped = []
+    used = SECTION_OVERHEAD_TOKENS if kept else 0
+    for i, article in enumerate(articles):
+        if i not in allocated:
+            dropped.append(DroppedDocument(file_name=article.file_name, tier=tier, tokens=sizes[i], kept_tokens=0))
+            continue
+
+        used += overheads[i] + allocated[i]
+        if allocated[i] >= sizes[i]:
+            packed.append(article)
+            continue
+
+        content = truncate(article.content, allocated[i])
+        packed.append(Article(file_name=article.file_name, content=content, file_category=article.file_category))
+        dropped.append(DroppedDocument(file_name=article.file_name, tier=tier, tokens=sizes[i],
+                                       kept_tokens=allocated[i]))
+
+    return packed, dropped, used
+
+
+def pack_context(model: str,
+                 required_prompt: str,
+                 messages: list[AnyMessage],
+                 reference_articles: list[Article] | None,
+                 other_articles: list[Article] | None) -> PackedContext:
+    """
+    Fits the supporting documents of an editor prompt into the prompt budget of `model`, by priority tier:
+
+    1. `required_prompt` and `messages`: the instructions, the current article with its highlight and the
+       reflections. They are never truncated, the line numbers of the current article must stay valid for edits.
+    2. reference articles, which the user picked as context: the beginning and the end are kept when truncated.
+    3. other articles the user has written: the beginning is kept when truncated.
+
+    Every truncated or dropped document is listed in `dropped`.
+    """
+    budget = PROMPT_BUDGETS.get(model, DEFAULT_PROMPT_BUDGET)
+    used = estimate_tokens(required_prompt) + estimate_message_tokens(messages)
+
+    packed_references, dropped_references, references_used = pack_tier(
+        reference_articles or [], budget - used, 'reference', 'head_tail')
+    used += references_used
+
+    packed_others, dropped_others, others_used = pack_tier(
+        other_articles or [], budget - used, 'other', 'head')
+    used += others_used
+
+    packed = PackedContext(budget=budget,
+                           used_tokens=used,
+                           reference_articles=packed_references,
+                           other_articles=packed_others,
+                           dropped=dropped_references + dropped_others)
+
+    # counted instead of logged, this runs for every request, the model is told through packed.omission_note()
+    stats = _packer_stats.setdefault(model, {"prompts": 0, "over_budget": 0, "packed_with_omissions": 0,
+                                             "truncated_documents": 0, "dropped_documents": 0,
+                                             "omitted_tokens": 0})
+    stats["prompts"] += 1
+    if used > budget:
+        stats["over_budget"] += 1
+    if packed.dropped:
+        stats["packed_with_omissions"] += 1
+        stats["truncated_documents"] += sum(1 for d in packed.dropped if d.kept_tokens)
+        stats["dropped_documents"] += sum(1 for d in packed.dropped if not d.kept_tokens)
+        stats["omitted_tokens"] += sum(d.tokens - d.kept_tokens for d in packed.dropped)
+    return packed
+
+
+def get_context_packer_stats() -> dict:
+    return {model: dict(stats) for model, stats in _packer_stats.items()}
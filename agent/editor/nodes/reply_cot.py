@@ -1,9 +1,13 @@
 
 from langchain_core.messages import SystemMessage, AIMessage
+from langgraph.types import StreamWriter
 
 from ...ai_models import get_llm
+from ...llm_scheduler import llm_slot
+from ...resilience import resilient_ainvoke
 from ..state import EditorGraphState
-from ...agent_utils import format_reflections
+from ...agent_utils import format_reflections, record_llm_usage
+from ..context_packer import pack_context
 from ..prompts.article_prompt_new import current_article_prompt, other_articles_prompt, reference_articles_prompt
 
 
@@ -131,24 +135,33 @@ def edit_article_tool(line_to_edit: list[int], line_to_add: list[int], editing_i
     return {"line_to_edit": line_to_edit, "line_to_add": line_to_add, "editing_instruction": editing_instruction}
 
 
-async def reply_cot(state: EditorGraphState):
+async def reply_cot(state: EditorGraphState, writer: StreamWriter):
     assistant_data = state.assistant_data
     if not assistant_data:
         raise ValueError(f"Assistant data not found")
     
     formatted_reflections = format_reflections(assistant_data.reflections)
 
-    system_prompt = reply_cot_prompt(current_article_prompt=current_article_prompt(state.article, state.highlight_data),
-                                    other_articles_prompt=other_articles_prompt(state.other_articles),
-                                    reference_articles_prompt=reference_articles_prompt(state.reference_articles),
-                                    formatted_reflections=formatted_reflections)
+    article_prompt = current_article_prompt(state.article, state.highlight_data)
+    packed = pack_context(model='qwen-turbo',
+                          required_prompt=reply_cot_prompt(article_prompt, '', '', formatted_reflections),
+                          messages=state.messages,
+                          reference_articles=state.reference_articles,
+                          other_articles=state.other_articles)
+
+    system_prompt = reply_cot_prompt(current_article_prompt=article_prompt,
+                                     other_articles_prompt=other_articles_prompt(packed.other_articles),
+                                     reference_articles_prompt=reference_articles_prompt(packed.reference_articles) + packed.omission_note(),
+                                     formatted_reflections=formatted_reflections)
     
     llm = get_llm(llm=state.assistant_data.llm_provider, model='qwen-turbo', temperature=0)
     llm_tools = llm.bind_tools([edit_article_tool])
 
     input_messages = [SystemMessage(system_prompt)] + state.messages
 
-    ai_message = await llm_tools.ainvoke(input=input_messages)
+    async with llm_slot(assistant_data.llm_provider, assistant_data.user_id, cost=packed.used_tokens, writer=writer):
+        ai_message = await resilient_ainvoke(llm_tools, input_messages)
+    record_llm_usage(assistant_data.user_id, ai_message)
 
     if ai_message.tool_calls:
         tool_call = ai_message.tool_calls[0]
@@ -1,51 +1,73 @@
+import time
 from langchain_core.messages import SystemMessage
+from langgraph.types import StreamWriter
 
 from ..state import EditorGraphState
+from ..prompts.prompt_layout import PromptLayout, reflections_section, record_prompt_cache_usage
 from ..prompts.article_prompts import current_article_prompt, other_articles_prompt, reference_articles_prompt
-from ...agent_utils import format_reflections
+from ...agent_utils import format_reflections, record_llm_usage
+from ..context_packer import pack_context
+from ..retrieval import retrieval_query, select_relevant_chunks
+from ...document_search import search_user_documents
 from ...ai_models import get_llm
+from ...response_cache import cached_ainvoke
+from ...llm_scheduler import llm_slot
+
+
+REPLY_TO_GENERAL_INPUT_PROMPT_LAYOUT = PromptLayout(node='reply_to_general_input', version=1, static_prefix='''You are an AI assistant tasked with responding to the users question.
+The user is currently working on an article in markdown format, you should use the current article as context when responding to the users question.
+The user may highlight some text in the current article, you should use the highlighted text as context when generating your response.''')
 
 
 def reply_to_general_input_prompt(current_article_prompt:str,
                                   other_articles_prompt:str,
                                   reference_articles_prompt:str,
                                   formatted_reflections:str):
-    return f'''You are an AI assistant tasked with responding to the users question.
-The user is currently working on an article in markdown format, you should use the current article as context when responding to the users question.
-The user may highlight some text in the current article, you should use the highlighted text as context when generating your response.
-
-{current_article_prompt}
-
-{other_articles_prompt}
-
-{reference_articles_prompt}
-
-You have the following reflections on style guidelines and general facts about the user to use when generating your response.
-<reflections>
-{formatted_reflections}
-</reflections>
-
-'''
+    # the static prefix first, then the sections from the least to the most volatile, see PromptLayout
+    return REPLY_TO_GENERAL_INPUT_PROMPT_LAYOUT.render(reflections_section(formatted_reflections),
+                                                       reference_articles_prompt,
+                                                       other_articles_prompt,
+                                                       current_article_prompt)
 
 
-async def reply_to_general_input(state: EditorGraphState):
+async def reply_to_general_input(state: EditorGraphState, writer: StreamWriter):
     assistant_data = state.assistant_data
     if not assistant_data:
         raise ValueError(f"Assistant data not found")
     
     formatted_reflections = format_reflections(assistant_data.reflections)
 
-    system_prompt = reply_to_general_input_prompt(current_article_prompt=current_article_prompt(state.article, state.highlight_data.text),
-                                                    other_articles_prompt=other_articles_prompt(state.other_articles),
-                                                    reference_articles_prompt=reference_articles_prompt(state.reference_articles),
-                                                    formatted_reflections=formatted_reflections)
+    query = retrieval_query(state.messages, state.highlight_data.text)
+    reference_articles = await select_relevant_chunks(state.reference_articles, query)
+    other_articles = await select_relevant_chunks(state.other_articles, query)
+    # related parts of the user's other documents, when the vector index is enabled
+    sent_file_names = {article.file_name for article in [state.article] + (state.other_articles or [])
+                       + (state.reference_articles or [])}
+    other_articles = (other_articles or []) + await search_user_documents(assistant_data.user_id, query,
+                                                                          exclude_file_names=sent_file_names)
+    article_prompt = current_article_prompt(state.article, state.highlight_data.text)
+    packed = pack_context(model='qwen-turbo',
+                          required_prompt=reply_to_general_input_prompt(article_prompt, '', '', formatted_reflections),
+                          messages=state.messages,
+                          reference_articles=reference_articles,
+                          other_articles=other_articles)
+
+    system_prompt = reply_to_general_input_prompt(current_article_prompt=article_prompt,
+                                                  other_articles_prompt=other_articles_prompt(packed.other_articles),
+                                                  reference_articles_prompt=reference_articles_prompt(packed.reference_articles) + packed.omission_note(),
+                                                  formatted_reflections=formatted_reflections)
  
 
     llm = get_llm(llm=state.assistant_data.llm_provider, model='qwen-turbo', temperature=0)
 
     input_messages = [SystemMessage(system_prompt)] + state.messages
 
-    ai_message = await llm.ainvoke(input=input_messages)
+    started_at = time.perf_counter()
+    ai_message = await cached_ainvoke(llm, input_messages,
+                                      admission=llm_slot(assistant_data.llm_provider, assistant_data.user_id,
+                                                         cost=packed.used_tokens, writer=writer))
+    record_prompt_cache_usage(REPLY_TO_GENERAL_INPUT_PROMPT_LAYOUT, ai_message, started_at)
+    record_llm_usage(assistant_data.user_id, ai_message)
 
     return {"messages": ai_message}
 
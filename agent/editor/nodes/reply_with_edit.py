@@ -1,17 +1,19 @@
+import time
 
 from langchain_core.messages import SystemMessage, AIMessage
+from langgraph.types import StreamWriter
 
 from ...ai_models import get_llm
+from ...response_cache import cached_ainvoke
+from ...llm_scheduler import llm_slot
 from ..state import EditorGraphState
-from ...agent_utils import format_reflections
+from ..prompts.prompt_layout import PromptLayout, reflections_section, record_prompt_cache_usage
+from ...agent_utils import format_reflections, record_llm_usage
+from ..context_packer import pack_context
 from ..prompts.article_prompts import current_article_prompt, other_articles_prompt, reference_articles_prompt
 
 
-def reply_with_edit_prompt(current_article_prompt:str,
-                            other_articles_prompt:str,
-                            reference_articles_prompt:str,
-                            formatted_reflections:str):
-    return f'''You are an AI assistant tasked with responding to the users query and editing the current article.
+REPLY_WITH_EDIT_PROMPT_LAYOUT = PromptLayout(node='reply_with_edit', version=1, static_prefix='''You are an AI assistant tasked with responding to the users query and editing the current article.
 The user is currently working on an article in markdown format, you should use the current article as context when responding to the users query.
 The user may highlight some text in the current article, you should use the highlighted text as context when generating your response.
 You should edit the current article based on the users query, ensure you use markdown syntax when appropriate, as the text you generate will be rendered in markdown.
@@ -44,21 +46,18 @@ Here should be your response to the users query:
 I will help you extend the sentence to be more informative.
 
 <@edited_article>I am a software engineer, and I write python and javascript.</@edited_article>
-</example_2>
-
-
-{current_article_prompt}
+</example_2>''')
 
-{other_articles_prompt}
 
-{reference_articles_prompt}
-
-You have the following reflections on style guidelines and general facts about the user to use when generating your response.
-<reflections>
-{formatted_reflections}
-</reflections>
-
-'''
+def reply_with_edit_prompt(current_article_prompt:str,
+                           other_articles_prompt:str,
+                           reference_articles_prompt:str,
+                           formatted_reflections:str):
+    # the static prefix first, then the sections from the least to the most volatile, see PromptLayout
+    return REPLY_WITH_EDIT_PROMPT_LAYOUT.render(reflections_section(formatted_reflections),
+                                                reference_articles_prompt,
+                                                other_articles_prompt,
+                                                current_article_prompt)
 
 
 def seperate_response_and_edited_article(ai_message: AIMessage):
@@ -70,24 +69,36 @@ def seperate_response_and_edited_article(ai_message: AIMessage):
     return response_str, edited_article
 
 
-async def reply_with_edit(state: EditorGraphState):
+async def reply_with_edit(state: EditorGraphState, writer: StreamWriter):
     assistant_data = state.assistant_data
     if not assistant_data:
         raise ValueError(f"Assistant data not found")
     
     formatted_reflections = format_reflections(assistant_data.reflections)
 
-    system_prompt = reply_with_edit_prompt(current_article_prompt=current_article_prompt(state.article, state.highlight_data.text),
-                                            other_articles_prompt=other_articles_prompt(state.other_articles),
-                                            reference_articles_prompt=reference_articles_prompt(state.reference_articles),
-                                            formatted_reflections=formatted_reflections)
+    article_prompt = current_article_prompt(state.article, state.highlight_data.text)
+    packed = pack_context(model='qwen-turbo',
+                          required_prompt=reply_with_edit_prompt(article_prompt, '', '', formatted_reflections),
+                          messages=state.messages,
+                          reference_articles=state.reference_articles,
+                          other_articles=state.other_articles)
+
+    system_prompt = reply_with_edit_prompt(current_article_prompt=article_prompt,
+                                           other_articles_prompt=other_articles_prompt(packed.other_articles),
+                                           reference_articles_prompt=reference_articles_prompt(packed.reference_articles) + packed.omission_note(),
+                                           formatted_reflections=formatted_reflections)
         
     llm = get_llm(llm=state.assistant_data.llm_provider, model='qwen-turbo', temperature=0)
 
     input_messages = [SystemMessage(system_prompt)] + state.messages
 
     # the llm response will be streamed and handled by routers/chat.py
-    ai_message = await llm.ainvoke(input=input_messages)
+    started_at = time.perf_counter()
+    ai_message = await cached_ainvoke(llm, input_messages,
+                                      admission=llm_slot(assistant_data.llm_provider, assistant_data.user_id,
+                                                         cost=packed.used_tokens, writer=writer))
+    record_prompt_cache_usage(REPLY_WITH_EDIT_PROMPT_LAYOUT, ai_message, started_at)
+    record_llm_usage(assistant_data.user_id, ai_message)
 
     response_str, edited_article = seperate_response_and_edited_article(ai_message)
 
@@ -1,17 +1,20 @@
 import re
+import time
 from langchain_core.messages import SystemMessage, AIMessage
+from langgraph.types import StreamWriter
 
 from ...ai_models import get_llm
+from ...hedging import hedged_ainvoke, think_backups
 from ..state import EditorGraphState
-from ...agent_utils import format_reflections
+from ..prompts.prompt_layout import PromptLayout, reflections_section, record_prompt_cache_usage
+from ...agent_utils import format_reflections, record_llm_usage
+from ..context_packer import pack_context
+from ..retrieval import retrieval_query, select_relevant_chunks
+from ...document_search import search_user_documents
 from ..prompts.article_prompt_new import current_article_prompt, other_articles_prompt, reference_articles_prompt
 
 
-def think_prompt(current_article_prompt:str,
-                    other_articles_prompt:str,
-                    reference_articles_prompt:str,
-                    formatted_reflections:str):
-    return f'''You are an AI article editor assistant, your job is to answer the user's query based on the editing article or perform tasks based on the user's query.
+THINK_PROMPT_LAYOUT = PromptLayout(node='think', version=1, static_prefix='''You are an AI article editor assistant, your job is to answer the user's query based on the editing article or perform tasks based on the user's query.
 The user is currently working on an article in markdown format, you should use the current article as context when trying to understand the users query.
 The user may highlight or select some text in the current article, if the user does, you should mainly use the highlighted text and the text around it as context. 
 The user may ask questions or ask you to perform tasks, you can respond to the questions or use your ability to perform tasks. 
@@ -59,20 +62,18 @@ And you can edit multiple lines at once, for example, if you want to edit line 1
 <line_2>This is the edited line 2.\nAnd this is a new line after line 2.</line_2>
 </edited_content>
 
-Typically, you don't need to repeat the lines that you don't edit, although you can if you want to.
-
-
-{current_article_prompt}
+Typically, you don't need to repeat the lines that you don't edit, although you can if you want to.''')
 
-{other_articles_prompt}
 
-{reference_articles_prompt}
-
-You have the following reflections on style guidelines and general facts about the user to use when generating your response.
-<reflections>
-{formatted_reflections}
-</reflections>
-'''
+def think_prompt(current_article_prompt:str,
+                 other_articles_prompt:str,
+                 reference_articles_prompt:str,
+                 formatted_reflections:str):
+    # the static prefix first, then the sections from the least to the most volatile, see PromptLayout
+    return THINK_PROMPT_LAYOUT.render(reflections_section(formatted_reflections),
+                                      reference_articles_prompt,
+                                      other_articles_prompt,
+                                      current_article_prompt)
 
 
 def parse_tag_content(ai_message: AIMessage):
@@ -91,23 +92,45 @@ def parse_tag_content(ai_message: AIMessage):
     return response_content, think_content, edited_content
 
 
-async def think(state: EditorGraphState):
+async def think(state: EditorGraphState, writer: StreamWriter):
     assistant_data = state.assistant_data
     if not assistant_data:
         raise ValueError(f"Assistant data not found")
     
     formatted_reflections = format_reflections(assistant_data.reflections)
 
-    system_prompt = think_prompt(current_article_prompt=current_article_prompt(state.article, state.highlight_data),
-                                    other_articles_prompt=other_articles_prompt(state.other_articles),
-                                    reference_articles_prompt=reference_articles_prompt(state.reference_articles),
-                                    formatted_reflections=formatted_reflections)
+    query = retrieval_query(state.messages, state.highlight_data.text)
+    reference_articles = await select_relevant_chunks(state.reference_articles, query)
+    other_articles = await select_relevant_chunks(state.other_articles, query)
+    # related parts of the user's other documents, when the vector index is enabled
+    sent_file_names = {article.file_name for article in [state.article] + (state.other_articles or [])
+                       + (state.reference_articles or [])}
+    other_articles = (other_articles or []) + await search_user_documents(assistant_data.user_id, query,
+                                                                          exclude_file_names=sent_file_names)
+    article_prompt = current_article_prompt(state.article, state.highlight_data)
+    packed = pack_context(model='deepseek-r1',
+                          required_prompt=think_prompt(article_prompt, '', '', formatted_reflections),
+                          messages=state.messages,
+                          reference_articles=reference_articles,
+                          other_articles=other_articles)
+
+    system_prompt = think_prompt(current_article_prompt=article_prompt,
+                                 other_articles_prompt=other_articles_prompt(packed.other_articles),
+                                 reference_articles_prompt=reference_articles_prompt(packed.reference_articles) + packed.omission_note(),
+                                 formatted_reflections=formatted_reflections)
     
     llm = get_llm(llm='fireworks', model='deepseek-r1', temperature=0.5)
 
     input_messages = [SystemMessage(system_prompt)] + state.messages
 
-    ai_message = await llm.ainvoke(input=input_messages)
+    # waits for a fireworks slot when the provider is busy, the queue status is streamed to the client.
+    # when THINK_HEDGE_BACKUPS is set, a slow first token from fireworks starts the same request on a backup,
+    # in a slot of the backup's provider
+    started_at = time.perf_counter()
+    ai_message = await hedged_ainvoke('fireworks', llm, think_backups(temperature=0.5), input_messages,
+                                      user_id=assistant_data.user_id, cost=packed.used_tokens, writer=writer)
+    record_prompt_cache_usage(THINK_PROMPT_LAYOUT, ai_message, started_at)
+    record_llm_usage(assistant_data.user_id, ai_message)
 
     response_content, think_content, edited_content = parse_tag_content(ai_message)
 
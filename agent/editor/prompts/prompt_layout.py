@@ -0,0 +1,91 @@
+import time
+import hashlib
+from langchain_core.messages import AIMessage
+
+
+class PromptLayout:
+    """
+    The system prompt of a node: a static prefix, byte-identical for every call of the same node version,
+    followed by the dynamic sections. Providers cache the longest prompt prefix they have seen recently,
+    so the sections are passed least volatile first: reflections, reference articles, other articles,
+    and the current article with its highlight last.
+    Bump `version` whenever the static prefix changes, so the cache statistics of the versions stay apart.
+    """
+
+    def __init__(self, node: str, version: int, static_prefix: str):
+        self.node = node
+        self.version = version
+        self.static_prefix = static_prefix
+        self.prefix_hash = hashlib.sha256(static_prefix.encode('utf-8')).hexdigest()[:12]
+
+    def render(self, *sections: str) -> str:
+        return self.static_prefix + ''.join(f"\n\n{section}" for section in sections if section)
+
+
+def reflections_section(formatted_reflections: str) -> str:
+    return f'''You have the following reflections on style guidelines and general facts about the user to use when generating your response.
+<reflections>
+{formatted_reflections}
+</reflections>'''
+
+
+# (node, version) -> prompt cache statistics
+_prompt_cache_stats: dict[tuple[str, int], dict] = {}
+
+
+def cached_prompt_tokens(ai_message: AIMessage) -> tuple[int, int] | None:
+    """(prompt tokens, prompt tokens served from the provider's prefix cache), None without usage metadata."""
+    usage = ai_message.usage_metadata
+    if not usage:
+        return None
+    cached = (usage.get('input_token_details') or {}).get('cache_read') or 0
+    if not cached:
+        # deepseek reports its context cache hits in a field of its own
+        cached = (ai_message.response_metadata.get('token_usage') or {}).get('prompt_cache_hit_tokens') or 0
+    return usage['input_tokens'], cached
+
+
+def record_prompt_cache_usage(layout: PromptLayout, ai_message: AIMessage, started_at: float):
+    """Records the prompt cache usage of a call made with `layout`, `started_at` is its time.perf_counter() start."""
+    tokens = cached_prompt_tokens(ai_message)
+    if tokens is None:
+        # replayed from the response cache, or a provider that reports no usage
+        return
+    prompt_tokens, cached_tokens = tokens
+    elapsed = time.perf_counter() - started_at
+
+    stats = _prompt_cache_stats.setdefault((layout.node, layout.version), {
+        "prefix_hash": layout.prefix_hash,
+        "calls": 0,
+        "prompt_tokens": 0,
+        "cached_prompt_tokens": 0,
+        "hit_calls": 0,
+        "hit_seconds": 0.0,
+        "miss_calls": 0,
+        "miss_seconds": 0.0,
+    })
+    stats["calls"] += 1
+    stats["prompt_tokens"] += prompt_tokens
+    stats["cached_prompt_tokens"] += cached_tokens
+    if cached_tokens:
+        stats["hit_calls"] += 1
+        stats["hit_seconds"] += elapsed
+    else:
+        stats["miss_calls"] += 1
+        stats["miss_seconds"] += elapsed
+
+
+def get_prompt_cache_stats() -> dict:
+    report = {}
+    for (node, version), stats in _prompt_cache_stats.items():
+        hit_mean = stats["hit_seconds"] / stats["hit_calls"] if stats["hit_calls"] else None
+        miss_mean = stats["miss_seconds"] / stats["miss_calls"] if stats["miss_calls"] else None
+        report[f"{node}@v{version}"] = {
+            **stats,
+            "token_hit_rate": stats["cached_prompt_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0,
+            "call_hit_rate": stats["hit_calls"] / stats["calls"] if stats["calls"] else 0.0,
+            # rough: the calls also differ in prompt and answer length
+            "estimated_seconds_saved": (miss_mean - hit_mean) * stats["hit_calls"]
+            if hit_mean is not None and miss_mean is not None else None,
+        }
+    return report
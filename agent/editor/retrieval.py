@@ -0,0 +1,271 @@
+import os
+import re
+import asyncio
+import math
+import hashlib
+from collections import Counter
+from pydantic import BaseModel
+from langchain_core.messages import AnyMessage, HumanMessage
+
+from database.cache import TTLCache
+from ..agent_classes import Article
+from .context_packer import estimate_tokens
+
+
+# supporting documents are only narrowed down to their relevant chunks above this many tokens in total
+RETRIEVAL_MIN_TOKENS = int(os.getenv("RETRIEVAL_MIN_TOKENS", 4000))
+# number of chunks sent per list of documents
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", 8))
+RETRIEVAL_CHUNK_TOKENS = int(os.getenv("RETRIEVAL_CHUNK_TOKENS", 300))
+RETRIEVAL_INDEX_CACHE_SIZE = int(os.getenv("RETRIEVAL_INDEX_CACHE_SIZE", 512))
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_HEADING = re.compile(r'^(#{1,6})\s+(.*)$')
+_FENCE = re.compile(r'^\s*(```|~~~)')
+# latin words and numbers, and runs of CJK characters
+_TERMS = re.compile(r'[a-z0-9]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af]+')
+_STOPWORDS = frozenset(
+    'a an and are as at be but by for from has have i in is it its of on or that the this to was were will with'
+    .split())
+
+CHUNK_SEPARATOR = "\n\n[...]\n\n"
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercased latin words without stopwords, and overlapping bigrams of CJK text, which has no spaces."""
+    terms = []
+    for match in _TERMS.finditer(text.lower()):
+        term = match.group()
+        if term.isascii():
+            if term not in _STOPWORDS:
+                terms.append(term)
+        elif len(term) == 1:
+            terms.append(term)
+        else:
+            terms.extend(term[i:i + 2] for i in range(len(term) - 1))
+    return terms
+
+
+class Chunk(BaseModel):
+    # the headings the chunk is under, e.g. "# Guide > ## Install"
+    heading: str
+    text: str
+    # 1-based line range in the document
+    start_line: int
+    end_line: int
+
+    def render(self) -> str:
+        if not self.heading or self.text.startswith('#'):
+            return self.text
+        return f"{self.heading}\n{self.text}"
+
+
+def _split_blocks(lines: list[str]) -> list[tuple[str, int, int, bool]]:
+    """
+    Splits markdown lines into blocks: headings, paragraphs separated by blank lines and fenced code blocks,
+    which are never split. Returns (heading path, first line index, last line index, is heading) tuples.
+    """
+    blocks = []
+    headings: list[str] = []
+    start = None
+    in_fence = False
+
+    def close(end):
+        nonlocal start
+        if start is not None:
+            blocks.append((' > '.join(headings), start, end, False))
+            start = None
+
+    for i, line in enumerate(lines):
+        if _FENCE.match(line):
+            if start is None:
+                start = i
+            in_fence = not in_fence
+            continue
+        if in_fence:
+            continue
+
+        heading = _HEADING.match(line)
+        if heading:
+            close(i - 1)
+            level = len(heading.group(1))
+            headings = headings[:level - 1] + [line.strip()]
+            blocks.append((' > '.join(headings), i, i, True))
+        elif not line.strip():
+            close(i - 1)
+        elif start is None:
+            start = i
+
+    close(len(lines) - 1)
+    return blocks
+
+
+def chunk_markdown(text: str, max_tokens: int = RETRIEVAL_CHUNK_TOKENS) -> list[Chunk]:
+    """
+    Splits a markdown document into chunks of about `max_tokens` tokens. Consecutive blocks of the same section
+    are merged up to the limit, a new heading always starts a new chunk, and single blocks larger than the limit
+    are split between lines.
+    """
+    lines = text.split('\n')
+    chunks = []
+    current: list[tuple[int, int]] = []
+    current_heading = ''
+    current_tokens = 0
+
+    def flush():
+        nonlocal current, current_tokens
+        if current:
+            start_line, end_line = current[0][0], current[-1][1]
+            chunks.append(Chunk(heading=current_heading,
+                                text='\n'.join(lines[start_line:end_line + 1]).strip('\n'),
+                                start_line=start_line + 1,
+                                end_line=end_line + 1))
+        current = []
+        current_tokens = 0
+
+    for heading, start, end, is_heading in _split_blocks(lines):
+        if is_heading or heading != current_heading:
+            flush()
+            current_heading = heading
+
+        for piece_start, piece_end, tokens in _split_block(lines, start, end, max_tokens):
+            if current and current_tokens + tokens > max_tokens:
+                flush()
+            current.append((piece_start, piece_end))
+            current_tokens += tokens
+
+    flush()
+    return chunks
+
+
+def _split_block(lines: list[str], start: int, end: int, max_tokens: int):
+    """Yields (start, end, tokens) pieces of the block lines[start:end + 1] of at most about `max_tokens` tokens."""
+    piece_start = start
+    tokens = 0
+    for i in range(start, end + 1):
+        line_tokens = estimate_tokens(lines[i]) + 1
+        if i > piece_start and tokens + line_tokens > max_tokens:
+            yield piece_start, i - 1, tokens
+            piece_start = i
+            tokens = 0
+        tokens += line_tokens
+    yield piece_start, end, tokens
+
+
+class DocumentIndex:
+    """BM25 statistics of the chunks of one document version. Immutable once built, so it can be shared."""
+
+    def __init__(self, content: str):
+        self.chunks = chunk_markdown(content)
+        self.lengths: list[int] = []
+        # term -> [(chunk index, term frequency)]
+        self.postings: dict[str, list[tuple[int, int]]] = {}
+        for chunk_index, chunk in enumerate(self.chunks):
+            terms = tokenize(chunk.heading + '\n' + chunk.text)
+            self.lengths.append(len(terms))
+            for term, frequency in Counter(terms).items():
+                self.postings.setdefault(term, []).append((chunk_index, frequency))
+        self.total_length = sum(self.lengths)
+
+    def document_frequency(self, term: str) -> int:
+        return len(self.postings.get(term, ()))
+
+
+# content hash -> DocumentIndex, so each document version is chunked and indexed once
+document_index_cache = TTLCache(maxsize=RETRIEVAL_INDEX_CACHE_SIZE, ttl=3600)
+
+
+async def get_document_index(content: str) -> DocumentIndex:
+    key = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    index = document_index_cache.get(key)
+    if index is None:
+        # indexing a large document takes a while, keep the event loop responsive meanwhile
+        index = await asyncio.to_thread(DocumentIndex, content)
+        document_index_cache.set(key, index)
+    return index
+
+
+def get_retrieval_cache_stats():
+    return document_index_cache.stats()
+
+
+def retrieval_query(messages: list[AnyMessage], highlight: str | None) -> str:
+    """The latest user message and the highlighted text."""
+    latest = next((message for message in reversed(messages) if isinstance(message, HumanMessage)), None)
+    parts = []
+    if latest is not None:
+        parts.append(latest.content if isinstance(latest.content, str) else str(latest.content))
+    if highlight:
+        parts.append(highlight)
+    return '\n'.join(parts)
+
+
+def search_chunks(indexes: list[DocumentIndex], query: str, top_k: int) -> list[tuple[float, int, int]]:
+    """
+    Scores the chunks of all `indexes` against `query` with BM25, the document frequencies and the average
+    chunk length are those of all the chunks together. Returns the top (score, index number, chunk index).
+    """
+    chunk_count = sum(len(index.chunks) for index in indexes)
+    if not chunk_count:
+        return []
+    average_length = sum(index.total_length for index in indexes) / chunk_count or 1.0
+
+    scores: dict[tuple[int, int], float] = {}
+    for term, query_frequency in Counter(tokenize(query)).items():
+        document_frequency = sum(index.document_frequency(term) for index in indexes)
+        if not document_frequency:
+            continue
+        idf = math.log(1 + (chunk_count - document_frequency + 0.5) / (document_frequency + 0.5))
+        for index_number, index in enumerate(indexes):
+            for chunk_index, frequency in index.postings.get(term, ()):
+                length_norm = 1 - BM25_B + BM25_B * index.lengths[chunk_index] / average_length
+                score = idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * length_norm)
+                key = (index_number, chunk_index)
+                scores[key] = scores.get(key, 0.0) + score * query_frequency
+
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+    return [(score, index_number, chunk_index) for (index_number, chunk_index), score in ranked]
+
+
+def exceeds_tokens(articles: list[Article], max_tokens: int) -> bool:
+    # a character is at most one token and four characters at least one, only estimate when that doesn't tell
+    characters = sum(len(article.content) for article in articles)
+    if characters <= max_tokens:
+        return False
+    if characters > 4 * max_tokens:
+        return True
+    return sum(estimate_tokens(article.content) for article in articles) > max_tokens
+
+
+async def select_relevant_chunks(articles: list[Article] | None, query: str,
+                           top_k: int = RETRIEVAL_TOP_K) -> list[Article] | None:
+    """
+    Replaces the content of `articles` with their chunks most relevant to `query`, in document order.
+    Articles without a relevant chunk are left out. Small lists of articles, an empty query,
+    or a query that matches no chunk at all are returned unchanged, so pack_context truncates them
+    and notes what it omitted instead of the context being lost silently.
+    """
+    if not articles or not tokenize(query):
+        return articles
+    if not exceeds_tokens(articles, RETRIEVAL_MIN_TOKENS):
+        return articles
+
+    indexes = [await get_document_index(article.content) for article in articles]
+    selected: dict[int, list[int]] = {}
+    for _, index_number, chunk_index in search_chunks(indexes, query, top_k):
+        selected.setdefault(index_number, []).append(chunk_index)
+    if not selected:
+        return articles
+
+    relevant = []
+    for index_number, article in enumerate(articles):
+        if index_number not in selected:
+            continue
+        chunks = [indexes[index_number].chunks[i] for i in sorted(selected[index_number])]
+        relevant.append(Article(file_name=article.file_name,
+                                content=CHUNK_SEPARATOR.join(chunk.render() for chunk in chunks),
+                                file_category=article.file_category))
+
+    return relevant
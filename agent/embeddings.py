@@ -0,0 +1,107 @@
+import os
+import math
+import asyncio
+import hashlib
+from abc import ABC, abstractmethod
+from functools import lru_cache
+import numpy as np
+
+from .editor.context_packer import estimate_tokens
+from .editor.retrieval import tokenize
+
+
+# `hashing` works offline and costs nothing, `dashscope` calls the DashScope embedding api
+EMBEDDER = os.getenv("EMBEDDER", "hashing")
+HASHING_EMBEDDER_DIMENSION = int(os.getenv("HASHING_EMBEDDER_DIMENSION", 512))
+DASHSCOPE_EMBEDDING_MODEL = os.getenv("DASHSCOPE_EMBEDDING_MODEL", "text-embedding-v3")
+
+
+class Embedder(ABC):
+    """Turns texts into L2-normalized float32 vectors of `dimension` dimensions."""
+    model_name: str
+    dimension: int
+
+    @abstractmethod
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        ...
+
+    def count_tokens(self, texts: list[str]) -> int:
+        return sum(estimate_tokens(text) for text in texts)
+
+
+@lru_cache(maxsize=65536)
+def _hash_term(term: str, dimension: int) -> tuple[int, float]:
+    digest = hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest()
+    value = int.from_bytes(digest, 'little')
+    # the lowest bit picks the sign, so colliding terms cancel out instead of adding up on average
+    return (value >> 1) % dimension, 1.0 if value & 1 else -1.0
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vectors / norms).astype(np.float32)
+
+
+class HashingEmbedder(Embedder):
+    """
+    Deterministic embedder for offline use: the terms of retrieval.tokenize are hashed into a signed
+    bag of words with sublinear term frequencies. Vectors are the same across processes and machines,
+    so stored vectors stay valid after a restart.
+    """
+
+    def __init__(self, dimension: int = HASHING_EMBEDDER_DIMENSION):
+        self.dimension = dimension
+        self.model_name = f"hashing-{dimension}"
+
+    def embed_sync(self, texts: list[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for row, text in enumerate(texts):
+            counts: dict[str, int] = {}
+            for term in tokenize(text):
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                column, sign = _hash_term(term, self.dimension)
+                vectors[row, column] += sign * (1.0 + math.log(count))
+        return normalize(vectors)
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        return await asyncio.to_thread(self.embed_sync, texts)
+
+    def count_tokens(self, texts: list[str]) -> int:
+        # nothing is billed for local embeddings
+        return 0
+
+
+class DashScopeEmbedder(Embedder):
+    """Embeddings from the OpenAI compatible DashScope api."""
+
+    def __init__(self, model: str = DASHSCOPE_EMBEDDING_MODEL, dimension: int = 1024):
+        from langchain_openai import OpenAIEmbeddings
+
+        self.model_name = model
+        self.dimension = dimension
+        self._embeddings = OpenAIEmbeddings(model=model,
+                                            dimensions=dimension,
+                                            api_key=os.getenv('DASHSCOPE_API_KEY'),
+                                            base_url=os.getenv('DASHSCOPE_BASE_URL'),
+                                            # DashScope takes strings, not the token ids tiktoken would send
+                                            check_embedding_ctx_length=False,
+                                            chunk_size=10)
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        vectors = await self._embeddings.aembed_documents(texts)
+        return normalize(np.asarray(vectors, dtype=np.float32))
+
+
+_embedder: Embedder | None = None
+
+
+def get_embedder() -> Embedder:
+    global _embedder
+    if _embedder is None:
+        if EMBEDDER == "dashscope":
+            _embedder = DashScopeEmbedder()
+        else:
+            _embedder = HashingEmbedder()
+    return _embedder
@@ -0,0 +1,113 @@
+"""
+A local, OpenAI compatible fake llm provider, to try the failure handling of agent/resilience.py offline.
+
+Run it with `python -m agent.fake_provider` and point a provider at it, e.g.
+DASHSCOPE_BASE_URL=http://127.0.0.1:8765/v1. Every request takes the next step of the scenario,
+and the last step repeats. The steps are:
+- `ok`: streams a short answer
+- an HTTP status code, e.g. `429` or `503`: fails with that status, 429 and 503 with a Retry-After header
+- `slow`: streams the answer after FAKE_PROVIDER_SLOW_SECONDS
+- `cut`: drops the connection in the middle of the answer
+The scenario is FAKE_PROVIDER_SCENARIO (e.g. `429,500,ok`), and can be replaced with POST /fake/scenario.
+"""
+import os
+import json
+import time
+import asyncio
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+
+
+FAKE_PROVIDER_PORT = int(os.getenv("FAKE_PROVIDER_PORT", 8765))
+FAKE_PROVIDER_SCENARIO = os.getenv("FAKE_PROVIDER_SCENARIO", "ok")
+FAKE_PROVIDER_RETRY_AFTER_SECONDS = float(os.getenv("FAKE_PROVIDER_RETRY_AFTER_SECONDS", 1))
+FAKE_PROVIDER_SLOW_SECONDS = float(os.getenv("FAKE_PROVIDER_SLOW_SECONDS", 5))
+
+ANSWER_TOKENS = ["This ", "is ", "a ", "fake ", "answer."]
+
+
+class Scenario(BaseModel):
+    steps: str
+    retry_after_seconds: float = FAKE_PROVIDER_RETRY_AFTER_SECONDS
+
+
+app = FastAPI()
+_scenario = {"steps": FAKE_PROVIDER_SCENARIO.split(','),
+             "retry_after_seconds": FAKE_PROVIDER_RETRY_AFTER_SECONDS,
+             "requests": 0}
+
+
+def next_step() -> str:
+    steps = _scenario["steps"]
+    step = steps[min(_scenario["requests"], len(steps) - 1)].strip()
+    _scenario["requests"] += 1
+    return step
+
+
+def chunk_data(model: str, delta: dict, finish_reason: str | None = None) -> str:
+    chunk = {"id": "fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+             "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+    return f"data: {json.dumps(chunk)}\n\n"
+
+
+async def stream_answer(model: str, step: str, include_usage: bool):
+    if step == 'slow':
+        await asyncio.sleep(FAKE_PROVIDER_SLOW_SECONDS)
+    yield chunk_data(model, {"role": "assistant", "content": ""})
+    for index, token in enumerate(ANSWER_TOKENS):
+        if step == 'cut' and index == len(ANSWER_TOKENS) // 2:
+            # the client sees the connection close without the end of the stream
+            raise ConnectionResetError("fake provider dropped the connection")
+        yield chunk_data(model, {"content": token})
+    yield chunk_data(model, {}, finish_reason="stop")
+    if include_usage:
+        usage = {"id": "fake", "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                 "choices": [], "usage": {"prompt_tokens": 100, "completion_tokens": len(ANSWER_TOKENS),
+                                          "total_tokens": 100 + len(ANSWER_TOKENS)}}
+        yield f"data: {json.dumps(usage)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    step = next_step()
+    print(f"    Fake provider request {_scenario['requests']}: {step}")
+
+    if step.isdigit():
+        headers = {}
+        if int(step) in (429, 503):
+            headers["Retry-After"] = f"{_scenario['retry_after_seconds']:g}"
+        return JSONResponse(status_code=int(step), headers=headers,
+                            content={"error": {"message": f"fake provider error {step}", "type": "fake_error"}})
+
+    model = body.get("model", "fake")
+    if body.get("stream"):
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+        return StreamingResponse(stream_answer(model, step, include_usage), media_type="text/event-stream")
+
+    if step == 'slow':
+        await asyncio.sleep(FAKE_PROVIDER_SLOW_SECONDS)
+    return {"id": "fake", "object": "chat.completion", "created": int(time.time()), "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(ANSWER_TOKENS)},
+                         "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": len(ANSWER_TOKENS),
+                      "total_tokens": 100 + len(ANSWER_TOKENS)}}
+
+
+@app.post("/fake/scenario")
+async def set_scenario(scenario: Scenario):
+    """Replaces the scenario and restarts it from its first step."""
+    _scenario.update(steps=scenario.steps.split(','), retry_after_seconds=scenario.retry_after_seconds, requests=0)
+    return {"steps": _scenario["steps"]}
+
+
+@app.get("/fake/scenario")
+async def get_scenario():
+    return _scenario
+
+
+if __name__ == "__main__":
+    uvicorn.run(app, host="127.0.0.1", port=FAKE_PROVIDER_PORT)
@@ -0,0 +1,212 @@
+import os
+import time
+import asyncio
+from collections import deque
+from contextlib import AsyncExitStack, suppress
+from typing import Callable
+from fastapi import HTTPException
+from langchain_core.messages import AIMessage, AIMessageChunk, AnyMessage
+from langchain_core.runnables import Runnable
+
+from .ai_models import get_llm
+from .llm_scheduler import llm_slot
+from .resilience import (CircuitBreaker, ProviderUnavailableError, RelayChatModel, circuit_breaker, is_retryable,
+                         model_name, open_stream, relay_with_breaker, resilient_ainvoke, retry_after_seconds)
+from .llm_utils import parse_setting_list, percentile, provider_model
+
+
+# backup providers of the think node as `provider:model` pairs, e.g. `aliyun_eas:deepseek-r1-distill-qwen-32b`.
+# Backups must stream the answer in the message content, like fireworks does with its <think> tags.
+# Empty disables hedging.
+THINK_HEDGE_BACKUPS = os.getenv("THINK_HEDGE_BACKUPS", "")
+# the backup starts when the primary has sent no token after this percentile of its recent first token latencies
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 0.9))
+# used until enough first token latencies are recorded, and as the bounds of the percentile deadline
+HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv("HEDGE_DEFAULT_DELAY_SECONDS", 8))
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv("HEDGE_MIN_DELAY_SECONDS", 1))
+HEDGE_MAX_DELAY_SECONDS = float(os.getenv("HEDGE_MAX_DELAY_SECONDS", 30))
+HEDGE_MIN_SAMPLES = 20
+HEDGE_LATENCY_WINDOW = 500
+
+
+class ProviderLatency:
+    """First token latencies and race results of one provider."""
+
+    def __init__(self):
+        self.first_token_seconds: deque[float] = deque(maxlen=HEDGE_LATENCY_WINDOW)
+        self.requests = 0
+        self.wins = 0
+        self.losses = 0
+        self.errors = 0
+        # requests of this provider as the primary that started a backup
+        self.hedged = 0
+
+    def hedge_delay(self) -> float:
+        if len(self.first_token_seconds) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY_SECONDS
+        delay = percentile(list(self.first_token_seconds), HEDGE_PERCENTILE)
+        return min(max(delay, HEDGE_MIN_DELAY_SECONDS), HEDGE_MAX_DELAY_SECONDS)
+
+    def stats(self) -> dict:
+        samples = list(self.first_token_seconds)
+        races = self.wins + self.losses
+        return {
+            "requests": self.requests,
+            "wins": self.wins,
+            "losses": self.losses,
+            "errors": self.errors,
+            "hedged": self.hedged,
+            "win_rate": self.wins / races if races else 0.0,
+            "first_token_p50": percentile(samples, 0.5) if samples else None,
+            "first_token_p95": percentile(samples, 0.95) if samples else None,
+            "first_token_p99": percentile(samples, 0.99) if samples else None,
+            "hedge_delay": self.hedge_delay(),
+        }
+
+
+_latencies: dict[str, ProviderLatency] = {}
+
+
+def provider_latency(provider: str) -> ProviderLatency:
+    return _latencies.setdefault(provider, ProviderLatency())
+
+
+def get_hedge_stats() -> dict:
+    return {provider: latency.stats() for provider, latency in _latencies.items()}
+
+
+def _task_error(task: asyncio.Task) -> BaseException | None:
+    """The error of a finished task, a task cancelled from outside counts as failed with a CancelledError."""
+    if task.cancelled():
+        return asyncio.CancelledError()
+    return task.exception()
+
+
+class _Candidate:
+    def __init__(self, provider: str, llm: Runnable, breaker: CircuitBreaker, input_messages: list[AnyMessage],
+                 user_id: str, cost: int, writer: Callable[[dict], None] | None = None):
+        self.provider = provider
+        self.breaker = breaker
+        self.started_at = time.perf_counter()
+        self.stream = None
+        # the provider's request slot, held until the candidate is cancelled or its answer is relayed
+        self._slot = AsyncExitStack()
+        self.task = asyncio.create_task(self._start(llm, input_messages, user_id, cost, writer))
+        provider_latency(provider).requests += 1
+
+    async def _start(self, llm: Runnable, input_messages: list[AnyMessage], user_id: str, cost: int,
+                     writer: Callable[[dict], None] | None) -> list[AIMessageChunk]:
+        # waits in the provider's queue like any other request of the user, the wait counts towards the hedge delay
+        await self._slot.enter_async_context(llm_slot(self.provider, user_id, cost=cost, writer=writer))
+        try:
+            self.started_at = time.perf_counter()
+            # retried and recorded in the provider's circuit breaker like a call of resilient_ainvoke
+            received, self.stream = await open_stream(llm, input_messages, self.breaker)
+            return received
+        except BaseException:
+            await self.release()
+            raise
+
+    async def release(self):
+        await self._slot.aclose()
+
+    async def cancel(self):
+        self.task.cancel()
+        with suppress(BaseException):
+            await self.task
+        if self.stream is not None:
+            with suppress(BaseException):
+                await self.stream.aclose()
+        await self.release()
+
+
+def _start_candidate(provider: str, llm: Runnable, input_messages: list[AnyMessage], user_id: str, cost: int,
+                     tried: list[str], writer: Callable[[dict], None] | None = None) -> _Candidate | None:
+    """Starts a candidate, None when the circuit breaker of its provider/model is open."""
+    breaker = circuit_breaker(provider, model_name(llm))
+    tried.append(breaker.name)
+    if not breaker.allow():
+        return None
+    return _Candidate(provider, llm, breaker, input_messages, user_id, cost, writer)
+
+
+async def hedged_ainvoke(primary_provider: str, primary: Runnable, backups: list[tuple[str, Runnable]],
+                         input_messages: list[AnyMessage], user_id: str, cost: int = 1,
+                         writer: Callable[[dict], None] | None = None) -> AIMessage:
+    """
+    `primary.ainvoke(input_messages)`, hedged: when the primary has not sent its first token within its
+    percentile deadline, the request is also sent to the first backup. The first candidate to send a token wins,
+    the other is cancelled, and the winner's answer is streamed to the graph as if it came from one model.
+    Each candidate holds a slot of its provider's `llm_slot` for `user_id` and `cost`, only the primary's queue
+    status is sent to `writer`. Candidates go through the circuit breakers and retries of `resilient_ainvoke`:
+    a provider whose breaker is open is skipped, and ProviderUnavailableError is raised when no candidate answered.
+    Without backups the call goes through `resilient_ainvoke` instead.
+    """
+    if not backups:
+        async with llm_slot(primary_provider, user_id, cost=cost, writer=writer):
+            return await resilient_ainvoke(primary, input_messages)
+
+    primary_stats = provider_latency(primary_provider)
+    candidates = []
+    tried = []
+    winner = None
+    try:
+        primary_candidate = _start_candidate(primary_provider, primary, input_messages, user_id, cost, tried, writer)
+        if primary_candidate is not None:
+            candidates.append(primary_candidate)
+            done, _ = await asyncio.wait([primary_candidate.task], timeout=primary_stats.hedge_delay())
+        # a primary that already failed, or whose breaker is open, is replaced right away
+        if primary_candidate is None or not done or _task_error(primary_candidate.task) is not None:
+            primary_stats.hedged += 1
+            for backup_provider, backup in backups:
+                backup_candidate = _start_candidate(backup_provider, backup, input_messages, user_id, cost, tried)
+                if backup_candidate is not None:
+                    candidates.append(backup_candidate)
+                    break
+
+        pending = {candidate.task for candidate in candidates}
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for candidate in candidates:
+                if candidate.task in done:
+                    error = _task_error(candidate.task)
+                    if error is not None:
+                        provider_latency(candidate.provider).errors += 1
+                        print(f"    Hedged request to {candidate.provider} failed: {error!r}")
+                    elif winner is None:
+                        winner = candidate
+
+        if winner is None:
+            errors = [_task_error(candidate.task) for candidate in candidates]
+            # a bad request or a full queue is raised as it is, provider failures as ProviderUnavailableError
+            for error in errors:
+                if isinstance(error, HTTPException) or not is_retryable(error):
+                    raise error
+            last_error = errors[-1] if errors else None
+            retry_after = retry_after_seconds(last_error) if last_error is not None else None
+            raise ProviderUnavailableError(tried, retry_after) from last_error
+
+        winner_stats = provider_latency(winner.provider)
+        winner_stats.first_token_seconds.append(time.perf_counter() - winner.started_at)
+        if len(candidates) > 1:
+            winner_stats.wins += 1
+            for candidate in candidates:
+                failed = candidate.task.done() and _task_error(candidate.task) is not None
+                if candidate is not winner and not failed:
+                    provider_latency(candidate.provider).losses += 1
+            print(f"    Hedged request won by {winner.provider}")
+    finally:
+        for candidate in candidates:
+            if candidate is not winner:
+                await candidate.cancel()
+
+    try:
+        chunks = relay_with_breaker(winner.task.result(), winner.stream, winner.breaker)
+        return await RelayChatModel(chunks=chunks).ainvoke(input=input_messages)
+    finally:
+        await winner.release()
+
+
+def think_backups(temperature: float) -> list[tuple[str, Runnable]]:
+    return [(provider, get_llm(llm=provider, model=model, temperature=temperature))
+            for provider, model in parse_setting_list(THINK_HEDGE_BACKUPS, "THINK_HEDGE_BACKUPS", provider_model)]
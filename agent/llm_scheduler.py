@@ -0,0 +1,241 @@
+import os
+import time
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable
+from fastapi import HTTPException, status
+
+from .llm_utils import parse_setting_pairs, percentile
+
+
+# concurrent llm requests allowed per provider as `provider=limit` pairs, e.g. `fireworks=8,qwen=32`,
+# other providers get LLM_DEFAULT_MAX_CONCURRENCY, 0 means unlimited
+LLM_DEFAULT_MAX_CONCURRENCY = int(os.getenv("LLM_DEFAULT_MAX_CONCURRENCY", 16))
+# requests over the limit wait in per-user queues served by deficit round robin: each turn a user earns
+# this many tokens of credit, and a request is admitted once its user has credit for its estimated prompt
+LLM_QUEUE_QUANTUM_TOKENS = int(os.getenv("LLM_QUEUE_QUANTUM_TOKENS", 4000))
+# backpressure: a provider with this many waiting requests rejects new ones, and a request is rejected
+# when it has waited this long
+LLM_MAX_QUEUED_REQUESTS = int(os.getenv("LLM_MAX_QUEUED_REQUESTS", 256))
+LLM_MAX_QUEUE_WAIT_SECONDS = float(os.getenv("LLM_MAX_QUEUE_WAIT_SECONDS", 60))
+# a waiting request reports its queue status to the client this often
+LLM_QUEUE_STATUS_INTERVAL_SECONDS = float(os.getenv("LLM_QUEUE_STATUS_INTERVAL_SECONDS", 2))
+LLM_QUEUE_WAIT_WINDOW = 1000
+
+
+LLM_MAX_CONCURRENCY = parse_setting_pairs(os.getenv("LLM_MAX_CONCURRENCY", ""), "LLM_MAX_CONCURRENCY", int)
+
+
+class LLMQueueFullError(HTTPException):
+    """Raised when a provider's queue is full or a request waited too long, the client should retry later."""
+
+    def __init__(self, provider: str, reason: str):
+        self.provider = provider
+        super().__init__(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                         detail={"message": f"Too many requests to {provider}, try again later",
+                                 "reason": reason},
+                         headers={"Retry-After": str(int(LLM_QUEUE_STATUS_INTERVAL_SECONDS) or 1)})
+
+
+class _Waiter:
+    def __init__(self, user_id: str, cost: int):
+        self.user_id = user_id
+        self.cost = cost
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.perf_counter()
+
+
+class ProviderScheduler:
+    """
+    Admission control of one provider: at most `max_concurrency` requests run at once, the others wait in
+    one queue per user. A free slot goes to the users in deficit round robin order, weighted by the estimated
+    prompt tokens of their requests, so a user sending many or long requests can not starve the others.
+    """
+
+    def __init__(self, provider: str, max_concurrency: int):
+        self.provider = provider
+        self.max_concurrency = max_concurrency
+        self.running = 0
+        self.queued = 0
+        self._queues: dict[str, deque[_Waiter]] = {}
+        self._deficits: dict[str, int] = {}
+        # users with waiting requests, in round robin order
+        self._active_users: deque[str] = deque()
+
+        self.admitted = 0
+        self.admitted_after_wait = 0
+        self.rejected_queue_full = 0
+        self.rejected_wait_timeout = 0
+        self.cancelled_while_queued = 0
+        self.max_running = 0
+        self.max_queued = 0
+        self.wait_seconds: deque[float] = deque(maxlen=LLM_QUEUE_WAIT_WINDOW)
+
+    def _has_capacity(self) -> bool:
+        return self.max_concurrency <= 0 or self.running < self.max_concurrency
+
+    def _admit(self):
+        self.running += 1
+        self.admitted += 1
+        self.max_running = max(self.max_running, self.running)
+
+    def _remove_user(self, user_id: str):
+        self._active_users.remove(user_id)
+        del self._queues[user_id]
+        del self._deficits[user_id]
+
+    def _dispatch(self):
+        """Hands the free slots to the waiting requests, in deficit round robin order."""
+        while self._active_users and self._has_capacity():
+            user_id = self._active_users[0]
+            queue = self._queues[user_id]
+            waiter = queue[0]
+            if waiter.future.done():
+                # cancelled, or rejected after waiting too long
+                queue.popleft()
+                self.queued -= 1
+                if not queue:
+                    self._remove_user(user_id)
+                continue
+
+            if self._deficits[user_id] < waiter.cost:
+                # not enough credit, earn a quantum and let the next user go first
+                self._deficits[user_id] += LLM_QUEUE_QUANTUM_TOKENS
+                self._active_users.rotate(-1)
+                continue
+
+            self._deficits[user_id] -= waiter.cost
+            queue.popleft()
+            self.queued -= 1
+            if not queue:
+                # an idle user keeps no credit
+                self._remove_user(user_id)
+            self._admit()
+            waiter.future.set_result(None)
+
+    def _enqueue(self, waiter: _Waiter):
+        queue = self._queues.get(waiter.user_id)
+        if queue is None:
+            queue = self._queues[waiter.user_id] = deque()
+            self._deficits[waiter.user_id] = 0
+            self._active_users.append(waiter.user_id)
+        queue.append(waiter)
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+
+    def _discard(self, waiter: _Waiter):
+        """Removes a request that stopped waiting, so it no longer counts as queued."""
+        queue = self._queues.get(waiter.user_id)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        self.queued -= 1
+        if not queue:
+            self._remove_user(waiter.user_id)
+
+    def release(self):
+        self.running -= 1
+        self._dispatch()
+
+    def queue_status(self, waiter: _Waiter, status_name: str) -> dict:
+        return {"llm_queue": {"status": status_name,
+                              "provider": self.provider,
+                              "waited_ms": round((time.perf_counter() - waiter.enqueued_at) * 1000),
+                              "queued_requests": self.queued,
+                              "running_requests": self.running}}
+
+    async def acquire(self, user_id: str, cost: int, writer: Callable[[dict], None] | None = None):
+        if self._has_capacity() and not self.queued:
+            self._admit()
+            self.wait_seconds.append(0.0)
+            return
+
+        if self.queued >= LLM_MAX_QUEUED_REQUESTS:
+            self.rejected_queue_full += 1
+            raise LLMQueueFullError(self.provider, "queue_full")
+
+        waiter = _Waiter(user_id, max(cost, 1))
+        self._enqueue(waiter)
+        # admits it right away if a slot is free
+        self._dispatch()
+
+        deadline = waiter.enqueued_at + LLM_MAX_QUEUE_WAIT_SECONDS
+        try:
+            while not waiter.future.done():
+                if writer:
+                    writer(self.queue_status(waiter, "queued"))
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    waiter.future.cancel()
+                    self._discard(waiter)
+                    self.rejected_wait_timeout += 1
+                    raise LLMQueueFullError(self.provider, "wait_timeout")
+                await asyncio.wait([waiter.future], timeout=min(LLM_QUEUE_STATUS_INTERVAL_SECONDS, remaining))
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # admitted just before the cancellation, give the slot back
+                self.release()
+            else:
+                waiter.future.cancel()
+                self._discard(waiter)
+                self.cancelled_while_queued += 1
+            raise
+
+        waited = time.perf_counter() - waiter.enqueued_at
+        self.wait_seconds.append(waited)
+        self.admitted_after_wait += 1
+        if writer:
+            writer(self.queue_status(waiter, "admitted"))
+
+    def stats(self) -> dict:
+        samples = list(self.wait_seconds)
+        return {
+            "max_concurrency": self.max_concurrency,
+            "running": self.running,
+            "queued": self.queued,
+            "waiting_users": len(self._active_users),
+            "max_running": self.max_running,
+            "max_queued": self.max_queued,
+            "admitted": self.admitted,
+            "admitted_after_wait": self.admitted_after_wait,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_wait_timeout": self.rejected_wait_timeout,
+            "cancelled_while_queued": self.cancelled_while_queued,
+            "wait_p50": percentile(samples, 0.5) if samples else None,
+            "wait_p95": percentile(samples, 0.95) if samples else None,
+            "wait_p99": percentile(samples, 0.99) if samples else None,
+            "wait_max": max(samples) if samples else None,
+        }
+
+
+_schedulers: dict[str, ProviderScheduler] = {}
+
+
+def provider_scheduler(provider: str) -> ProviderScheduler:
+    scheduler = _schedulers.get(provider)
+    if scheduler is None:
+        scheduler = _schedulers[provider] = ProviderScheduler(
+            provider, LLM_MAX_CONCURRENCY.get(provider, LLM_DEFAULT_MAX_CONCURRENCY))
+    return scheduler
+
+
+@asynccontextmanager
+async def llm_slot(provider: str, user_id: str, cost: int = 1,
+                   writer: Callable[[dict], None] | None = None) -> AsyncIterator[None]:
+    """
+    Holds one of `provider`'s request slots for the body of the `async with`, waiting in `user_id`'s queue
+    when the provider is at its limit. `cost` is the estimated prompt tokens of the request.
+    While waiting, `writer` (the node's langgraph StreamWriter) receives `{"llm_queue": {...}}` status updates.
+    Raises LLMQueueFullError when the provider's queue is full or the request waited too long.
+    """
+    scheduler = provider_scheduler(provider)
+    await scheduler.acquire(user_id, cost, writer)
+    try:
+        yield
+    finally:
+        scheduler.release()
+
+
+def get_llm_scheduler_stats() -> dict:
+    return {provider: scheduler.stats() for provider, scheduler in _schedulers.items()}
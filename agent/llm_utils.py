@@ -0,0 +1,73 @@
+from typing import AsyncIterator, Callable, TypeVar
+from langchain_core.messages import AIMessageChunk
+
+
+T = TypeVar('T')
+
+
+def parse_setting_pairs(value: str, setting: str, parse_value: Callable[[str], T]) -> dict[str, T]:
+    """Parses `key=value` pairs separated by commas, e.g. `fireworks=8,qwen=32`. Invalid entries are skipped."""
+    pairs = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        key, separator, item_value = item.partition('=')
+        try:
+            if not separator:
+                raise ValueError(item)
+            pairs[key.strip()] = parse_value(item_value.strip())
+        except ValueError:
+            print(f"    Ignoring invalid {setting} entry: {item}")
+    return pairs
+
+
+def parse_setting_list(value: str, setting: str, parse_item: Callable[[str], T]) -> list[T]:
+    """Parses items separated by commas. Invalid items are skipped."""
+    items = []
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        try:
+            items.append(parse_item(item.strip()))
+        except ValueError:
+            print(f"    Ignoring invalid {setting} entry: {item}")
+    return items
+
+
+def provider_model(value: str) -> tuple[str, str]:
+    """Parses a `provider:model` pair, e.g. `deepseek:deepseek-chat`."""
+    provider, separator, model = value.partition(':')
+    if not separator:
+        raise ValueError(value)
+    return provider.strip(), model.strip()
+
+
+def percentile(samples: list[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+async def first_chunks(stream: AsyncIterator[AIMessageChunk]) -> list[AIMessageChunk]:
+    """Reads the stream up to the first chunk with content, and returns the chunks read."""
+    received = []
+    async for chunk in stream:
+        received.append(chunk)
+        if chunk.content or chunk.tool_call_chunks:
+            break
+    return received
+
+
+async def relay_chunks(received: list[AIMessageChunk], stream,
+                       on_error: Callable[[Exception], None] | None = None) -> AsyncIterator[AIMessageChunk]:
+    """The chunks read by `first_chunks`, then the rest of the stream, which is closed at the end."""
+    try:
+        for chunk in received:
+            yield chunk
+        async for chunk in stream:
+            yield chunk
+    except Exception as e:
+        if on_error is not None:
+            on_error(e)
+        raise
+    finally:
+        await stream.aclose()
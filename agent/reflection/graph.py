@@ -5,10 +5,54 @@ from langchain_core.runnables import RunnableConfig
 from langgraph.store.base import BaseStore
 from .state import ReflectionGraphState
 from .prompts import REFLECT_SYSTEM_PROMPT, REFLECT_USER_PROMPT
-from ..agent_utils import format_reflections
+from ..agent_utils import format_reflections, record_llm_usage
 from ..agent_classes import Reflections
 from ..ai_models import get_llm
+from ..response_cache import cached_ainvoke
+from ..llm_scheduler import llm_slot
+from ..editor.context_packer import estimate_tokens
 from database.db import db
+from database.assistant_utils import bump_assistant_list_version, invalidate_assistant_data
+from database.db_classes import AssistantData
+
+
+# a reflection is only written over the version of the assistant it was generated from,
+# after a concurrent edit it is merged into the new version, at most this many times
+REFLECTION_SAVE_ATTEMPTS = 3
+
+
+def merge_reflections(base: Reflections, generated: Reflections, current: Reflections) -> Reflections:
+    """Applies the items the llm added to and removed from `base` to `current`, so concurrent edits are kept."""
+    merged = {}
+    for field in Reflections.model_fields:
+        base_items, generated_items, current_items = (getattr(base, field), getattr(generated, field),
+                                                      getattr(current, field))
+        removed = set(base_items) - set(generated_items)
+        added = [item for item in generated_items if item not in base_items and item not in current_items]
+        merged[field] = [item for item in current_items if item not in removed] + added
+    return Reflections(**merged)
+
+
+async def save_reflections(assistant_data: AssistantData, generated: Reflections) -> bool:
+    reflections, version = generated, assistant_data.version
+    query = {"assistant_id": assistant_data.assistant_id, "user_id": assistant_data.user_id}
+    for _ in range(REFLECTION_SAVE_ATTEMPTS):
+        # assistants created before versioning have no version field
+        version_filter = {"$in": [0, None]} if version == 0 else version
+        result = await db.assistant_data.update_one({**query, "version": version_filter},
+                                                    {"$set": {"reflections": reflections.model_dump()},
+                                                     "$inc": {"version": 1}})
+        if result.matched_count:
+            return True
+
+        document = await db.assistant_data.find_one(query, {"_id": 0, "reflections": 1, "version": 1})
+        if not document:
+            return False
+        reflections = merge_reflections(assistant_data.reflections, generated, Reflections(**document["reflections"]))
+        version = document.get("version") or 0
+
+    print(f"    Reflections of assistant {assistant_data.assistant_id} not saved, it kept changing")
+    return False
 
 
 async def reflect(state: ReflectionGraphState):
@@ -50,7 +94,10 @@ async def reflect(state: ReflectionGraphState):
         HumanMessage(formatted_user_prompt),
     ]
 
-    response = await llm_tools.ainvoke(input=input_messages)
+    response = await cached_ainvoke(llm_tools, input_messages,
+                                    admission=llm_slot("qwen", assistant_data.user_id,
+                                                       cost=estimate_tokens(formatted_system_prompt + formatted_user_prompt)))
+    record_llm_usage(assistant_data.user_id, response)
     if not response.tool_calls:
         raise AttributeError('No tool_calls found in LLM response')
 
@@ -58,7 +105,9 @@ async def reflect(state: ReflectionGraphState):
     new_reflections = generate_reflections(style_guidelines=response.tool_calls[0]['args']['style_guidelines'],
                                         general_facts=response.tool_calls[0]['args']['general_facts'])
     
-    await db.assistant_data.update_one({"assistant_id": assistant_data.assistant_id}, {"$set": {"reflections": new_reflections.model_dump()}})
+    if await save_reflections(assistant_data, new_reflections):
+        invalidate_assistant_data(assistant_data.user_id, assistant_data.assistant_id)
+        await bump_assistant_list_version(assistant_data.user_id)
 
     # this node will not update anything to the state
     return {"messages": []}
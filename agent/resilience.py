@@ -0,0 +1,332 @@
+import os
+import time
+import random
+import asyncio
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Iterator
+import httpx
+import openai
+from fastapi import HTTPException, status
+from pydantic import ConfigDict, Field
+from langchain_core.language_models import BaseChatModel
+from langchain_core.language_models.chat_models import agenerate_from_stream, generate_from_stream
+from langchain_core.messages import AIMessage, AIMessageChunk, AnyMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable
+
+from .ai_models import get_llm, llm_provider_of, unwrap_chat_model
+from .llm_utils import first_chunks, parse_setting_pairs, provider_model, relay_chunks
+
+
+# retries of a provider call that failed with a 429, a 5xx or a connection error before its first token,
+# waiting a jittered exponential backoff, or the Retry-After the provider asked for
+LLM_RETRY_MAX_ATTEMPTS = int(os.getenv("LLM_RETRY_MAX_ATTEMPTS", 3))
+LLM_RETRY_BASE_DELAY_SECONDS = float(os.getenv("LLM_RETRY_BASE_DELAY_SECONDS", 0.5))
+# a longer backoff or Retry-After is not waited for, the call fails over instead
+LLM_RETRY_MAX_DELAY_SECONDS = float(os.getenv("LLM_RETRY_MAX_DELAY_SECONDS", 20))
+# a provider/model failing this many calls in a row is skipped for LLM_BREAKER_OPEN_SECONDS,
+# then a single probe call decides whether it is used again
+LLM_BREAKER_FAILURE_THRESHOLD = int(os.getenv("LLM_BREAKER_FAILURE_THRESHOLD", 5))
+LLM_BREAKER_OPEN_SECONDS = float(os.getenv("LLM_BREAKER_OPEN_SECONDS", 30))
+# the alternate of each provider as `provider=alternate_provider:model` pairs,
+# e.g. `qwen=deepseek:deepseek-chat`, used when the provider keeps failing or its breaker is open
+LLM_FAILOVER = os.getenv("LLM_FAILOVER", "")
+
+RETRYABLE_STATUS_CODES = {408, 409, 429}
+
+
+FAILOVER = parse_setting_pairs(LLM_FAILOVER, "LLM_FAILOVER", provider_model)
+
+
+class ProviderUnavailableError(HTTPException):
+    """Raised when a provider call failed after its retries and no alternate could answer either."""
+
+    def __init__(self, providers: list[str], retry_after: float | None = None):
+        self.providers = providers
+        super().__init__(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                         detail={"message": "The language model is unavailable, try again later",
+                                 "providers": providers},
+                         headers={"Retry-After": str(max(1, round(retry_after or LLM_BREAKER_OPEN_SECONDS)))})
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Rate limits, server errors, timeouts and connection errors are worth another try, bad requests are not."""
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+        return True
+    status_code = getattr(error, 'status_code', None)
+    return isinstance(status_code, int) and (status_code in RETRYABLE_STATUS_CODES or status_code >= 500)
+
+
+def retry_after_seconds(error: BaseException) -> float | None:
+    """The wait the provider asked for in its `retry-after-ms` or `retry-after` header, None without one."""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        value = headers.get('retry-after')
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            # an HTTP date
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (ValueError, TypeError):
+        return None
+
+
+def retry_delay(error: BaseException, attempt: int) -> float | None:
+    """Seconds to wait before retry `attempt` (0 based), None when the wait is too long to be worth it."""
+    retry_after = retry_after_seconds(error)
+    if retry_after is not None:
+        if retry_after > LLM_RETRY_MAX_DELAY_SECONDS:
+            return None
+        # a little jitter, so the calls told to wait the same time do not all come back at once
+        return retry_after + random.uniform(0, LLM_RETRY_BASE_DELAY_SECONDS)
+    # full jitter
+    return random.uniform(0, min(LLM_RETRY_MAX_DELAY_SECONDS, LLM_RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+
+
+def describe_error(error: BaseException) -> str:
+    status_code = getattr(error, 'status_code', None)
+    return f"{status_code} {type(error).__name__}" if status_code else type(error).__name__
+
+
+class CircuitBreaker:
+    """
+    Closed: calls go through. Open, after LLM_BREAKER_FAILURE_THRESHOLD failures in a row: calls are skipped.
+    Half open, LLM_BREAKER_OPEN_SECONDS later: one probe call goes through, and closes or opens it again.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at = None
+
+        self.successes = 0
+        self.failures = 0
+        self.retries = 0
+        self.times_opened = 0
+        self.short_circuited = 0
+
+    def allow(self) -> bool:
+        now = time.monotonic()
+        if self.state == 'closed':
+            return True
+        if self.state == 'open' and now - self.opened_at >= LLM_BREAKER_OPEN_SECONDS:
+            self.state = 'half_open'
+            self.probe_started_at = None
+        # a probe that never reported back (e.g. cancelled) is replaced after the same time
+        if self.state == 'half_open' and (self.probe_started_at is None
+                                          or now - self.probe_started_at >= LLM_BREAKER_OPEN_SECONDS):
+            self.probe_started_at = now
+            return True
+        self.short_circuited += 1
+        return False
+
+    def record_success(self):
+        self.successes += 1
+        self.consecutive_failures = 0
+        if self.state != 'closed':
+            print(f"    Circuit breaker of {self.name} closed")
+        self.state = 'closed'
+        self.probe_started_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.state == 'half_open' or (self.state == 'closed'
+                                         and self.consecutive_failures >= LLM_BREAKER_FAILURE_THRESHOLD):
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self.probe_started_at = None
+            self.times_opened += 1
+            print(f"    Circuit breaker of {self.name} opened after {self.consecutive_failures} failures")
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "successes": self.successes,
+            "failures": self.failures,
+            "retries": self.retries,
+            "times_opened": self.times_opened,
+            "short_circuited": self.short_circuited,
+        }
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_failovers = {"attempted": 0, "succeeded": 0, "unavailable": 0}
+
+
+def model_name(llm: Runnable) -> str:
+    chat_model, _ = unwrap_chat_model(llm)
+    return getattr(chat_model, 'model_name', None) or getattr(chat_model, 'model', None) or chat_model._llm_type
+
+
+def circuit_breaker(provider: str, model: str) -> CircuitBreaker:
+    name = f"{provider}/{model}"
+    breaker = _breakers.get(name)
+    if breaker is None:
+        breaker = _breakers[name] = CircuitBreaker(name)
+    return breaker
+
+
+def get_resilience_stats() -> dict:
+    return {"breakers": {name: breaker.stats() for name, breaker in _breakers.items()},
+            "failovers": dict(_failovers)}
+
+
+class RelayChatModel(BaseChatModel):
+    """
+    Streams chunks that were already received from another model through the normal chat model callbacks,
+    so the graph stream only sees the call that is actually used.
+    The chunks are read on the event loop the relay was created on, the sync methods read them through
+    that loop from another thread.
+    """
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+    chunks: Any
+    loop: Any = Field(default_factory=asyncio.get_running_loop)
+
+    @property
+    def _llm_type(self) -> str:
+        return "relay"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        return await agenerate_from_stream(self._astream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+    async def _next_chunk(self) -> AIMessageChunk | None:
+        return await anext(self.chunks, None)
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is self.loop:
+            # waiting here would block the loop the chunks are read on
+            raise RuntimeError("RelayChatModel can not be called synchronously on the event loop it relays, "
+                               "use ainvoke or astream")
+
+        while (chunk := asyncio.run_coroutine_threadsafe(self._next_chunk(), self.loop).result()) is not None:
+            generation_chunk = ChatGenerationChunk(message=chunk)
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.content, chunk=generation_chunk)
+            yield generation_chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        async for chunk in self.chunks:
+            generation_chunk = ChatGenerationChunk(message=chunk)
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.content, chunk=generation_chunk)
+            yield generation_chunk
+
+
+async def open_stream(llm: Runnable, input_messages: list[AnyMessage],
+                      breaker: CircuitBreaker) -> tuple[list[AIMessageChunk], AsyncIterator[AIMessageChunk]]:
+    """
+    Starts streaming `llm`'s answer, retrying failures before the first token with backoff and recording
+    each attempt in `breaker`. Returns the chunks read up to the first token and the rest of the stream,
+    to be relayed with `relay_with_breaker`.
+    """
+    attempt = 0
+    while True:
+        # no callbacks, the chunks only reach the graph once the call has succeeded
+        stream = llm.astream(input_messages, config={"callbacks": []})
+        try:
+            received = await first_chunks(stream)
+        except asyncio.CancelledError:
+            await stream.aclose()
+            raise
+        except Exception as e:
+            await stream.aclose()
+            if not is_retryable(e):
+                # the provider answered, the request itself is wrong
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            attempt += 1
+            delay = retry_delay(e, attempt - 1)
+            if attempt >= LLM_RETRY_MAX_ATTEMPTS or delay is None or breaker.state == 'open':
+                raise
+            breaker.retries += 1
+            print(f"    {breaker.name} failed with {describe_error(e)}, retry {attempt} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            continue
+
+        breaker.record_success()
+        return received, stream
+
+
+def relay_with_breaker(received: list[AIMessageChunk], stream: AsyncIterator[AIMessageChunk],
+                       breaker: CircuitBreaker) -> AsyncIterator[AIMessageChunk]:
+    """The answer opened by `open_stream`, a failure after the first token is recorded in `breaker`."""
+
+    def record_failure(error: Exception):
+        # the answer is already partly streamed to the client, so it is not retried
+        if is_retryable(error):
+            breaker.record_failure()
+
+    return relay_chunks(received, stream, on_error=record_failure)
+
+
+def failover_llm(provider: str, llm: Runnable) -> tuple[str, Runnable] | None:
+    """The configured alternate of `provider`, with the same temperature and bound arguments (e.g. tools)."""
+    if provider not in FAILOVER:
+        return None
+    alternate_provider, alternate_model = FAILOVER[provider]
+    chat_model, kwargs = unwrap_chat_model(llm)
+    alternate = get_llm(llm=alternate_provider, model=alternate_model,
+                        temperature=getattr(chat_model, 'temperature', None) or 0)
+    return alternate_provider, alternate.bind(**kwargs) if kwargs else alternate
+
+
+async def resilient_ainvoke(llm: Runnable, input_messages: list[AnyMessage]) -> AIMessage:
+    """
+    `llm.ainvoke(input_messages)`, resilient to provider failures: 429s, 5xx and connection errors before the
+    first token are retried with backoff, a provider/model that keeps failing is skipped by its circuit breaker,
+    and the call fails over to the provider's alternate in LLM_FAILOVER. Raises ProviderUnavailableError when
+    nothing could answer. Failures after the first token are raised as they are, the answer is partly sent.
+    """
+    chat_model, _ = unwrap_chat_model(llm)
+    provider = llm_provider_of(chat_model) or chat_model._llm_type
+    candidates = [(provider, llm)]
+    alternate = failover_llm(provider, llm)
+    if alternate is not None:
+        candidates.append(alternate)
+
+    tried = []
+    last_error = None
+    for index, (candidate_provider, candidate) in enumerate(candidates):
+        breaker = circuit_breaker(candidate_provider, model_name(candidate))
+        if index > 0:
+            _failovers["attempted"] += 1
+            print(f"    Failing over from {tried[-1]} to {breaker.name}")
+        tried.append(breaker.name)
+        if not breaker.allow():
+            continue
+        try:
+            received, stream = await open_stream(candidate, input_messages, breaker)
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            last_error = e
+            continue
+        if index > 0:
+            _failovers["succeeded"] += 1
+        chunks = relay_with_breaker(received, stream, breaker)
+        return await RelayChatModel(chunks=chunks).ainvoke(input=input_messages)
+
+    _failovers["unavailable"] += 1
+    retry_after = retry_after_seconds(last_error) if last_error is not None else None
+    raise ProviderUnavailableError(tried, retry_after) from last_error
@@ -0,0 +1,153 @@
+import os
+import json
+import hashlib
+from contextlib import AbstractAsyncContextManager, nullcontext
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Iterator
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, AnyMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable
+
+from .ai_models import unwrap_chat_model
+from .resilience import resilient_ainvoke
+from database.db import db
+from database.cache import TTLCache
+
+
+# answers of temperature 0 llm calls, keyed by the model, its parameters and tools, and the exact input messages
+LLM_RESPONSE_CACHE_SIZE = int(os.getenv("LLM_RESPONSE_CACHE_SIZE", 512))
+LLM_RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("LLM_RESPONSE_CACHE_TTL_SECONDS", 3600))
+# also keep the answers in the llm_response_cache collection, shared by all workers and expired by a TTL index
+LLM_RESPONSE_CACHE_MONGO = os.getenv("LLM_RESPONSE_CACHE_MONGO", "false") == "true"
+# a cached answer is streamed again in chunks of this many characters
+LLM_RESPONSE_REPLAY_CHUNK_CHARS = int(os.getenv("LLM_RESPONSE_REPLAY_CHUNK_CHARS", 16))
+
+# bump to invalidate every cached answer, e.g. when the cached format changes
+RESPONSE_CACHE_VERSION = 1
+
+response_cache = TTLCache(maxsize=LLM_RESPONSE_CACHE_SIZE, ttl=LLM_RESPONSE_CACHE_TTL_SECONDS)
+
+
+def response_cache_key(llm: Runnable, messages: list[AnyMessage]) -> str:
+    chat_model, kwargs = unwrap_chat_model(llm)
+    # the same string langchain's own llm cache uses: the model class, its parameters and the bound arguments
+    llm_string = chat_model._get_llm_string(**kwargs)
+    serialized_messages = [{"type": message.type,
+                            "content": message.content,
+                            "tool_calls": getattr(message, "tool_calls", None) or []}
+                           for message in messages]
+    payload = json.dumps([RESPONSE_CACHE_VERSION, llm_string, serialized_messages],
+                         ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def is_cacheable(llm: Runnable) -> bool:
+    chat_model, _ = unwrap_chat_model(llm)
+    return getattr(chat_model, "temperature", None) == 0
+
+
+async def get_cached_response(key: str) -> dict | None:
+    cached = response_cache.get(key)
+    if cached is not None or not LLM_RESPONSE_CACHE_MONGO:
+        return cached
+
+    try:
+        document = await db.llm_response_cache.find_one({"_id": key, "expires_at": {"$gt": datetime.now()}})
+    except Exception as e:
+        print(f"    Failed to read the llm response cache: {e}")
+        return None
+    if document is None:
+        return None
+    response_cache.set(key, document["message"])
+    return document["message"]
+
+
+async def set_cached_response(key: str, message: dict):
+    response_cache.set(key, message)
+    if not LLM_RESPONSE_CACHE_MONGO:
+        return
+    try:
+        await db.llm_response_cache.update_one(
+            {"_id": key},
+            {"$set": {"message": message,
+                      "expires_at": datetime.now() + timedelta(seconds=LLM_RESPONSE_CACHE_TTL_SECONDS)}},
+            upsert=True)
+    except Exception as e:
+        print(f"    Failed to write the llm response cache: {e}")
+
+
+class ReplayChatModel(BaseChatModel):
+    """
+    Streams a cached answer again, in chunks of LLM_RESPONSE_REPLAY_CHUNK_CHARS characters, through the normal
+    chat model callbacks, so the graph stream (and the client) sees it exactly like a generated answer.
+    """
+    content: str
+    tool_calls: list[dict] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "replay"
+
+    def _chunks(self) -> Iterator[ChatGenerationChunk]:
+        for start in range(0, len(self.content), LLM_RESPONSE_REPLAY_CHUNK_CHARS):
+            yield ChatGenerationChunk(
+                message=AIMessageChunk(content=self.content[start:start + LLM_RESPONSE_REPLAY_CHUNK_CHARS]))
+        if self.tool_calls:
+            yield ChatGenerationChunk(message=AIMessageChunk(
+                content='',
+                tool_call_chunks=[{"name": tool_call["name"],
+                                   "args": json.dumps(tool_call["args"], ensure_ascii=False),
+                                   "id": tool_call.get("id"),
+                                   "index": index}
+                                  for index, tool_call in enumerate(self.tool_calls)]))
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs: Any) -> ChatResult:
+        return ChatResult(generations=[ChatGeneration(
+            message=AIMessage(content=self.content, tool_calls=self.tool_calls))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        for chunk in self._chunks():
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop=None, run_manager=None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        for chunk in self._chunks():
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+            yield chunk
+
+
+async def cached_ainvoke(llm: Runnable, input_messages: list[AnyMessage],
+                         admission: AbstractAsyncContextManager | None = None) -> AIMessage:
+    """
+    `llm.ainvoke(input_messages)` for deterministic (temperature 0) models, answered from the response cache
+    when the same model was asked the same thing before. Other models are always invoked.
+    The provider is only called inside `admission`, e.g. an `llm_slot`, so cache hits never wait for a slot.
+    """
+    admission = admission or nullcontext()
+    if not is_cacheable(llm):
+        async with admission:
+            return await resilient_ainvoke(llm, input_messages)
+
+    key = response_cache_key(llm, input_messages)
+    cached = await get_cached_response(key)
+    if cached is not None:
+        return await ReplayChatModel(content=cached["content"],
+                                     tool_calls=cached["tool_calls"]).ainvoke(input=input_messages)
+
+    async with admission:
+        ai_message = await resilient_ainvoke(llm, input_messages)
+    if ai_message.content or ai_message.tool_calls:
+        await set_cached_response(key, {"content": ai_message.content,
+                                        "tool_calls": [{"name": tool_call["name"],
+                                                        "args": tool_call["args"],
+                                                        "id": tool_call.get("id")}
+                                                       for tool_call in ai_message.tool_calls]})
+    return ai_message
+
+
+def get_response_cache_stats():
+    return response_cache.stats()
@@ -0,0 +1,41 @@
+from langchain_core.messages import SystemMessage, HumanMessage
+from langgraph.graph import START, StateGraph
+from .state import SummarizationGraphState
+from .prompts import SUMMARIZE_SYSTEM_PROMPT, SUMMARIZE_USER_PROMPT
+from ..ai_models import get_llm
+from ..agent_utils import record_llm_usage
+from ..llm_scheduler import llm_slot
+from ..resilience import resilient_ainvoke
+from ..editor.context_packer import estimate_tokens
+
+
+async def summarize(state: SummarizationGraphState):
+
+    # convert the conversation to a string
+    conversation_as_string = "\n\n".join(
+        f"<{msg.type}>\n{msg.content}\n</{msg.type}>" for msg in state.messages
+        )
+
+    llm = get_llm(llm="qwen", model='qwen-turbo', temperature=0)
+
+    formatted_system_prompt = SUMMARIZE_SYSTEM_PROMPT.format(previous_summary=state.previous_summary)
+
+    formatted_user_prompt = SUMMARIZE_USER_PROMPT.format(conversation=conversation_as_string)
+
+    input_messages = [
+        SystemMessage(formatted_system_prompt),
+        HumanMessage(formatted_user_prompt),
+    ]
+
+    async with llm_slot("qwen", state.user_id, cost=estimate_tokens(formatted_system_prompt + formatted_user_prompt)):
+        response = await resilient_ainvoke(llm, input_messages)
+    record_llm_usage(state.user_id, response)
+
+    return {"summary": response.content.strip()}
+
+
+graph_builder = StateGraph(SummarizationGraphState)
+graph_builder.add_node('summarize', summarize)
+graph_builder.add_edge(START, 'summarize')
+
+summarization_graph = graph_builder.compile()
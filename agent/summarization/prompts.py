@@ -0,0 +1,34 @@
+from langchain_core.prompts import PromptTemplate
+
+SUMMARIZE_SYSTEM_PROMPT = PromptTemplate(
+    input_variables=["previous_summary"],
+    template=
+f'''You are an expert assistant. You are tasked with keeping a running summary of a long conversation between a user and an AI article editor assistant.
+The summary replaces the older part of the conversation, the assistant will only see the summary and the most recent messages when it replies to the user.
+
+This is the summary you have written so far, it may be empty if the conversation has just become long enough to be summarized:
+<previous-summary>
+{{previous_summary}}
+</previous-summary>
+
+You will be given the messages that came after the previous summary. Write a new summary that covers both the previous summary and the new messages.
+Use these guidelines when writing the summary:
+
+<system-guidelines>
+- Keep what the assistant needs to continue the conversation: the user's requests, decisions, preferences and open questions, and what the assistant did or promised to do.
+- Keep the names of the articles and the parts of the articles that were discussed or edited, but do not copy article content.
+- Drop greetings, repetitions and anything that has been superseded by a later message.
+- Write in the language the user writes in.
+- Keep the summary short and factual, it should never be longer than the messages it replaces.
+</system-guidelines>
+
+Reply with the new summary only.'''
+)
+
+SUMMARIZE_USER_PROMPT = PromptTemplate(
+    input_variables=["conversation"],
+    template=
+f'''Here are the new messages between the user and the assistant:
+
+{{conversation}}'''
+)
@@ -0,0 +1,15 @@
+from typing import Annotated
+from pydantic import BaseModel
+from langchain_core.messages import AnyMessage
+from langgraph.graph.message import add_messages
+
+
+class SummarizationGraphState(BaseModel):
+    # The user the conversation belongs to, the llm request waits in this user's queue.
+    user_id: str = ''
+    # The messages to fold into the summary.
+    messages: Annotated[list[AnyMessage], add_messages]
+    # The summary of the messages before `messages`.
+    previous_summary: str = ''
+    # The new summary, covering the previous summary and `messages`.
+    summary: str | None = None
@@ -0,0 +1,36 @@
+"""
+Cost per request of get_jwt_payload with and without the verified token cache.
+
+    JWT_SECRET_KEY=... python -m benchmarks.bench_jwt_cache
+"""
+import os
+import time
+from datetime import timedelta
+
+os.environ.setdefault("JWT_SECRET_KEY", "benchmark-secret")
+
+from routers.auth_utils import create_jwt_token, get_jwt_payload, verified_token_cache, get_verified_token_cache_stats
+
+
+REQUESTS = 20_000
+
+
+def per_request_us(tokens: list[str], clear_cache: bool) -> float:
+    started_at = time.perf_counter()
+    for token in tokens:
+        if clear_cache:
+            verified_token_cache.clear()
+        get_jwt_payload(token)
+    return (time.perf_counter() - started_at) / len(tokens) * 1_000_000
+
+
+if __name__ == "__main__":
+    token, _ = create_jwt_token(data={"user_id": "A001"}, expire_delta=timedelta(minutes=30))
+    tokens = [token] * REQUESTS
+
+    uncached = per_request_us(tokens, clear_cache=True)
+    verified_token_cache.clear()
+    cached = per_request_us(tokens, clear_cache=False)
+    print(f"jwt.decode on every request {uncached:8.2f} us/request")
+    print(f"verified token cache        {cached:8.2f} us/request ({uncached / cached:.1f}x)")
+    print(get_verified_token_cache_stats())
@@ -0,0 +1,72 @@
+"""
+Time to first token of back-to-back requests, with a new chat model (and HTTP client) per request
+and with the shared clients of agent/ai_models.get_llm.
+
+    python -m benchmarks.bench_llm_pool
+
+The requests go to the local fake provider of agent/fake_provider.py, which is started here,
+unless DASHSCOPE_BASE_URL and DASHSCOPE_API_KEY point to a real one. Over plain HTTP on localhost
+only the TCP connect is saved, against a real provider the TLS handshake is saved as well.
+"""
+import os
+import time
+import socket
+import asyncio
+import threading
+import statistics
+import uvicorn
+from langchain_openai import ChatOpenAI
+from agent import fake_provider
+from agent.ai_models import get_llm, get_llm_pool_stats, close_llm_clients
+
+
+REQUESTS = 30
+MODEL = os.getenv("BENCH_LLM_MODEL", "qwen-turbo")
+
+
+def start_fake_provider() -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(fake_provider.app, host="127.0.0.1",
+                                           port=fake_provider.FAKE_PROVIDER_PORT, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    for _ in range(100):
+        with socket.socket() as connection:
+            if connection.connect_ex(("127.0.0.1", fake_provider.FAKE_PROVIDER_PORT)) == 0:
+                return server
+        time.sleep(0.05)
+    raise RuntimeError("The fake provider did not start")
+
+
+async def time_to_first_token(create_llm) -> float:
+    started_at = time.perf_counter()
+    first_token_seconds = None
+    async for chunk in create_llm().astream("hi"):
+        if chunk.content and first_token_seconds is None:
+            first_token_seconds = time.perf_counter() - started_at
+    return first_token_seconds
+
+
+def new_chat_model() -> ChatOpenAI:
+    # what every node call did before the registry
+    return ChatOpenAI(model=MODEL, api_key=os.environ["DASHSCOPE_API_KEY"],
+                      base_url=os.environ["DASHSCOPE_BASE_URL"], temperature=0)
+
+
+async def main():
+    for name, create_llm in [("client per request", new_chat_model),
+                             ("shared client", lambda: get_llm("qwen", MODEL, 0))]:
+        seconds = [await time_to_first_token(create_llm) for _ in range(REQUESTS)]
+        print(f"{name:18} time to first token median {statistics.median(seconds) * 1000:7.2f} ms  "
+              f"p90 {sorted(seconds)[int(REQUESTS * 0.9) - 1] * 1000:7.2f} ms")
+    print(get_llm_pool_stats())
+    await close_llm_clients()
+
+
+if __name__ == "__main__":
+    server = None
+    if not (os.getenv("DASHSCOPE_BASE_URL") and os.getenv("DASHSCOPE_API_KEY")):
+        os.environ["DASHSCOPE_BASE_URL"] = f"http://127.0.0.1:{fake_provider.FAKE_PROVIDER_PORT}/v1"
+        os.environ["DASHSCOPE_API_KEY"] = "fake"
+        server = start_fake_provider()
+    asyncio.run(main())
+    if server is not None:
+        server.should_exit = True
@@ -0,0 +1,65 @@
+"""
+Latency of websocket frames during a burst of logins, with bcrypt run on the event loop
+and on the password hashing pool of routers/password_utils.py.
+
+    python -m benchmarks.bench_password_hashing
+
+A stream task sends a frame every FRAME_INTERVAL_SECONDS, a frame's latency is how much later
+than that it comes after the previous one.
+"""
+import time
+import asyncio
+import statistics
+from routers.password_utils import pwd_context, verify_password, get_password_hashing_stats
+
+
+FRAME_INTERVAL_SECONDS = 0.005
+BURST_LOGINS = 8
+
+
+async def stream_frames(stop: asyncio.Event, latencies: list[float]):
+    sent_at = time.perf_counter()
+    while not stop.is_set():
+        await asyncio.sleep(FRAME_INTERVAL_SECONDS)
+        now = time.perf_counter()
+        latencies.append(now - sent_at - FRAME_INTERVAL_SECONDS)
+        sent_at = now
+
+
+async def login_inline(password: str, hashed_password: str):
+    # what login_user did before the pool
+    return pwd_context.verify(password, hashed_password)
+
+
+async def measure(login) -> dict:
+    hashed_password = pwd_context.hash("password")
+    stop, latencies = asyncio.Event(), []
+    stream_task = asyncio.create_task(stream_frames(stop, latencies))
+    await asyncio.sleep(0.05)
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(login("password", hashed_password) for _ in range(BURST_LOGINS)))
+    burst_seconds = time.perf_counter() - started_at
+
+    stop.set()
+    await stream_task
+    latencies.sort()
+    # a blocked loop sends fewer frames, so the max shows the stall the percentiles can miss
+    return {"frames": len(latencies),
+            "p50_ms": statistics.median(latencies) * 1000,
+            "p99_ms": latencies[max(0, int(len(latencies) * 0.99) - 1)] * 1000,
+            "max_ms": latencies[-1] * 1000,
+            "burst_seconds": burst_seconds}
+
+
+async def main():
+    for name, login in [("event loop", login_inline), ("hashing pool", verify_password)]:
+        result = await measure(login)
+        print(f"{name:13} {result['frames']:5} frames, latency p50 {result['p50_ms']:7.2f} ms  "
+              f"p99 {result['p99_ms']:8.2f} ms  max {result['max_ms']:8.2f} ms, "
+              f"{BURST_LOGINS} logins in {result['burst_seconds']:.2f} s")
+    print(get_password_hashing_stats())
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,61 @@
+"""
+Latency and prompt tokens of the BM25 retrieval of agent/editor/retrieval.py over many reference articles.
+
+    python -m benchmarks.bench_retrieval
+
+`cold` includes chunking and indexing every article, `warm` reuses the indexes cached by content hash.
+"""
+import time
+import random
+import asyncio
+import statistics
+from agent.agent_classes import Article
+from agent.editor.context_packer import estimate_tokens
+from agent.editor.retrieval import select_relevant_chunks, document_index_cache, get_retrieval_cache_stats
+
+
+REFERENCE_ARTICLES = 20
+SECTIONS_PER_ARTICLE = 60
+WARM_RUNS = 50
+QUERY = "how is the kubernetes deployment priced"
+
+
+def reference_article(rng: random.Random, index: int) -> Article:
+    vocabulary = [f"w{word}" for word in range(5000)] + ["kubernetes", "deployment", "pricing", "priced", "cluster"]
+    lines = []
+    for section in range(SECTIONS_PER_ARTICLE):
+        lines += [f"## Section {section}", ""]
+        for _ in range(4):
+            lines += [" ".join(rng.choice(vocabulary) for _ in range(60)), ""]
+        if section % 5 == 0:
+            lines += ["```python", "def handler():", "    return 1", "```", ""]
+    return Article(file_name=f"reference_{index}.md", content="\n".join(lines), file_category="reference")
+
+
+def total_tokens(articles: list[Article]) -> int:
+    return sum(estimate_tokens(article.content) for article in articles)
+
+
+async def main():
+    rng = random.Random(0)
+    articles = [reference_article(rng, index) for index in range(REFERENCE_ARTICLES)]
+
+    document_index_cache.clear()
+    started_at = time.perf_counter()
+    selected = await select_relevant_chunks(articles, QUERY)
+    cold_ms = (time.perf_counter() - started_at) * 1000
+
+    warm_ms = []
+    for _ in range(WARM_RUNS):
+        started_at = time.perf_counter()
+        await select_relevant_chunks(articles, QUERY)
+        warm_ms.append((time.perf_counter() - started_at) * 1000)
+
+    print(f"{REFERENCE_ARTICLES} reference articles, {total_tokens(articles):,} tokens")
+    print(f"selected {len(selected)} articles, {total_tokens(selected):,} tokens")
+    print(f"cold {cold_ms:8.1f} ms  warm median {statistics.median(warm_ms):6.2f} ms  max {max(warm_ms):6.2f} ms")
+    print(get_retrieval_cache_stats())
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+"""
+Frames and server CPU per answer of the chat websocket, with one validated JSON frame per llm chunk
+and with the coalescing stage and orjson encoder of routers/chat_utils.py.
+
+    python -m benchmarks.bench_stream_frames
+
+The websocket is simulated, so the CPU saved on the real ASGI and network path of every frame is not counted.
+
+The answer is ANSWER_TOKENS tokens streamed TOKEN_INTERVAL_SECONDS apart, like a fast provider.
+"""
+import os
+import json
+import time
+import asyncio
+from websockets.frames import Frame, Opcode
+from routers.chat_utils import StreamResponse, coalesce_stream_responses
+from routers.ws_codec import json_codec
+
+
+ANSWER_TOKENS = 2000
+TOKEN_INTERVAL_SECONDS = 0.0005
+
+
+class CountingWebSocket:
+    """Frames each message like the websocket server does, and writes it with one syscall."""
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self._output = os.open(os.devnull, os.O_WRONLY)
+
+    async def send_json(self, data: dict):
+        # starlette encodes send_json with the standard json module
+        await self.send_text(json.dumps(data, separators=(",", ":"), ensure_ascii=False))
+
+    async def send_text(self, text: str):
+        frame = Frame(Opcode.TEXT, text.encode()).serialize(mask=False, extensions=[])
+        os.write(self._output, frame)
+        self.frames += 1
+        self.bytes += len(frame)
+
+    def close(self):
+        os.close(self._output)
+
+
+def stream_fields(index: int) -> dict:
+    return dict(type='stream', assistant_id='assistant', assistant_status='thinking', role='assistant',
+                content_chunk=f'token{index} ', think_content_chunk='', edited_article_chunk='',
+                edited_article_related_to='article.md', other_data={})
+
+
+async def validated_responses():
+    for index in range(ANSWER_TOKENS):
+        await asyncio.sleep(TOKEN_INTERVAL_SECONDS)
+        yield StreamResponse(**stream_fields(index))
+
+
+async def constructed_responses():
+    for index in range(ANSWER_TOKENS):
+        await asyncio.sleep(TOKEN_INTERVAL_SECONDS)
+        yield StreamResponse.model_construct(**stream_fields(index))
+
+
+async def producer_only(websocket: CountingWebSocket):
+    # the cost of the simulated llm stream itself, the baseline of the other two
+    async for _ in validated_responses():
+        pass
+
+
+async def frame_per_chunk(websocket: CountingWebSocket):
+    async for response in validated_responses():
+        await websocket.send_json(response.model_dump())
+
+
+async def coalesced(websocket: CountingWebSocket):
+    async for response in coalesce_stream_responses(constructed_responses()):
+        await json_codec.send(websocket, response.model_dump())
+
+
+async def main():
+    for name, send_answer in [("producer only", producer_only), ("frame per chunk", frame_per_chunk),
+                              ("coalesced", coalesced)]:
+        websocket = CountingWebSocket()
+        cpu_started_at, started_at = time.process_time(), time.perf_counter()
+        await send_answer(websocket)
+        websocket.close()
+        cpu_ms = (time.process_time() - cpu_started_at) * 1000
+        print(f"{name:16} {websocket.frames:5} frames, {websocket.bytes:7,} bytes, "
+              f"{cpu_ms:7.1f} ms CPU, {time.perf_counter() - started_at:.2f} s per answer")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,41 @@
+"""
+Tokens per second of TagStreamParser against the regex parser it replaced, on a 100k token stream.
+
+    python -m benchmarks.bench_tag_parser
+"""
+import time
+import random
+from tests.test_tag_parser import parse_with_reference, parse_with_stream_parser
+
+
+STREAM_TOKENS = 100_000
+
+
+def token_stream(rng: random.Random) -> list[str]:
+    tokens = []
+    for index in range(STREAM_TOKENS):
+        if index % 5000 == 0:
+            tokens.append('<think>')
+        elif index % 5000 == 2500:
+            tokens.append('</think>')
+        else:
+            tokens.append(rng.choice(['word ', 'the ', 'x', 'y', ' <line_3>', '</line_3>\n', 'a<b']))
+    return tokens
+
+
+def measure(parse, chunks: list[str]) -> float:
+    started_at = time.perf_counter()
+    parse(chunks)
+    return time.perf_counter() - started_at
+
+
+if __name__ == "__main__":
+    tokens = token_stream(random.Random(0))
+    for name, parse in [("regex parser", parse_with_reference), ("TagStreamParser", parse_with_stream_parser)]:
+        seconds = measure(parse, tokens)
+        print(f"{name:16} {len(tokens) / seconds:12,.0f} tokens/s")
+
+    # the whole answer in one chunk, e.g. a non-streaming provider
+    text = ''.join(tokens)
+    for name, parse in [("regex parser", parse_with_reference), ("TagStreamParser", parse_with_stream_parser)]:
+        print(f"{name:16} {measure(parse, [text]) * 1000:12,.1f} ms for one {len(text):,} character chunk")
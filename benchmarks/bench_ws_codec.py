@@ -0,0 +1,94 @@
+"""
+Bytes on the wire and encode/decode CPU of the chat websocket encodings for a typical edit session:
+the client sends a stream request with its articles, and the server streams the answer and the edited article.
+
+    python -m benchmarks.bench_ws_codec
+
+`json+deflate` is JSON over permessage-deflate, simulated with a deflate stream that keeps its context
+across messages, like the websocket server does.
+"""
+import time
+import zlib
+import random
+from routers.ws_codec import WebSocketCodec, supported_encodings
+
+
+SESSION_REQUESTS = 5
+ANSWER_FRAMES = 60
+
+
+def markdown_article(rng: random.Random, sections: int) -> str:
+    words = ["the", "model", "article", "stream", "latency", "editor", "markdown", "user", "server", "frame",
+             "token", "chunk", "answer", "context", "retrieval", "cache", "写作", "助手", "文章"]
+    lines = []
+    for section in range(sections):
+        lines += [f"## Section {section}", ""]
+        for _ in range(3):
+            lines += [" ".join(rng.choice(words) for _ in range(50)), ""]
+        lines += ["- " + " ".join(rng.choice(words) for _ in range(8)) for _ in range(4)] + [""]
+    return "\n".join(lines)
+
+
+def edit_session(rng: random.Random) -> list[tuple[str, dict]]:
+    """(direction, message) of every message of the session."""
+    article = markdown_article(rng, sections=20)
+    messages = []
+    for request in range(SESSION_REQUESTS):
+        messages.append(("client", {
+            "type": "stream", "assistant_id": "assistant",
+            "messages": [{"role": "user", "content": "Rewrite the second section in a friendlier tone"}],
+            "highlight_data": {"is_highlighted": False, "highlighted_text": "", "start_index": 0, "end_index": 0},
+            "article": {"file_name": "article.md", "content": article, "file_category": "current"},
+            "other_articles": [],
+            "reference_articles": [{"file_name": "notes.md", "content": markdown_article(rng, sections=5),
+                                    "file_category": "reference"}],
+            "config": {}}))
+        edited_article = markdown_article(rng, sections=2)
+        step = len(edited_article) // ANSWER_FRAMES + 1
+        for frame in range(ANSWER_FRAMES):
+            messages.append(("server", {
+                "type": "stream", "assistant_id": "assistant", "assistant_status": "thinking", "role": "assistant",
+                "content_chunk": "Sure, here is the rewritten section. " if frame == 0 else "",
+                "think_content_chunk": "",
+                "edited_article_chunk": edited_article[frame * step:(frame + 1) * step],
+                "edited_article_related_to": "article.md", "other_data": {}}))
+        messages.append(("server", {"type": "stream_end", "assistant_id": "assistant"}))
+    return messages
+
+
+def measure(encoding: str, messages: list[tuple[str, dict]]) -> dict:
+    if encoding == 'json+deflate':
+        codec = WebSocketCodec('json')
+        deflate = {direction: zlib.compressobj(wbits=-15) for direction in ("client", "server")}
+        inflate = {direction: zlib.decompressobj(wbits=-15) for direction in ("client", "server")}
+    else:
+        codec = WebSocketCodec(encoding)
+        deflate = inflate = None
+
+    wire_bytes = {"client": 0, "server": 0}
+    encode_seconds = decode_seconds = 0.0
+    for direction, message in messages:
+        started_at = time.perf_counter()
+        frame = codec.encode(message)
+        if deflate is not None:
+            frame = deflate[direction].compress(frame.encode()) + deflate[direction].flush(zlib.Z_SYNC_FLUSH)
+        encode_seconds += time.perf_counter() - started_at
+        wire_bytes[direction] += len(frame)
+
+        started_at = time.perf_counter()
+        if inflate is not None:
+            frame = inflate[direction].decompress(frame)
+        codec.decode(frame if isinstance(frame, bytes) else frame.encode())
+        decode_seconds += time.perf_counter() - started_at
+
+    return {"client_bytes": wire_bytes["client"], "server_bytes": wire_bytes["server"],
+            "encode_ms": encode_seconds * 1000, "decode_ms": decode_seconds * 1000}
+
+
+if __name__ == "__main__":
+    messages = edit_session(random.Random(0))
+    print(f"{len(messages)} messages per session")
+    for encoding in ['json', 'json+deflate'] + [encoding for encoding in supported_encodings() if encoding != 'json']:
+        result = measure(encoding, messages)
+        print(f"{encoding:13} client {result['client_bytes']:9,} B  server {result['server_bytes']:8,} B  "
+              f"encode {result['encode_ms']:6.2f} ms  decode {result['decode_ms']:6.2f} ms")
@@ -0,0 +1,109 @@
+import os
+import asyncio
+from pymongo.errors import OperationFailure
+from .db import db
+from .db_classes import AssistantData
+from .cache import TTLCache
+
+
+ASSISTANT_CACHE_SIZE = int(os.getenv("ASSISTANT_CACHE_SIZE", 1024))
+ASSISTANT_CACHE_TTL_SECONDS = float(os.getenv("ASSISTANT_CACHE_TTL_SECONDS", 300))
+
+# (user_id, assistant_id) -> AssistantData, read on every chat turn.
+# The cached instances are shared between requests and must be treated as read-only.
+assistant_data_cache = TTLCache(maxsize=ASSISTANT_CACHE_SIZE, ttl=ASSISTANT_CACHE_TTL_SECONDS)
+
+# a failed change stream is reopened after a backoff that doubles on every failure, up to the max
+ASSISTANT_CHANGE_STREAM_RETRY_SECONDS = 1
+ASSISTANT_CHANGE_STREAM_MAX_RETRY_SECONDS = float(os.getenv("ASSISTANT_CHANGE_STREAM_MAX_RETRY_SECONDS", 60))
+# the change stream needs a replica set
+_CHANGE_STREAM_NOT_SUPPORTED = 40573
+# the position of the resume token is no longer in the oplog
+_CHANGE_STREAM_HISTORY_LOST = (280, 286)
+
+
+# 每个用户的助手列表版本号, 存在 user_profiles 中.
+# 任何对 assistant_data 的写入都要调用 bump_assistant_list_version, /agent/list 用它生成 ETag
+async def bump_assistant_list_version(user_id: str):
+    await db.user_profiles.update_one(
+        {"user_id": user_id},
+        {"$inc": {"assistant_list_version": 1}}
+    )
+
+
+async def fetch_assistant_list_version(user_id: str) -> int:
+    document = await db.user_profiles.find_one({"user_id": user_id},
+                                               {"_id": 0, "assistant_list_version": 1})
+    if not document:
+        return 0
+    return document.get("assistant_list_version", 0)
+
+
+async def fetch_assistant_data(user_id: str, assistant_id: str) -> AssistantData | None:
+    key = (user_id, assistant_id)
+    assistant_data = assistant_data_cache.get(key)
+    if assistant_data is not None:
+        return assistant_data
+
+    generation = assistant_data_cache.generation
+    document = await db.assistant_data.find_one({"assistant_id": assistant_id, "user_id": user_id})
+    if not document:
+        return None
+
+    assistant_data = AssistantData(**document)
+    assistant_data_cache.set(key, assistant_data, generation=generation)
+    return assistant_data
+
+
+def invalidate_assistant_data(user_id: str, assistant_id: str):
+    """Must be called after every write to an assistant_data document."""
+    assistant_data_cache.invalidate((user_id, assistant_id))
+
+
+def get_assistant_cache_stats():
+    return assistant_data_cache.stats()
+
+
+async def watch_assistant_data_changes():
+    """
+    Invalidates the assistant cache from a mongodb change stream, so that writes made by
+    other workers are seen before the cache entry expires. Change streams need a replica set.
+    A failed stream is reopened with backoff from its resume token, so no change is missed.
+    When it can not resume, the whole cache is cleared instead.
+    """
+    resume_token = None
+    retry_seconds = ASSISTANT_CHANGE_STREAM_RETRY_SECONDS
+    while True:
+        try:
+            async with db.assistant_data.watch(full_document='updateLookup', resume_after=resume_token) as stream:
+                if resume_token is None:
+                    # the changes made while the stream was down are unknown
+                    assistant_data_cache.clear()
+                print("    Watching assistant_data changes for cache invalidation")
+                retry_seconds = ASSISTANT_CHANGE_STREAM_RETRY_SECONDS
+                resume_token = stream.resume_token
+                async for change in stream:
+                    document = change.get('fullDocument')
+                    if document:
+                        invalidate_assistant_data(document['user_id'], document['assistant_id'])
+                    else:
+                        # deletes only carry the _id, so the affected key is unknown
+                        assistant_data_cache.clear()
+                    # a stream invalidated by a drop or rename can not be resumed
+                    resume_token = None if change['operationType'] == 'invalidate' else stream.resume_token
+            continue
+        except asyncio.CancelledError:
+            raise
+        except OperationFailure as e:
+            if e.code == _CHANGE_STREAM_NOT_SUPPORTED:
+                print(f"    Assistant change stream not supported, falling back to TTL expiry: {e}")
+                return
+            if e.code in _CHANGE_STREAM_HISTORY_LOST:
+                resume_token = None
+            error = e
+        except Exception as e:
+            error = e
+
+        print(f"    Assistant change stream failed, reopening it in {retry_seconds:.0f}s: {error}")
+        await asyncio.sleep(retry_seconds)
+        retry_seconds = min(retry_seconds * 2, ASSISTANT_CHANGE_STREAM_MAX_RETRY_SECONDS)
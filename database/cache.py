@@ -0,0 +1,158 @@
+import time
+import heapq
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class TTLCache:
+    """
+    A small in-process LRU cache whose entries also expire after `ttl` seconds.
+    Not shared between workers, so every entry must be safe to serve for up to `ttl` seconds.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # bumped on every invalidation, so a value read from the database before
+        # an invalidation is not written back into the cache after it
+        self.generation = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, generation: int | None = None):
+        if generation is not None and generation != self.generation:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        self.generation += 1
+        self._data.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class ExpiringCache:
+    """
+    A bounded cache where every entry carries its own absolute expiry (unix timestamp).
+    A min-heap ordered by expiry makes purging expired entries cheap, and when the cache
+    is full the entry closest to expiry is evicted first.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data: dict[Hashable, tuple[float, Any]] = {}
+        self._expiry_heap: list[tuple[float, Hashable]] = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+
+        expires_at, value = entry
+        if expires_at <= time.time():
+            del self._data[key]
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, expires_at: float):
+        if expires_at <= time.time():
+            return
+
+        previous = self._data.get(key)
+        self._data[key] = (expires_at, value)
+        if previous is None or previous[0] != expires_at:
+            heapq.heappush(self._expiry_heap, (expires_at, key))
+        if len(self._data) > self.maxsize or len(self._expiry_heap) > 2 * self.maxsize:
+            self._purge(force=True)
+
+    def _purge(self, force: bool = False):
+        now = time.time()
+        while self._expiry_heap:
+            expires_at, key = self._expiry_heap[0]
+            entry = self._data.get(key)
+            if entry is None or entry[0] != expires_at:
+                # stale heap item, the key was removed or set again with another expiry
+                heapq.heappop(self._expiry_heap)
+                continue
+            if expires_at <= now:
+                heapq.heappop(self._expiry_heap)
+                del self._data[key]
+                continue
+            if force and len(self._data) > self.maxsize:
+                heapq.heappop(self._expiry_heap)
+                del self._data[key]
+                self.evictions += 1
+                continue
+            break
+
+        # keep the heap from growing with stale items when keys are re-set or invalidated
+        if len(self._expiry_heap) > 2 * self.maxsize:
+            self._expiry_heap = [(expires_at, key) for key, (expires_at, _) in self._data.items()]
+            heapq.heapify(self._expiry_heap)
+
+    def invalidate(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+        self._expiry_heap.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
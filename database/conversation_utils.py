@@ -0,0 +1,67 @@
+import hashlib
+from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from .db import db
+from .db_classes import ConversationMessage, ConversationSummary
+
+
+def prefix_hashes(messages: list[dict]) -> list[str]:
+    """The hash of messages[:i + 1] for every i, the last one is the hash of the whole conversation."""
+    digest = hashlib.sha256()
+    hashes = []
+    for msg in messages:
+        digest.update(f"{msg['role']}\x00{msg['content']}\x00".encode('utf-8'))
+        hashes.append(digest.copy().hexdigest())
+    return hashes
+
+
+def messages_hash(messages: list[dict]) -> str:
+    return prefix_hashes(messages)[-1] if messages else hashlib.sha256().hexdigest()
+
+
+async def append_conversation_messages(user_id: str, assistant_id: str, messages: list[dict], start: int = 0):
+    """
+    Logs messages[start:] of a conversation. Each message is upserted by the hash of the conversation up to
+    and including it, so logging messages again, from a retried summary or a request repeating the history,
+    changes nothing, while a conversation that only shares a beginning with another gets its own messages.
+    """
+    if start >= len(messages):
+        return
+    hashes = prefix_hashes(messages)
+    timestamp = datetime.now()
+    operations = []
+    for index in range(start, len(messages)):
+        document = ConversationMessage(user_id=user_id,
+                                       assistant_id=assistant_id,
+                                       conversation_id=hashes[0],
+                                       message_index=index,
+                                       prefix_hash=hashes[index],
+                                       role=messages[index]['role'],
+                                       content=messages[index]['content'],
+                                       timestamp=timestamp).model_dump()
+        operations.append(UpdateOne({"user_id": user_id, "assistant_id": assistant_id, "prefix_hash": hashes[index]},
+                                    {"$setOnInsert": document},
+                                    upsert=True))
+    try:
+        await db.conversation_messages.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # two requests upserting the same message at once, one of them has inserted it
+        if any(error['code'] != 11000 for error in e.details['writeErrors']):
+            raise
+
+
+async def fetch_conversation_summary(user_id: str, assistant_id: str) -> ConversationSummary | None:
+    document = await db.conversation_summaries.find_one({"user_id": user_id, "assistant_id": assistant_id},
+                                                        {"_id": 0})
+    if document:
+        return ConversationSummary(**document)
+    return None
+
+
+async def save_conversation_summary(conversation_summary: ConversationSummary):
+    await db.conversation_summaries.update_one(
+        {"user_id": conversation_summary.user_id, "assistant_id": conversation_summary.assistant_id},
+        {"$set": conversation_summary.model_dump()},
+        upsert=True
+    )
@@ -22,26 +22,36 @@ class EmbeddingToken(BaseModel):
     timestamp: datetime
     total_tokens: int
 
+
+# token usage is stored in its own append-only collections, one document per call
+class LLMTokenUsage(LLMToken):
+    user_id: str
+
+
+class EmbeddingTokenUsage(EmbeddingToken):
+    user_id: str
+
 class AssistantInfo(BaseModel):
     assistant_id: str
     assistant_name: str
 
-class UserProfile(UserInfo):
-    hashed_password: str
+# the fields needed to authenticate a session, fetched on every authenticated call
+class UserSessionProfile(UserInfo):
     refresh_token: str | None = None
 
     created_at: datetime
     last_login: datetime | None = None
 
+    inactive: bool = False
+
+class UserProfile(UserSessionProfile):
+    hashed_password: str
+
     assistant_info_list: list[AssistantInfo] = Field(default_factory=list)
 
-    llm_token_usage: list[LLMToken] = Field(default_factory=list)
     llm_price: float = 0.0
-    embedding_token_usage: list[EmbeddingToken] = Field(default_factory=list)
     embedding_price: float = 0.0
 
-    inactive: bool = False
-
 
 class AssistantData(BaseModel):
     user_id: str
@@ -54,3 +64,34 @@ class AssistantData(BaseModel):
 
     user_defined_rules: list[str] | None = None
 
+    # incremented on every write, used for optimistic concurrency control
+    version: int = 0
+
+
+
+# the turns of each conversation, append-only. A message is unique per (user_id, assistant_id, prefix_hash),
+# so logging the same history again adds nothing
+class ConversationMessage(BaseModel):
+    user_id: str
+    assistant_id: str
+    # prefix hash of the first message, shared by every message of the conversation
+    conversation_id: str
+    message_index: int
+    # hash of the conversation up to and including this message
+    prefix_hash: str
+    role: Literal['user', 'assistant']
+    content: str
+    timestamp: datetime
+
+
+class ConversationSummary(BaseModel):
+    user_id: str
+    assistant_id: str
+
+    summary: str
+    # the number of leading messages of the conversation covered by the summary
+    summarized_count: int
+    # hash of those messages, to check that a request continues the summarized conversation
+    prefix_hash: str
+
+    updated_at: datetime
@@ -0,0 +1,60 @@
+"""
+Renames assistants whose name is used more than once by the same user, so the unique
+(user_id, assistant_name) index of `assistant_data` can be built.
+
+Run it once from the project root, the app also runs it on startup when building the index fails:
+
+    python -m database.migrate_assistant_names
+
+The oldest assistant of each duplicated name keeps it, the others are renamed to `name (2)`, `name (3)`, ...
+skipping names the user already has. The names in `user_profiles.assistant_info_list` are renamed as well.
+"""
+import asyncio
+import dotenv
+
+dotenv.load_dotenv(encoding='utf-8', override=True)
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+
+async def dedupe_assistant_names(db: AsyncIOMotorDatabase):
+    pipeline = [
+        {"$group": {"_id": {"user_id": "$user_id", "assistant_name": "$assistant_name"},
+                    "ids": {"$push": "$_id"},
+                    "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ]
+
+    renamed = 0
+    async for group in db.assistant_data.aggregate(pipeline):
+        user_id = group['_id']['user_id']
+        assistant_name = group['_id']['assistant_name']
+        taken = set(await db.assistant_data.distinct("assistant_name", {"user_id": user_id}))
+
+        # ObjectIds grow with the creation time, the oldest assistant keeps the name
+        suffix = 2
+        for document_id in sorted(group['ids'])[1:]:
+            while f"{assistant_name} ({suffix})" in taken:
+                suffix += 1
+            new_name = f"{assistant_name} ({suffix})"
+            taken.add(new_name)
+
+            document = await db.assistant_data.find_one_and_update(
+                {"_id": document_id},
+                {"$set": {"assistant_name": new_name}, "$inc": {"version": 1}},
+                projection={"assistant_id": 1})
+            await db.user_profiles.update_one(
+                {"user_id": user_id, "assistant_info_list.assistant_id": document['assistant_id']},
+                {"$set": {"assistant_info_list.$.assistant_name": new_name},
+                 "$inc": {"assistant_list_version": 1}})
+            print(f"    Renamed assistant {document['assistant_id']} of user {user_id}: "
+                  f"{assistant_name} -> {new_name}")
+            renamed += 1
+
+    print(f"    Renamed {renamed} assistants with duplicate names")
+    return renamed
+
+
+if __name__ == "__main__":
+    from database.db import db
+    asyncio.run(dedupe_assistant_names(db))
@@ -0,0 +1,59 @@
+"""
+Moves the legacy `llm_token_usage` and `embedding_token_usage` arrays embedded in
+`user_profiles` into the append-only `llm_token_usage` and `embedding_token_usage` collections.
+
+Run it once from the project root:
+
+    python -m database.migrate_token_usage
+
+Each user is migrated separately: the usage records are inserted first, and the arrays
+are only removed from the profile after the insert succeeded. If the script is interrupted
+between the two steps, running it again may duplicate that one user's records, but never loses any.
+"""
+import asyncio
+import dotenv
+
+dotenv.load_dotenv(encoding='utf-8', override=True)
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from database.db_classes import LLMTokenUsage, EmbeddingTokenUsage
+
+
+async def migrate_token_usage(db: AsyncIOMotorDatabase):
+    query = {"$or": [{"llm_token_usage": {"$exists": True}},
+                     {"embedding_token_usage": {"$exists": True}}]}
+    projection = {"_id": 1, "user_id": 1, "llm_token_usage": 1, "embedding_token_usage": 1}
+
+    migrated_users = 0
+    migrated_llm_records = 0
+    migrated_embedding_records = 0
+
+    async for document in db.user_profiles.find(query, projection):
+        user_id = document['user_id']
+
+        llm_records = [LLMTokenUsage(user_id=user_id, **record).model_dump()
+                       for record in document.get('llm_token_usage') or []]
+        embedding_records = [EmbeddingTokenUsage(user_id=user_id, **record).model_dump()
+                             for record in document.get('embedding_token_usage') or []]
+
+        if llm_records:
+            await db.llm_token_usage.insert_many(llm_records)
+        if embedding_records:
+            await db.embedding_token_usage.insert_many(embedding_records)
+
+        await db.user_profiles.update_one(
+            {"_id": document['_id']},
+            {"$unset": {"llm_token_usage": "", "embedding_token_usage": ""}}
+        )
+
+        migrated_users += 1
+        migrated_llm_records += len(llm_records)
+        migrated_embedding_records += len(embedding_records)
+
+    print(f"    Migrated token usage of {migrated_users} users: "
+          f"{migrated_llm_records} llm records, {migrated_embedding_records} embedding records")
+
+
+if __name__ == "__main__":
+    from database.db import db
+    asyncio.run(migrate_token_usage(db))
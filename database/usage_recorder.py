@@ -0,0 +1,129 @@
+import os
+import asyncio
+from collections import deque
+from pydantic import BaseModel
+from pymongo.errors import BulkWriteError
+from .db import db
+
+
+# token usage records are buffered in memory and written to mongo in the background with insert_many,
+# when USAGE_FLUSH_BATCH_SIZE records are waiting or every USAGE_FLUSH_INTERVAL_SECONDS
+USAGE_FLUSH_BATCH_SIZE = int(os.getenv("USAGE_FLUSH_BATCH_SIZE", 200))
+USAGE_FLUSH_INTERVAL_SECONDS = float(os.getenv("USAGE_FLUSH_INTERVAL_SECONDS", 5))
+# records kept while mongo is unreachable, the oldest ones are dropped beyond this
+USAGE_BUFFER_MAX_RECORDS = int(os.getenv("USAGE_BUFFER_MAX_RECORDS", 20000))
+
+
+class UsageRecorder:
+    """
+    Write-behind recorder of the append-only usage collections (llm_token_usage, embedding_token_usage).
+    `record` only appends to an in-memory buffer, so it adds no latency to the chat stream,
+    and a background task bulk inserts the buffered records. Records that fail to insert are kept and retried.
+    """
+
+    def __init__(self):
+        self._buffers: dict[str, deque[dict]] = {}
+        self._wake_up = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+        self.recorded = 0
+        self.inserted = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+
+    def buffered(self) -> int:
+        return sum(len(buffer) for buffer in self._buffers.values())
+
+    def record(self, collection: str, record: BaseModel):
+        buffer = self._buffers.setdefault(collection, deque())
+        buffer.append(record.model_dump())
+        self.recorded += 1
+        if len(buffer) > USAGE_BUFFER_MAX_RECORDS:
+            buffer.popleft()
+            self.dropped += 1
+        if self.buffered() >= USAGE_FLUSH_BATCH_SIZE:
+            self._wake_up.set()
+
+    async def flush(self) -> bool:
+        """
+        Inserts every buffered record, the records of a failed insert are put back in front of the buffer.
+        Returns False when some records could not be inserted.
+        """
+        succeeded = True
+        async with self._flush_lock:
+            for collection, buffer in list(self._buffers.items()):
+                if not buffer:
+                    continue
+                records = list(buffer)
+                buffer.clear()
+                self.flushes += 1
+                try:
+                    # unordered, so one bad record does not stop the others
+                    await db[collection].insert_many(records, ordered=False)
+                    self.inserted += len(records)
+                    continue
+                except BulkWriteError as e:
+                    # a duplicate key means the record was already inserted by an earlier, failed looking flush
+                    failed = {error['index'] for error in e.details['writeErrors'] if error['code'] != 11000}
+                    self.inserted += len(records) - len(failed)
+                    records = [record for index, record in enumerate(records) if index in failed]
+                    error = e
+                except Exception as e:
+                    error = e
+                if not records:
+                    continue
+                self.failed_flushes += 1
+                succeeded = False
+                print(f"    Failed to write {len(records)} {collection} records, will retry: {error}")
+                # insert_many has given each record an _id, so a retry can not insert a record twice
+                buffer.extendleft(reversed(records))
+                while len(buffer) > USAGE_BUFFER_MAX_RECORDS:
+                    buffer.popleft()
+                    self.dropped += 1
+        return succeeded
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake_up.wait(), timeout=USAGE_FLUSH_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wake_up.clear()
+            if not await self.flush() and not self._stopping:
+                # mongo is failing, a full buffer must not retry it in a tight loop
+                await asyncio.sleep(USAGE_FLUSH_INTERVAL_SECONDS)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stops the background task and writes what is still buffered, called on shutdown."""
+        if self._task is not None:
+            # not cancelled, an insert in progress is finished first
+            self._stopping = True
+            self._wake_up.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "buffered": self.buffered(),
+            "recorded": self.recorded,
+            "inserted": self.inserted,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+        }
+
+
+usage_recorder = UsageRecorder()
+
+
+def get_usage_recorder_stats() -> dict:
+    return usage_recorder.stats()
@@ -0,0 +1,304 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+from pydantic import BaseModel
+
+# the stores are locked with flock so several workers can share VECTOR_STORE_DIR,
+# without fcntl (windows) only one worker may use a store directory
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+VECTOR_STORE_DIR = os.getenv("VECTOR_STORE_DIR", "./vector_store")
+# number of user stores kept open at once
+VECTOR_STORE_OPEN_LIMIT = int(os.getenv("VECTOR_STORE_OPEN_LIMIT", 256))
+
+INITIAL_CAPACITY = 1024
+# the files are rewritten without the deleted rows once more than this share of the rows is deleted
+COMPACT_DELETED_RATIO = 0.5
+
+
+class VectorChunk(BaseModel):
+    document_hash: str
+    file_name: str
+    start_line: int
+    end_line: int
+    text: str
+
+
+class VectorSearchResult(VectorChunk):
+    score: float
+
+
+class UserVectorStore:
+    """
+    The chunk vectors of one user's documents, in memory-mapped files under VECTOR_STORE_DIR:
+
+    - `header.json`: model, dimension, row count, capacity and the generation of the data files
+    - `vectors.<generation>.f32`: capacity x dimension float32 rows, L2-normalized
+    - `alive.<generation>.u8`: 1 for live rows, 0 for deleted ones
+    - `chunks.<generation>.jsonl`: the VectorChunk of every row
+
+    Rows are appended in place and deleted with a tombstone. Growing and compacting write a new generation
+    of the data files, and the header is replaced atomically after the data it points to is written,
+    so a crash leaves the last complete state. Rows beyond the header's count are ignored when loading.
+
+    Several processes can open the same store: writes hold an exclusive flock on `lock` and searches a shared one,
+    and the header's version, bumped on every write, tells a process to reload what another one has written.
+    """
+
+    def __init__(self, directory: str, model_name: str, dimension: int):
+        self.directory = directory
+        self.model_name = model_name
+        self.dimension = dimension
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(os.path.join(directory, 'lock'), 'a')
+        self.version = None
+        self.generation = None
+        self.capacity = None
+
+        with self._file_lock(exclusive=True):
+            header = self._read_header()
+            if header and header["model_name"] == model_name and header["dimension"] == dimension:
+                self._load(header)
+            else:
+                # a store written by another embedding model can't be searched with this one, start over
+                self.version = header.get("version", 0) if header else 0
+                self.generation = header["generation"] if header else 0
+                self.chunks = []
+                self._create_generation(self.generation + 1 if header else 0, INITIAL_CAPACITY,
+                                        np.empty((0, dimension), np.float32), np.empty(0, np.uint8), [])
+                self._open_files(mode='r+')
+                self._index_rows()
+
+    @contextmanager
+    def _file_lock(self, exclusive: bool):
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _load(self, header: dict):
+        if header["generation"] != self.generation or header["capacity"] != self.capacity:
+            self.generation = header["generation"]
+            self.capacity = header["capacity"]
+            self._open_files(mode='r+')
+        self.version = header.get("version", 0)
+        self.count = header["count"]
+        self.chunks = self._read_chunks()[:self.count]
+        self.count = len(self.chunks)
+        self._index_rows()
+
+    def _index_rows(self):
+        # document hash -> row numbers, and file name -> hash of the latest indexed version
+        self.documents: dict[str, list[int]] = {}
+        self.files: dict[str, str] = {}
+        for row, chunk in enumerate(self.chunks):
+            if self._alive[row]:
+                self.documents.setdefault(chunk.document_hash, []).append(row)
+                self.files[chunk.file_name] = chunk.document_hash
+
+    def _refresh(self):
+        """Reloads the store when another process has written to it, called with the file lock held."""
+        header = self._read_header()
+        if (header and header.get("version", 0) != self.version
+                and header["model_name"] == self.model_name and header["dimension"] == self.dimension):
+            self._load(header)
+
+    def _path(self, name: str, generation: int | None = None) -> str:
+        generation = self.generation if generation is None else generation
+        return os.path.join(self.directory, name.format(generation=generation))
+
+    def _read_header(self) -> dict | None:
+        try:
+            with open(os.path.join(self.directory, 'header.json'), encoding='utf-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def _write_header(self):
+        self.version += 1
+        path = os.path.join(self.directory, 'header.json')
+        with open(path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump({"model_name": self.model_name,
+                       "version": self.version,
+                       "dimension": self.dimension,
+                       "generation": self.generation,
+                       "capacity": self.capacity,
+                       "count": self.count}, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + '.tmp', path)
+
+    def _open_files(self, mode: str):
+        self._vectors = np.memmap(self._path('vectors.{generation}.f32'), dtype=np.float32, mode=mode,
+                                  shape=(self.capacity, self.dimension))
+        self._alive = np.memmap(self._path('alive.{generation}.u8'), dtype=np.uint8, mode=mode,
+                                shape=(self.capacity,))
+
+    def _read_chunks(self) -> list[VectorChunk]:
+        chunks = []
+        with open(self._path('chunks.{generation}.jsonl'), encoding='utf-8') as file:
+            for line in file:
+                try:
+                    chunks.append(VectorChunk.model_validate_json(line))
+                except ValueError:
+                    # a line cut short by a crash
+                    break
+        return chunks
+
+    def _create_generation(self, generation: int, capacity: int, vectors: np.ndarray, alive: np.ndarray,
+                           chunks: list[VectorChunk]):
+        """Writes the data files of a new generation and then points the header at them."""
+        new_vectors = np.memmap(self._path('vectors.{generation}.f32', generation), dtype=np.float32, mode='w+',
+                                shape=(capacity, self.dimension))
+        new_vectors[:len(vectors)] = vectors
+        new_vectors.flush()
+        new_alive = np.memmap(self._path('alive.{generation}.u8', generation), dtype=np.uint8, mode='w+',
+                              shape=(capacity,))
+        new_alive[:len(alive)] = alive
+        new_alive.flush()
+        with open(self._path('chunks.{generation}.jsonl', generation), 'w', encoding='utf-8') as file:
+            for chunk in chunks:
+                file.write(chunk.model_dump_json() + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        del new_vectors, new_alive
+
+        previous_generation = self.generation
+        self.generation = generation
+        self.capacity = capacity
+        self.count = len(chunks)
+        self._write_header()
+
+        if previous_generation != generation:
+            for name in ('vectors.{generation}.f32', 'alive.{generation}.u8', 'chunks.{generation}.jsonl'):
+                try:
+                    os.remove(self._path(name, previous_generation))
+                except FileNotFoundError:
+                    pass
+
+    def _rewrite(self, capacity: int, keep_rows: np.ndarray):
+        vectors = np.array(self._vectors[keep_rows])
+        chunks = [self.chunks[row] for row in keep_rows]
+        del self._vectors, self._alive
+        self._create_generation(self.generation + 1, capacity, vectors, np.ones(len(keep_rows), np.uint8), chunks)
+        self._open_files(mode='r+')
+        self.chunks = chunks
+        self._index_rows()
+
+    def has_document(self, document_hash: str) -> bool:
+        return document_hash in self.documents
+
+    def add(self, chunks: list[VectorChunk], vectors: np.ndarray):
+        with self._lock, self._file_lock(exclusive=True):
+            self._refresh()
+            # another worker may have indexed the same document in the meantime
+            new_rows = [index for index, chunk in enumerate(chunks) if chunk.document_hash not in self.documents]
+            chunks = [chunks[index] for index in new_rows]
+            vectors = vectors[new_rows]
+            if not chunks:
+                return
+
+            if self.count + len(chunks) > self.capacity:
+                capacity = self.capacity
+                while self.count + len(chunks) > capacity:
+                    capacity *= 2
+                # rewriting also drops the deleted rows
+                self._rewrite(capacity, np.flatnonzero(self._alive[:self.count]))
+
+            start = self.count
+            end = start + len(chunks)
+            self._vectors[start:end] = vectors
+            self._alive[start:end] = 1
+            self._vectors.flush()
+            self._alive.flush()
+            with open(self._path('chunks.{generation}.jsonl'), 'a', encoding='utf-8') as file:
+                for chunk in chunks:
+                    file.write(chunk.model_dump_json() + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+
+            self.chunks.extend(chunks)
+            for row, chunk in enumerate(chunks, start):
+                self.documents.setdefault(chunk.document_hash, []).append(row)
+                self.files[chunk.file_name] = chunk.document_hash
+            self.count = end
+            self._write_header()
+
+    def delete_document(self, document_hash: str):
+        with self._lock, self._file_lock(exclusive=True):
+            self._refresh()
+            rows = self.documents.pop(document_hash, None)
+            if not rows:
+                return
+            file_name = self.chunks[rows[0]].file_name
+            if self.files.get(file_name) == document_hash:
+                del self.files[file_name]
+            self._alive[rows] = 0
+            self._alive.flush()
+
+            live_rows = sum(len(rows) for rows in self.documents.values())
+            if self.count > INITIAL_CAPACITY and live_rows < self.count * (1 - COMPACT_DELETED_RATIO):
+                self._rewrite(self.capacity, np.flatnonzero(self._alive[:self.count]))
+            else:
+                # the other processes reload their row index
+                self._write_header()
+
+    def search(self, query_vector: np.ndarray, top_k: int,
+               exclude_hashes: set[str] | None = None) -> list[VectorSearchResult]:
+        """Top-k cosine similarity over the live rows, the query vector must be L2-normalized."""
+        with self._lock, self._file_lock(exclusive=False):
+            self._refresh()
+            if not self.count:
+                return []
+            scores = self._vectors[:self.count] @ query_vector.astype(np.float32)
+            scores[self._alive[:self.count] == 0] = -np.inf
+            for document_hash in exclude_hashes or ():
+                rows = self.documents.get(document_hash)
+                if rows:
+                    scores[rows] = -np.inf
+
+            top_k = min(top_k, self.count)
+            top_rows = np.argpartition(-scores, top_k - 1)[:top_k]
+            top_rows = top_rows[np.argsort(-scores[top_rows])]
+            return [VectorSearchResult(**self.chunks[row].model_dump(), score=float(scores[row]))
+                    for row in top_rows if scores[row] > -np.inf]
+
+    def stats(self) -> dict:
+        return {
+            "rows": self.count,
+            "capacity": self.capacity,
+            "documents": len(self.documents),
+            "live_rows": sum(len(rows) for rows in self.documents.values()),
+            "model_name": self.model_name,
+        }
+
+
+_open_stores: OrderedDict[str, UserVectorStore] = OrderedDict()
+_open_stores_lock = threading.Lock()
+
+
+def get_user_vector_store(user_id: str, model_name: str, dimension: int) -> UserVectorStore:
+    """Opens (or creates) the vector store of a user, the most recently used stores are kept open."""
+    with _open_stores_lock:
+        store = _open_stores.get(user_id)
+        if store is None or store.model_name != model_name or store.dimension != dimension:
+            directory = os.path.join(VECTOR_STORE_DIR, hashlib.sha256(user_id.encode('utf-8')).hexdigest()[:32])
+            store = UserVectorStore(directory, model_name, dimension)
+            _open_stores[user_id] = store
+        _open_stores.move_to_end(user_id)
+        while len(_open_stores) > VECTOR_STORE_OPEN_LIMIT:
+            _open_stores.popitem(last=False)
+        return store
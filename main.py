@@ -1,5 +1,6 @@
 import uvicorn
 import os
+import asyncio
 import dotenv
 
 # this is used to set up the environment variables
@@ -8,21 +9,61 @@ dotenv.load_dotenv(encoding='utf-8', override=True)
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import RedirectResponse
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
+from pymongo.errors import OperationFailure
 
 from routers.auth import auth_router
 from routers.agent import agent_router
 from routers.chat import chat_router
+from routers.stats import stats_router
+from routers.password_utils import shutdown_password_hashing
+from agent.ai_models import close_llm_clients
+from agent.response_cache import LLM_RESPONSE_CACHE_MONGO
+from routers.json_utils import FastJSONResponse
 from database.db import client, db
+from database.assistant_utils import watch_assistant_data_changes
+from database.usage_recorder import usage_recorder
+from database.migrate_assistant_names import dedupe_assistant_names
+
+
+async def ensure_index(collection, keys, **kwargs):
+    """Creates one index, a failure is reported and does not keep the other indexes from being created."""
+    try:
+        await collection.create_index(keys, **kwargs)
+    except Exception as e:
+        print(f"    Failed to create index {keys} on {collection.name}: {e}")
+
+
+async def ensure_unique_assistant_names():
+    """
+    The unique (user_id, assistant_name) index is the only check for duplicate assistant names,
+    so existing duplicates are renamed first, and the app does not start without the index.
+    """
+    keys = [("user_id", 1), ("assistant_name", 1)]
+    try:
+        await db.assistant_data.create_index(keys, unique=True)
+        return
+    except OperationFailure as e:
+        if e.code != 11000:
+            raise RuntimeError(f"Failed to create the unique assistant name index: {e}") from e
+        print("    Duplicate assistant names found, renaming them before creating the unique index")
+
+    await dedupe_assistant_names(db)
+    try:
+        await db.assistant_data.create_index(keys, unique=True)
+    except OperationFailure as e:
+        raise RuntimeError(f"Failed to create the unique assistant name index: {e}") from e
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # this will be run when start the app
+    mongodb_connected = False
     try:
         # check if the mongodb is connected
         await client.admin.command('ping')
         print('    MongoDB connected successfully!')
+        mongodb_connected = True
 
         # Ensure the database exists
         db_list = await client.list_database_names()
@@ -31,35 +72,80 @@ async def lifespan(app: FastAPI):
 
         # Check and initialize collections if they do not exist
         collections = await db.list_collection_names()
-        required_collections = ["app_statistics", "assistant_data", "user_profiles"]
+        required_collections = ["app_statistics", "assistant_data", "user_profiles",
+                                "llm_token_usage", "embedding_token_usage",
+                                "conversation_messages", "conversation_summaries"]
 
         for collection in required_collections:
             if collection not in collections:
                 await db.create_collection(collection)
                 print(f"    Created collection: {collection}")
-
-        # Check and insert initial document in app_statistics if it doesn't exist
-        app_stats_collection = db.app_statistics
-        existing_doc = await app_stats_collection.find_one({"name": "registration_count"})
-
-        if existing_doc is None:
-            initial_doc = {"name": "registration_count", "value": 0}
-            await app_stats_collection.insert_one(initial_doc)
-            print("    Inserted initial document in app_statistics: ", initial_doc)
     except Exception as e:
         print(f"    Failed to connect to MongoDB: {e}")
 
+    if mongodb_connected:
+        # assistant names are unique per user, raises and stops the startup when that can not be guaranteed
+        await ensure_unique_assistant_names()
+        # assistants are listed per user in _id order
+        await ensure_index(db.assistant_data, [("user_id", 1), ("_id", 1)])
+        await ensure_index(db.assistant_data, [("user_id", 1), ("assistant_id", 1)])
+
+        # conversations are stored per assistant
+        await ensure_index(db.conversation_messages, [("user_id", 1), ("assistant_id", 1), ("timestamp", 1)])
+        # messages logged before they were keyed have no prefix_hash, they are left out of the unique index
+        await ensure_index(db.conversation_messages, [("user_id", 1), ("assistant_id", 1), ("prefix_hash", 1)],
+                           unique=True, partialFilterExpression={"prefix_hash": {"$exists": True}})
+        await ensure_index(db.conversation_summaries, [("user_id", 1), ("assistant_id", 1)], unique=True)
+
+        # token usage is queried per user and time range
+        await ensure_index(db.llm_token_usage, [("user_id", 1), ("timestamp", 1)])
+        await ensure_index(db.embedding_token_usage, [("user_id", 1), ("timestamp", 1)])
+
+        # cached llm answers shared by the workers expire through a TTL index
+        if LLM_RESPONSE_CACHE_MONGO:
+            await ensure_index(db.llm_response_cache, "expires_at", expireAfterSeconds=0)
+
+        try:
+            # Check and insert initial document in app_statistics if it doesn't exist
+            app_stats_collection = db.app_statistics
+            existing_doc = await app_stats_collection.find_one({"name": "registration_count"})
+
+            if existing_doc is None:
+                initial_doc = {"name": "registration_count", "value": 0}
+                await app_stats_collection.insert_one(initial_doc)
+                print("    Inserted initial document in app_statistics: ", initial_doc)
+        except Exception as e:
+            print(f"    Failed to initialize app_statistics: {e}")
+
+    # optionally invalidate the assistant cache from a change stream when running several workers
+    assistant_watch_task = None
+    if os.getenv("ASSISTANT_CACHE_CHANGE_STREAM") == "true":
+        assistant_watch_task = asyncio.create_task(watch_assistant_data_changes())
+
+    # token usage is buffered and written to mongo in the background
+    usage_recorder.start()
+
     # yield the app (run the app)
     yield
 
     # this will be run when shutdown the app
+    if assistant_watch_task:
+        # wait for the watcher to close its change stream before the mongo client goes away
+        assistant_watch_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await assistant_watch_task
+    shutdown_password_hashing()
+    await close_llm_clients()
+    # write the token usage still buffered before the connection goes away
+    await usage_recorder.stop()
     print("    Shutting down MongoDB connection...")
 
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 app.include_router(auth_router)
 app.include_router(agent_router, prefix='/agent')
 app.include_router(chat_router, prefix='/chat')
+app.include_router(stats_router, prefix='/internal')
 
 origins = [
     "http://localhost",
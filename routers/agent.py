@@ -1,29 +1,107 @@
 import uuid
-from typing import Literal
-from fastapi import APIRouter, Depends, HTTPException, status
-from routers.auth_utils import get_jwt_payload, oauth2_bearer
+import hashlib
+from typing import Literal, Annotated
+from pydantic import BaseModel, Field
+from pymongo import ReturnDocument
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo.errors import DuplicateKeyError
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request, Response
+from routers.auth_utils import get_jwt_payload, oauth2_bearer, invalidate_user_profile
 from database.db import db
 from database.db_classes import AssistantData
+from database.assistant_utils import (
+    bump_assistant_list_version, fetch_assistant_list_version, invalidate_assistant_data)
 from agent.agent_classes import Reflections
 
 
 agent_router = APIRouter(tags=["Agent Assistant"])
 
 
+class RenameOperation(BaseModel):
+    op: Literal['rename']
+    assistant_name: str
+
+
+class SetLLMProviderOperation(BaseModel):
+    op: Literal['set_llm_provider']
+    llm_provider: Literal['qwen', 'deepseek-r1']
+
+
+class AddReflectionOperation(BaseModel):
+    op: Literal['add_reflection']
+    reflection_type: Literal['style_guidelines', 'general_facts']
+    reflection: str
+
+
+class RemoveReflectionOperation(BaseModel):
+    op: Literal['remove_reflection']
+    reflection_type: Literal['style_guidelines', 'general_facts']
+    reflection: str
+
+
+PatchOperation = Annotated[RenameOperation | SetLLMProviderOperation | AddReflectionOperation | RemoveReflectionOperation,
+                           Field(discriminator='op')]
+
+
+class AssistantPatchRequest(BaseModel):
+    assistant_id: str
+    # the version the client last read, the patch is rejected if the assistant has changed since
+    expected_version: int | None = None
+    operations: list[PatchOperation] = Field(min_length=1)
+
+
+def build_assistant_update(operations: list[PatchOperation]) -> dict:
+    """
+    Builds the minimal mongodb update for a list of patch operations.
+    Raises a 400 if two operations would write the same field in conflicting ways.
+    """
+    set_fields = {}
+    push_fields = {}
+    pull_fields = {}
+
+    for operation in operations:
+        if isinstance(operation, RenameOperation):
+            field, value = 'assistant_name', operation.assistant_name
+        elif isinstance(operation, SetLLMProviderOperation):
+            field, value = 'llm_provider', operation.llm_provider
+        else:
+            field, value = f'reflections.{operation.reflection_type}', operation.reflection
+
+        if isinstance(operation, AddReflectionOperation):
+            push_fields.setdefault(field, []).append(value)
+        elif isinstance(operation, RemoveReflectionOperation):
+            pull_fields.setdefault(field, []).append(value)
+        elif field in set_fields and set_fields[field] != value:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
+                                detail=f"Conflicting operations on {field}")
+        else:
+            set_fields[field] = value
+
+    # mongodb can not push to and pull from the same array in one update
+    conflicting_fields = set(push_fields) & set(pull_fields)
+    if conflicting_fields:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
+                            detail=f"Conflicting operations on {', '.join(sorted(conflicting_fields))}")
+
+    update = {"$inc": {"version": 1}}
+    if set_fields:
+        update["$set"] = set_fields
+    if push_fields:
+        update["$push"] = {field: {"$each": values} for field, values in push_fields.items()}
+    if pull_fields:
+        update["$pull"] = {field: {"$in": values} for field, values in pull_fields.items()}
+    return update
+
+
 @agent_router.post("/create")
 async def create_agent(assistant_name: str, 
                        llm_provider: str, 
                        jwt_token: str = Depends(oauth2_bearer)):
     payload = get_jwt_payload(jwt_token=jwt_token)
 
-    # 1. 检查用户是否存在
+    # 1. 创建助手, 助手名是否重复由 (user_id, assistant_name) 唯一索引检查
     user_id = payload['data']['user_id']
-    existing_assistants = await db.assistant_data.find({"user_id": user_id}).to_list(length=None)
-    if assistant_name in [assistant['assistant_name'] for assistant in existing_assistants]:
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
-                            detail="Assistant name already exists")
-    
-    # 2. 创建助手
     assistant_id = str(uuid.uuid4())
     assistant_data = AssistantData(
         user_id=user_id,
@@ -34,15 +112,23 @@ async def create_agent(assistant_name: str,
         custom_actions=None
     )
 
-    # 3. 保存助手
-    result = await db.assistant_data.insert_one(assistant_data.model_dump())
+    # 2. 保存助手
+    try:
+        result = await db.assistant_data.insert_one(assistant_data.model_dump())
+    except DuplicateKeyError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
+                            detail="Assistant name already exists")
     if result.inserted_id:
+        invalidate_assistant_data(user_id, assistant_id)
+        await bump_assistant_list_version(user_id)
+
         # 更新用户助手列表
         await db.user_profiles.update_one(
             {"user_id": user_id},
             {"$push": {"assistant_info_list": {"assistant_id": assistant_id, 
                                                "assistant_name": assistant_name}}}
         )
+        invalidate_user_profile(user_id)
 
         # 返回助手
         return {"messages": "Assistant created successfully",
@@ -64,17 +150,67 @@ async def delete_agent(assistant_id: str,
     if result.deleted_count == 0:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, 
                             detail="Assistant not found")
+    invalidate_assistant_data(user_id, assistant_id)
+    await bump_assistant_list_version(user_id)
     return {"messages": "Assistant deleted successfully"}
 
 
-@agent_router.get("/list")
-async def list_agents(jwt_token: str = Depends(oauth2_bearer)):
+@agent_router.get("/list",
+                  description="List the user's assistants. Pass `limit` to paginate, the cursor of the next page "
+                              "is returned in the `X-Next-Cursor` header. Pass `fields` to only return some fields. "
+                              "Send the returned `ETag` in `If-None-Match` to get a 304 when nothing changed.")
+async def list_agents(request: Request,
+                      response: Response,
+                      limit: int | None = Query(default=None, ge=1, le=100),
+                      cursor: str | None = None,
+                      fields: list[str] | None = Query(default=None),
+                      jwt_token: str = Depends(oauth2_bearer)):
     payload = get_jwt_payload(jwt_token=jwt_token)
     user_id = payload['data']['user_id']
-    assistants = await db.assistant_data.find({"user_id": user_id}).to_list(length=None)
+
+    if fields:
+        unknown_fields = set(fields) - set(AssistantData.model_fields)
+        if unknown_fields:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
+                                detail=f"Unknown fields: {', '.join(sorted(unknown_fields))}")
+
+    # 1. 用助手列表版本号生成 ETag, 没有变化时直接返回 304, 不读取助手数据
+    list_version = await fetch_assistant_list_version(user_id)
+    query_digest = hashlib.sha1(f"{user_id}|{limit}|{cursor}|{sorted(fields or [])}".encode()).hexdigest()[:16]
+    etag = f'"{list_version}-{query_digest}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+
+    # 2. 按 _id 分页读取
+    query = {"user_id": user_id}
+    if cursor:
+        try:
+            query["_id"] = {"$gt": ObjectId(cursor)}
+        except InvalidId:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
+                                detail="Invalid cursor")
+
+    projection = None
+    if fields:
+        projection = {field: 1 for field in fields}
+        projection["assistant_id"] = 1
+
+    documents_cursor = db.assistant_data.find(query, projection).sort("_id", 1)
+    if limit:
+        documents_cursor = documents_cursor.limit(limit + 1)
+    assistants = await documents_cursor.to_list(length=None)
+
+    if limit and len(assistants) > limit:
+        assistants = assistants[:limit]
+        response.headers["X-Next-Cursor"] = str(assistants[-1]["_id"])
+
     if not assistants:
         return []
-    
+
+    if fields:
+        return [{key: value for key, value in assistant.items() if key != "_id"} for assistant in assistants]
+
     assistants = [AssistantData(**assistant) for assistant in assistants]
 
     return assistants
@@ -87,12 +223,64 @@ async def update_agent(assistant_data: AssistantData,
     user_id = payload['data']['user_id']
     assistant_data.user_id = user_id
     assistant_id=assistant_data.assistant_id
-    result = await db.assistant_data.update_one({"assistant_id": assistant_id, "user_id": user_id}, 
-                                       {"$set": assistant_data.model_dump()})
+    try:
+        result = await db.assistant_data.update_one({"assistant_id": assistant_id, "user_id": user_id}, 
+                                           {"$set": assistant_data.model_dump(exclude={"version"}),
+                                            "$inc": {"version": 1}})
+    except DuplicateKeyError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
+                            detail="Assistant name already exists")
     if result.modified_count == 0:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
                             detail="Failed to update assistant, check assistant_id and user_id")
+    invalidate_assistant_data(user_id, assistant_id)
+    await bump_assistant_list_version(user_id)
     return {"messages": "Assistant updated successfully"}
 
 
+@agent_router.patch("/update",
+                    description="Update single fields of an assistant. Pass `expected_version` to reject the patch "
+                                "with a 409 if the assistant has been modified since the client read it.")
+async def patch_agent(patch_request: AssistantPatchRequest,
+                      jwt_token: str = Depends(oauth2_bearer)):
+    payload = get_jwt_payload(jwt_token=jwt_token)
+    user_id = payload['data']['user_id']
+    update = build_assistant_update(patch_request.operations)
+
+    query = {"assistant_id": patch_request.assistant_id, "user_id": user_id}
+    if patch_request.expected_version is not None:
+        if patch_request.expected_version == 0:
+            # assistants created before versioning have no version field
+            query["version"] = {"$in": [0, None]}
+        else:
+            query["version"] = patch_request.expected_version
+
+    try:
+        result = await db.assistant_data.find_one_and_update(query, update,
+                                                             projection={"_id": 0, "version": 1, "assistant_name": 1},
+                                                             return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, 
+                            detail="Assistant name already exists")
+
+    if result is None:
+        exists = await db.assistant_data.find_one({"assistant_id": patch_request.assistant_id, "user_id": user_id}, 
+                                                  {"_id": 1})
+        if not exists:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, 
+                                detail="Assistant not found")
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, 
+                            detail="Assistant has been modified, fetch it again and retry")
+
+    if "assistant_name" in update.get("$set", {}):
+        # 同步更新用户助手列表中的助手名
+        await db.user_profiles.update_one(
+            {"user_id": user_id, "assistant_info_list.assistant_id": patch_request.assistant_id},
+            {"$set": {"assistant_info_list.$.assistant_name": result["assistant_name"]}}
+        )
+        invalidate_user_profile(user_id)
 
+    invalidate_assistant_data(user_id, patch_request.assistant_id)
+    await bump_assistant_list_version(user_id)
+    return {"messages": "Assistant updated successfully",
+            "version": result["version"]}
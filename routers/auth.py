@@ -1,15 +1,15 @@
 from datetime import datetime, timedelta
 from fastapi.responses import JSONResponse
-from passlib.context import CryptContext
 from fastapi import APIRouter, status, HTTPException, Depends
 from fastapi.security import OAuth2PasswordRequestForm
 
 from database.db import db
-from database.db_classes import UserInfo
+from database.db_classes import UserInfo, UserSessionProfile
 from .id_utils import generate_user_id
+from .password_utils import hash_password, verify_password
 from .auth_utils import (
     RegisterRequest, fetch_user_profile, UserProfile, registration_counter,
-    create_jwt_token, validate_jwt_and_fetch_user_profile)
+    create_jwt_token, validate_jwt_and_fetch_user_profile, invalidate_user_profile)
 
 
 auth_router = APIRouter(tags=["User Authentication"])
@@ -17,8 +17,6 @@ auth_router = APIRouter(tags=["User Authentication"])
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 REFRESH_TOKEN_EXPIRE_DAYS = 1
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 
 # 注册用户
 @auth_router.post("/register",
@@ -27,7 +25,7 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
                   description="Register a new user with an email and a password")
 async def register_user(register_request: RegisterRequest):
     # 1. 检查邮箱是否已经注册
-    existing_user = await fetch_user_profile(identifier=register_request.email)
+    existing_user = await fetch_user_profile(identifier=register_request.email, profile_class=UserInfo)
     if existing_user:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="Email already registered")
@@ -37,7 +35,7 @@ async def register_user(register_request: RegisterRequest):
         user_id=generate_user_id(await registration_counter(db)),
         user_nickname=register_request.user_nickname,
         email=register_request.email,
-        hashed_password=pwd_context.hash(register_request.password),
+        hashed_password=await hash_password(register_request.password),
         created_at=datetime.now(),
         last_login=datetime.now()
     )
@@ -63,7 +61,7 @@ async def login_user(form_data: OAuth2PasswordRequestForm = Depends()):
     password = form_data.password
     user_profile = await fetch_user_profile(identifier=email)
 
-    if not user_profile or not pwd_context.verify(password, user_profile.hashed_password):
+    if not user_profile or not await verify_password(password, user_profile.hashed_password):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Incorrect email or password",
                             headers={"WWW-Authenticate": "Bearer"})
@@ -89,6 +87,7 @@ async def login_user(form_data: OAuth2PasswordRequestForm = Depends()):
         {"user_id": user_profile.user_id},
         {"$set": {"refresh_token": refresh_token, "last_login": datetime.now()}}
     )
+    invalidate_user_profile(user_profile.user_id)
 
     # 4. 返回token
     return JSONResponse(content={"messages": "Login successful",
@@ -108,7 +107,7 @@ async def login_user(form_data: OAuth2PasswordRequestForm = Depends()):
                  status_code=status.HTTP_200_OK,
                  summary="Refresh access token",
                  description="Refresh access token with refresh token")
-async def refresh_token(user_profile: UserProfile = Depends(validate_jwt_and_fetch_user_profile)):
+async def refresh_token(user_profile: UserSessionProfile = Depends(validate_jwt_and_fetch_user_profile)):
     new_access_token, access_expiration_time = create_jwt_token(data={"user_id": user_profile.user_id,
                                                                       "user_nickname": user_profile.user_nickname},
                                                                 expire_delta=timedelta(
@@ -125,11 +124,12 @@ async def refresh_token(user_profile: UserProfile = Depends(validate_jwt_and_fet
                   status_code=status.HTTP_200_OK,
                   summary="Logout",
                   description="Logout a user. Remember to remove tokens from client side")
-async def logout_user(user_profile: UserProfile = Depends(validate_jwt_and_fetch_user_profile)):
+async def logout_user(user_profile: UserSessionProfile = Depends(validate_jwt_and_fetch_user_profile)):
     await db.user_profiles.update_one(
         {"user_id": user_profile.user_id},
         {"$set": {"refresh_token": None}}
     )
+    invalidate_user_profile(user_profile.user_id)
     return JSONResponse(content={"message": "Logout successful"})
 
 
@@ -138,7 +138,7 @@ async def logout_user(user_profile: UserProfile = Depends(validate_jwt_and_fetch
                  status_code=status.HTTP_200_OK,
                  summary="Get user information",
                  description="Get user information")
-async def get_user_info(user_profile: UserProfile = Depends(validate_jwt_and_fetch_user_profile)):
+async def get_user_info(user_profile: UserSessionProfile = Depends(validate_jwt_and_fetch_user_profile)):
     return JSONResponse(content={"user_id": user_profile.user_id,
                                  "user_nickname": user_profile.user_nickname,
                                  "email": user_profile.email,
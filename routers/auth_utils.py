@@ -1,4 +1,6 @@
 import os
+import asyncio
+import hashlib
 from fastapi import Depends, HTTPException
 from jose import jwt, JWTError
 from datetime import datetime, timedelta
@@ -7,13 +9,28 @@ from fastapi.security import OAuth2PasswordBearer
 from fastapi import status
 from motor.motor_asyncio import AsyncIOMotorDatabase
 
-from database.db_classes import UserProfile
+from database.db_classes import UserProfile, UserSessionProfile
 from database.db import db
+from database.cache import TTLCache, ExpiringCache
 
 
 SECRET_KEY = os.getenv("JWT_SECRET_KEY")
 ALGORITHM = "HS256"
 
+USER_PROFILE_CACHE_SIZE = int(os.getenv("USER_PROFILE_CACHE_SIZE", 1024))
+USER_PROFILE_CACHE_TTL_SECONDS = float(os.getenv("USER_PROFILE_CACHE_TTL_SECONDS", 60))
+
+# user_id -> UserSessionProfile, used by validate_jwt_and_fetch_user_profile
+user_profile_cache = TTLCache(maxsize=USER_PROFILE_CACHE_SIZE, ttl=USER_PROFILE_CACHE_TTL_SECONDS)
+
+VERIFIED_TOKEN_CACHE_SIZE = int(os.getenv("VERIFIED_TOKEN_CACHE_SIZE", 4096))
+
+# sha256(jwt_token) -> verified payload, kept until the token's exp
+verified_token_cache = ExpiringCache(maxsize=VERIFIED_TOKEN_CACHE_SIZE)
+
+# how many registration numbers a worker reserves from app_statistics at once
+REGISTRATION_BLOCK_SIZE = int(os.getenv("REGISTRATION_BLOCK_SIZE", 20))
+
 oauth2_bearer = OAuth2PasswordBearer(tokenUrl="login")
 
 
@@ -30,28 +47,81 @@ class JWTPayload(BaseModel):
     is_refresh: bool
 
 
-async def fetch_user_profile(identifier: str):
+async def fetch_user_profile(identifier: str, profile_class: type[BaseModel] = UserProfile):
+    # only fetch the fields of profile_class, so each endpoint reads as little of the document as it needs
+    projection = {field: 1 for field in profile_class.model_fields}
+    projection['_id'] = 0
+
     query = {"$or": [{"email": identifier}, {"user_id": identifier}]}
-    document = await db.user_profiles.find_one(query)
+    document = await db.user_profiles.find_one(query, projection)
     if document:
-        return UserProfile(**document)
+        return profile_class(**document)
     else:
         return None
 
-# Get the next registration counts
 
+async def fetch_cached_user_profile(user_id: str):
+    user_profile = user_profile_cache.get(user_id)
+    if user_profile is not None:
+        return user_profile
+
+    generation = user_profile_cache.generation
+    user_profile = await fetch_user_profile(identifier=user_id, profile_class=UserSessionProfile)
+    if user_profile is not None:
+        user_profile_cache.set(user_id, user_profile, generation=generation)
+    return user_profile
+
+
+def invalidate_user_profile(user_id: str):
+    """Must be called after every write to the user's profile document."""
+    user_profile_cache.invalidate(user_id)
+
+
+def get_user_profile_cache_stats():
+    return user_profile_cache.stats()
+
+
+class RegistrationNumberAllocator:
+    """
+    hi/lo allocator for registration numbers: one atomic $inc on the registration_count
+    document reserves a whole block, and the numbers in the block are handed out locally.
+    Numbers left in a block when the worker stops are never used, so user ids may have gaps.
+    """
+
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self._next_number = 1
+        self._last_number = 0  # the block is empty until the first reservation
+        self._lock = asyncio.Lock()
 
+    async def _reserve_block(self, db: AsyncIOMotorDatabase):
+        counter_doc = await db.app_statistics.find_one_and_update(
+            {'name': 'registration_count'},
+            {'$inc': {'value': self.block_size}},
+            return_document=True
+        )
+
+        if counter_doc is None:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to get registration count")
+
+        self._last_number = counter_doc['value']
+        self._next_number = self._last_number - self.block_size + 1
+
+    async def next_number(self, db: AsyncIOMotorDatabase):
+        async with self._lock:
+            if self._next_number > self._last_number:
+                await self._reserve_block(db)
+            number = self._next_number
+            self._next_number += 1
+            return number
+
+
+registration_number_allocator = RegistrationNumberAllocator(block_size=REGISTRATION_BLOCK_SIZE)
+
+
+# Get the next registration counts
 async def registration_counter(db: AsyncIOMotorDatabase):
-    counter_doc = await db.app_statistics.find_one_and_update(
-        {'name': 'registration_count'},
-        {'$inc': {'value': 1}},
-        return_document=True
-    )
-    
-    if counter_doc is None:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to get registration count")
-    
-    return counter_doc['value']
+    return await registration_number_allocator.next_number(db)
 
 
 def create_jwt_token(data: dict, expire_delta: timedelta, is_refresh: bool = False):
@@ -70,6 +140,12 @@ def create_jwt_token(data: dict, expire_delta: timedelta, is_refresh: bool = Fal
     
     
 def get_jwt_payload(jwt_token: str):
+    # tokens that have been verified before skip the HMAC check and claim parsing
+    token_digest = hashlib.sha256(jwt_token.encode()).digest()
+    payload = verified_token_cache.get(token_digest)
+    if payload is not None:
+        return payload
+
     try:
         # validate jwt_token
         payload = jwt.decode(jwt_token, key=SECRET_KEY, algorithms=[ALGORITHM])
@@ -89,6 +165,7 @@ def get_jwt_payload(jwt_token: str):
                 detail='No user_id provided',
                 headers={"WWW-Authenticate": "Bearer"})
         else:
+            verified_token_cache.set(token_digest, payload, expires_at=payload['exp'])
             return payload
     except JWTError:
         raise HTTPException(
@@ -97,11 +174,20 @@ def get_jwt_payload(jwt_token: str):
             headers={"WWW-Authenticate": "Bearer"})
 
 
+def get_verified_token_cache_stats():
+    return verified_token_cache.stats()
+
+
 async def validate_jwt_and_fetch_user_profile(jwt_token: str = Depends(oauth2_bearer)):
     payload = get_jwt_payload(jwt_token)
 
-    # fetch user profile
-    user_profile = await fetch_user_profile(identifier=payload['data']['user_id'])
+    # fetch user profile, a refresh token can be revoked by another worker (logout, a new login),
+    # so it is always checked against mongo instead of the cached profile
+    user_id = payload['data']['user_id']
+    if payload['is_refresh']:
+        user_profile = await fetch_user_profile(identifier=user_id, profile_class=UserSessionProfile)
+    else:
+        user_profile = await fetch_cached_user_profile(user_id=user_id)
 
     # validate user profile
     if user_profile is None:
@@ -1,17 +1,22 @@
 import asyncio
 import json
+from typing import Literal
+from contextlib import suppress
 from pydantic import BaseModel
 
 from fastapi import APIRouter, Depends, HTTPException, status, WebSocket, WebSocketDisconnect
-from langchain_core.messages import HumanMessage, AnyMessage, AIMessage, AIMessageChunk
+from fastapi.responses import StreamingResponse
 
-from routers.chat_utils import run_graph_and_stream
-from agent.agent_classes import Article, Reflections, HighlightData
+from routers.chat_utils import close_reason, run_graph_and_stream, run_graph_and_stream_http
+from routers.history_utils import prepare_conversation_messages
+from routers.document_store import ArticleRef, DocumentNotFoundError, resolve_articles
+from routers.ws_codec import FrameTooLargeError, WebSocketCodec, negotiate_codec
+from agent.agent_classes import Article, HighlightData
 from agent.editor.state import EditorGraphState
 from agent.editor.graph import editor_graph
+from agent.document_search import schedule_document_indexing
 from routers.auth_utils import get_jwt_payload, oauth2_bearer
-from database.db import db
-from database.db_classes import AssistantData
+from database.assistant_utils import fetch_assistant_data
 
 
 chat_router = APIRouter(tags=["Chat with Agent Assistant"])
@@ -20,9 +25,10 @@ class ChatRequest(BaseModel):
     assistant_id: str
     messages: list[dict]
     highlight_data: HighlightData
-    article: Article
-    other_articles: list[Article]
-    reference_articles: list[Article]
+    # each article is either sent in full, or as a reference to a document sent before, see routers/document_store.py
+    article: Article | ArticleRef
+    other_articles: list[Article | ArticleRef]
+    reference_articles: list[Article | ArticleRef]
     config: dict
 
 
@@ -40,47 +46,57 @@ class StreamRequest(BaseModel):
     assistant_id: str
     messages: list[dict]
     highlight_data: HighlightData
-    article: Article
-    other_articles: list[Article]
-    reference_articles: list[Article]
+    # each article is either sent in full, or as a reference to a document sent before, see routers/document_store.py
+    article: Article | ArticleRef
+    other_articles: list[Article | ArticleRef]
+    reference_articles: list[Article | ArticleRef]
     config: dict
     
 
+async def create_initial_state(user_id: str, request: ChatRequest | StreamRequest):
+    # Get the assistant data for the user.
+    assistant_data = await fetch_assistant_data(user_id=user_id, assistant_id=request.assistant_id)
+    if not assistant_data:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, 
+                            detail="Assistant not found")
+
+    # Resolve the articles sent as references to earlier documents, in one call so every missing one is reported.
+    articles = resolve_articles(user_id, [request.article] + request.other_articles + request.reference_articles)
+    article = articles[0]
+    other_articles = articles[1:1 + len(request.other_articles)]
+    reference_articles = articles[1 + len(request.other_articles):]
+    # index the articles for vector search in the background (only when VECTOR_INDEX_ENABLED)
+    schedule_document_indexing(user_id, articles)
+
+    # Convert the messages to Langchain messages, older messages are replaced by the conversation summary.
+    lang_messages = await prepare_conversation_messages(user_id=user_id, 
+                                                        assistant_id=request.assistant_id, 
+                                                        messages=request.messages)
+
+    return EditorGraphState(messages=lang_messages, 
+                            assistant_data=assistant_data,
+                            article=article,
+                            highlight_data=request.highlight_data,
+                            other_articles=other_articles,
+                            reference_articles=reference_articles)
+
+
 @chat_router.post("/completion")
 async def chat_with_agent(chat_request: ChatRequest,
                           jwt_token: str = Depends(oauth2_bearer)):
     payload = get_jwt_payload(jwt_token=jwt_token)
-    # Get the assistant data for the user.
     user_id = payload['data']['user_id']
-    assistant_data = await db.assistant_data.find_one({"assistant_id": chat_request.assistant_id, "user_id": user_id})
-    if not assistant_data:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, 
-                            detail="Assistant not found")
-    assistant_data = AssistantData(**assistant_data)
-
-    # Convert the messages to a list of Langchain messages.
-    lang_messages = []
-    for msg in chat_request.messages:
-        if msg['role'] == 'user':
-            lang_messages.append(HumanMessage(content=msg['content']))
-        elif msg['role'] == 'assistant':
-            lang_messages.append(AIMessage(content=msg['content']))
-
-    initial_state = EditorGraphState(messages=lang_messages, 
-                                     assistant_data=assistant_data,
-                                     article=chat_request.article,
-                                     highlight_data=chat_request.highlight_data,
-                                     other_articles=chat_request.other_articles,
-                                     reference_articles=chat_request.reference_articles)
+    initial_state = await create_initial_state(user_id=user_id, request=chat_request)
     
-    all_states = []
+    # only the final state is needed for the response
+    final_state = None
     async for output in editor_graph.astream(initial_state, stream_mode="values"):
-        all_states.append(output)
+        final_state = output
 
-    response_content = all_states[-1]['messages'][-1].content
-    think_content = all_states[-1]['think_content'] if 'think_content' in all_states[-1] else ''
-    edited_article = all_states[-1]['edited_article'] if 'edited_article' in all_states[-1] else ''
-    edited_article_related_to = all_states[-1]['edited_article_related_to'] if 'edited_article_related_to' in all_states[-1] else ''
+    response_content = final_state['messages'][-1].content
+    think_content = final_state['think_content'] if 'think_content' in final_state else ''
+    edited_article = final_state['edited_article'] if 'edited_article' in final_state else ''
+    edited_article_related_to = final_state['edited_article_related_to'] if 'edited_article_related_to' in final_state else ''
     
     return ChatResponse(assistant_id=chat_request.assistant_id,
                                 role="assistant",
@@ -91,30 +107,54 @@ async def chat_with_agent(chat_request: ChatRequest,
                                 other_data={})
 
 
+@chat_router.post("/completion/stream",
+                  description="Same as `/completion`, but streams the chunks of `/stream` over HTTP, "
+                              "as server-sent events (`format=sse`) or newline delimited JSON (`format=ndjson`). "
+                              "The stream always ends with a `stream_end` chunk.")
+async def stream_chat_with_agent(chat_request: ChatRequest,
+                                 format: Literal['sse', 'ndjson'] = 'sse',
+                                 jwt_token: str = Depends(oauth2_bearer)):
+    payload = get_jwt_payload(jwt_token=jwt_token)
+    user_id = payload['data']['user_id']
+    initial_state = await create_initial_state(user_id=user_id, request=chat_request)
 
-async def process_stream_request(user_id: str, stream_request: StreamRequest, websocket: WebSocket):
-    assistant_data = await db.assistant_data.find_one({"assistant_id": stream_request.assistant_id, "user_id": user_id})
-    if not assistant_data:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, 
-                            detail="Assistant not found")
-    assistant_data = AssistantData(**assistant_data)
-    
-    # Convert the messages to a list of Langchain messages.
-    lang_messages = []
-    for msg in stream_request.messages:
-        if msg['role'] == 'user':
-            lang_messages.append(HumanMessage(content=msg['content']))
-        elif msg['role'] == 'assistant':
-            lang_messages.append(AIMessage(content=msg['content']))
-
-    initial_state = EditorGraphState(messages=lang_messages, 
-                                     assistant_data=assistant_data,
-                                     article=stream_request.article,
-                                     highlight_data=stream_request.highlight_data,
-                                     other_articles=stream_request.other_articles,
-                                     reference_articles=stream_request.reference_articles)
+    media_type = 'text/event-stream' if format == 'sse' else 'application/x-ndjson'
+    return StreamingResponse(run_graph_and_stream_http(initial_state, stream_format=format),
+                             media_type=media_type,
+                             # disable proxy buffering (nginx) so chunks reach the client immediately
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def process_stream_request(user_id: str, stream_request: StreamRequest, websocket: WebSocket, codec: WebSocketCodec):
+    initial_state = await create_initial_state(user_id=user_id, request=stream_request)
     
-    await run_graph_and_stream(initial_state, websocket)
+    await run_graph_and_stream(initial_state, websocket, codec)
+
+
+async def run_stream_task(user_id: str, stream_request: StreamRequest, websocket: WebSocket, codec: WebSocketCodec):
+    # runs as a background task next to the receive loop, so errors are handled here
+    try:
+        await process_stream_request(user_id=user_id, stream_request=stream_request, websocket=websocket, codec=codec)
+    except DocumentNotFoundError as e:
+        # the connection stays open, the client resends the request with the full documents
+        await codec.send(websocket, {"type": "document_missing",
+                                     "assistant_id": stream_request.assistant_id,
+                                     "content_hashes": e.content_hashes})
+    except HTTPException as e:
+        with suppress(Exception):
+            await websocket.close(code=4003, reason=close_reason(str(e.detail)))
+    except Exception as e:
+        with suppress(Exception):
+            await websocket.close(code=1011, reason=close_reason(str(e)))
+
+
+async def cancel_generation(generation_task: asyncio.Task | None, reason: str):
+    if generation_task is None or generation_task.done():
+        return
+    print(f"    Cancelling generation: {reason}")
+    generation_task.cancel()
+    with suppress(asyncio.CancelledError, Exception):
+        await generation_task
 
 
 @chat_router.websocket("/stream")
@@ -129,8 +169,16 @@ async def stream_chat(websocket: WebSocket):
     2. Send messages in JSON format.
     3. Receive messages in JSON format.
     4. After websocket is opened, the client should send a message with type `auth` and token in the message body.
-    5. After authentication, the client can send `stream_request` message to start a new stream.
-    6. After the stream is started, the client can send `stream_stop` message to stop the stream. (under development)
+       The auth message may list `encodings` in order of preference (`msgpack+zstd`, `msgpack`, `json`),
+       the server replies with the chosen `encoding`, which is used for all later messages, see routers/ws_codec.py.
+    5. After authentication, the client can send `stream` message to start a new stream.
+    6. While a stream is running, the client can send `stream_stop` to cancel it, the server then sends `stream_end`
+       and the connection stays open. A new `stream` message or a disconnect also cancels the running stream.
+    7. Articles the server has received before can be sent as references (`content_hash`, optionally with
+       `base_hash` and `line_edits`). If the server no longer has them, it replies with `document_missing`
+       listing the `content_hashes` to send in full.
+    8. When the generation fails, e.g. the language model is unavailable or busy, the server sends `error`
+       with `status_code`, `detail` and `retry_after`, followed by `stream_end`, and the connection stays open.
 
     """
     try:
@@ -148,9 +196,11 @@ async def stream_chat(websocket: WebSocket):
                     # 验证jwt token, 若成功，获取user_id
                     payload = get_jwt_payload(jwt_token=jwt_token)
                     user_id = payload['data']['user_id']
-                    await websocket.send_json({"type": "auth", "user_id": user_id})
+                    # 协商之后消息的编码, 认证回复本身仍是JSON
+                    codec = negotiate_codec(auth_data.get("encodings"))
+                    await websocket.send_json({"type": "auth", "user_id": user_id, "encoding": codec.encoding})
                 except HTTPException as e:
-                    await websocket.close(code=4003, reason=e.detail)
+                    await websocket.close(code=4003, reason=close_reason(str(e.detail)))
                     return
             else:
                 await websocket.close(code=4003, reason="Authentication message required")
@@ -166,37 +216,49 @@ async def stream_chat(websocket: WebSocket):
             return
         
         # websocket 主循环
-        while True:
-            try:
-                data = await asyncio.wait_for(websocket.receive_json(), timeout=45)  # 等待45秒
-                if data.get('type') == 'quit':
-                    break
-                elif data.get('type') == 'stream':
-                    stream_request = StreamRequest(**data)
-                    # 处理stream请求
-                    await process_stream_request(user_id=user_id, stream_request=stream_request, websocket=websocket)
-                elif data.get('type') == 'stream_stop':
-                    break
-                elif data.get('type') == 'ping':
-                    # 收到ping消息，返回pong，用于保持连接。客户端每30秒发送一次ping消息
-                    await websocket.send_json({'type': 'pong'})
-
-            except HTTPException as e:
-                await websocket.close(code=4003, reason=e.detail)
-                return
-            except asyncio.TimeoutError:
-                await websocket.close(code=1000, reason="Stream timed out")
-                return
-            except Exception as e:
-                await websocket.close(code=1000, reason=str(e))
-                return
-            
-        await websocket.close(code=1000, reason="Client disconnected")
+        # 生成在后台任务中运行, 主循环持续读取消息, 因此 stream_stop、新的请求或断开连接都能立即取消正在进行的生成
+        generation_task = None
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(codec.receive(websocket), timeout=45)  # 等待45秒
+                    if data.get('type') == 'quit':
+                        break
+                    elif data.get('type') == 'stream':
+                        stream_request = StreamRequest(**data)
+                        # 处理stream请求, 同一连接上只保留最新的生成
+                        await cancel_generation(generation_task, reason="new stream request")
+                        generation_task = asyncio.create_task(
+                            run_stream_task(user_id=user_id, stream_request=stream_request, websocket=websocket, codec=codec))
+                    elif data.get('type') == 'stream_stop':
+                        await cancel_generation(generation_task, reason="stream_stop")
+                        generation_task = None
+                    elif data.get('type') == 'ping':
+                        # 收到ping消息，返回pong，用于保持连接。客户端每30秒发送一次ping消息
+                        await codec.send(websocket, {'type': 'pong'})
+
+                except WebSocketDisconnect:
+                    return
+                except FrameTooLargeError as e:
+                    await websocket.close(code=1009, reason=close_reason(str(e.detail)))
+                    return
+                except HTTPException as e:
+                    await websocket.close(code=4003, reason=close_reason(str(e.detail)))
+                    return
+                except asyncio.TimeoutError:
+                    await websocket.close(code=1000, reason="Stream timed out")
+                    return
+                except Exception as e:
+                    await websocket.close(code=1011, reason=close_reason(str(e)))
+                    return
+                
+            await websocket.close(code=1000, reason="Client disconnected")
+        finally:
+            await cancel_generation(generation_task, reason="connection closed")
             
-    except Exception as e:
-        await websocket.close(code=1000, reason=str(e))
-        return
     except WebSocketDisconnect:
         return
-
-
+    except Exception as e:
+        with suppress(Exception):
+            await websocket.close(code=1011, reason=close_reason(str(e)))
+        return
@@ -1,10 +1,29 @@
-import json
+import os
 import re
-from fastapi import WebSocket
+import time
+import asyncio
+from collections import deque
+from contextlib import aclosing, suppress
+from typing import AsyncIterator, Literal
+from fastapi import HTTPException, WebSocket
 from pydantic import BaseModel
 from langchain_core.messages import AIMessageChunk
 from agent.editor.graph import editor_graph
 from agent.editor.state import EditorGraphState
+from agent.editor.context_packer import estimate_tokens
+from routers.json_utils import json_dumps
+from routers.ws_codec import WebSocketCodec, json_codec
+
+
+# stream chunks are coalesced into one frame until this much time has passed or this many bytes are pending,
+# set both to 0 to send one frame per llm chunk
+STREAM_FLUSH_INTERVAL_MS = float(os.getenv("STREAM_FLUSH_INTERVAL_MS", 50))
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES", 1024))
+# the tokens saved by a cancelled generation are estimated as the average length of the recent completed answers
+# minus what was already streamed, this length is used until enough answers completed
+GENERATION_EXPECTED_OUTPUT_TOKENS = int(os.getenv("GENERATION_EXPECTED_OUTPUT_TOKENS", 1000))
+GENERATION_MIN_SAMPLES = 20
+GENERATION_OUTPUT_WINDOW = 500
 
 class StreamResponse(BaseModel):
     type: str
@@ -19,135 +38,373 @@ class StreamResponse(BaseModel):
 
 
 
-def process_text_chunk(text_chunk, target_tags, default_content, tag_contents, current_tag, chunk_leftover):
-    while text_chunk:
-            bracket_match = re.search(r'<([^<>]*)>', text_chunk)
-            if bracket_match:
-                text_inside_bracket = bracket_match.group(1)
-
-                if current_tag:
-                    if text_inside_bracket == f"/{current_tag}":
-                        # 如果有current_tag, 且text_inside_bracket是current_tag的close tag
-                        tag_contents[current_tag] += text_chunk[:bracket_match.start()]
-                        text_chunk = text_chunk[bracket_match.end():]
-                        current_tag = None
-                    else:
-                        # 如果有current_tag, 且text_inside_bracket不是current_tag的close tag
-                        tag_contents[current_tag] += text_chunk[:bracket_match.end()]
-                        text_chunk = text_chunk[bracket_match.end():]
-                elif text_inside_bracket in target_tags:
-                    # find if there's a new open tag in the chunk
-                    default_content += text_chunk[:bracket_match.start()]
-                    text_chunk = text_chunk[bracket_match.end():]
-                    current_tag = text_inside_bracket
-
-                    # handle edited content tag specifically
-                    if text_inside_bracket == 'edited_content':
-                        default_content += f"<edited_content></edited_content>"
-                else:
-                    default_content += text_chunk[:bracket_match.end()]
-                    text_chunk = text_chunk[bracket_match.end():]
-            
+_BRACKET_DELIMITER = re.compile(r'[<>]')
+
+
+class TagStreamParser:
+    """
+    Incremental parser that splits a stream of text chunks into the text outside of the target tags
+    and the text inside each target tag, e.g. `<think>...</think>`.
+
+    Every character is scanned once: plain text is copied up to the next `<`, and an unfinished `<...`
+    at the end of a chunk is kept until the next chunk completes it. An unfinished bracket longer than
+    the longest closing tag can not become a target tag, so it is released as plain text.
+    Tags in `placeholder_tags` leave an empty `<tag></tag>` in the default content where they were opened.
+    """
+
+    def __init__(self, target_tags: list[str], placeholder_tags: list[str] | None = None):
+        self.target_tags = set(target_tags)
+        self.placeholder_tags = set(placeholder_tags or [])
+        self.current_tag = None
+
+        self._default_content = []
+        self._tag_contents = {tag: [] for tag in target_tags}
+        # the unfinished bracket, starting with '<'
+        self._bracket = []
+        self._bracket_length = 0
+        # the longest bracket content that can still be a target tag, +1 for the '/' of a close tag
+        self._max_bracket_length = max(len(tag) for tag in target_tags) + 1
+
+    def _output(self):
+        if self.current_tag:
+            return self._tag_contents[self.current_tag]
+        return self._default_content
+
+    def _handle_bracket(self, bracket: str):
+        text_inside_bracket = bracket[1:-1]
+        if self.current_tag:
+            if text_inside_bracket == f"/{self.current_tag}":
+                self.current_tag = None
             else:
-                # no bracket match
-                unfinished_bracket_match = re.search(r'<([^<>]*)$', text_chunk)
-                if unfinished_bracket_match and len(unfinished_bracket_match.group(1)) <= (max(len(tag) for tag in target_tags) + 1):
-                    chunk_leftover = text_chunk[unfinished_bracket_match.start():]
-                    if current_tag:
-                        tag_contents[current_tag] += text_chunk[:unfinished_bracket_match.start()]
-                    else:
-                        default_content += text_chunk[:unfinished_bracket_match.start()]
-                    text_chunk = ''
-                else:
-                    if current_tag:
-                        tag_contents[current_tag] += text_chunk
-                    else:
-                        default_content += text_chunk
-                    text_chunk = ''
-    return default_content, tag_contents, current_tag, chunk_leftover
-
-
-async def run_graph_and_stream(current_state, websocket: WebSocket):
-    data_to_send = StreamResponse(type='stream',
-                                assistant_id=current_state.assistant_data.assistant_id,
-                                assistant_status='thinking',
-                                role='assistant',
-                                content_chunk='',
-                                think_content_chunk='',
-                                edited_article_chunk='',
-                                edited_article_related_to=current_state.article.file_name,
-                                other_data={})
-    await websocket.send_json(data_to_send.model_dump())
+                self._tag_contents[self.current_tag].append(bracket)
+        elif text_inside_bracket in self.target_tags:
+            self.current_tag = text_inside_bracket
+            if text_inside_bracket in self.placeholder_tags:
+                self._default_content.append(f"<{text_inside_bracket}></{text_inside_bracket}>")
+        else:
+            self._default_content.append(bracket)
+
+    def feed(self, text_chunk: str):
+        position = 0
+        length = len(text_chunk)
+        while position < length:
+            if not self._bracket:
+                # outside of a bracket, copy the text up to the next '<'
+                bracket_start = text_chunk.find('<', position)
+                if bracket_start == -1:
+                    self._output().append(text_chunk[position:])
+                    return
+                if bracket_start > position:
+                    self._output().append(text_chunk[position:bracket_start])
+                self._bracket = ['<']
+                self._bracket_length = 0
+                position = bracket_start + 1
+                continue
+
+            # inside a bracket, look for the '>' that closes it, or a '<' that restarts it
+            delimiter = _BRACKET_DELIMITER.search(text_chunk, position)
+            if delimiter is None:
+                self._bracket.append(text_chunk[position:])
+                self._bracket_length += length - position
+                break
+
+            end = delimiter.start()
+            self._bracket.append(text_chunk[position:end])
+            self._bracket_length += end - position
+            if delimiter.group() == '>':
+                self._bracket.append('>')
+                bracket = ''.join(self._bracket)
+                self._bracket = []
+                self._handle_bracket(bracket)
+                position = end + 1
+            else:
+                # the previous '<' was plain text
+                self._output().append(''.join(self._bracket))
+                self._bracket = ['<']
+                self._bracket_length = 0
+                position = end + 1
+
+        if self._bracket and self._bracket_length > self._max_bracket_length:
+            # too long to be a target tag
+            self._output().append(''.join(self._bracket))
+            self._bracket = []
+
+    def flush(self):
+        """Releases an unfinished bracket as plain text, call it when the stream ends."""
+        if self._bracket:
+            self._output().append(''.join(self._bracket))
+            self._bracket = []
+
+    def take(self) -> tuple[str, dict[str, str]]:
+        """Returns the default content and tag contents parsed since the last call."""
+        default_content = ''.join(self._default_content)
+        tag_contents = {tag: ''.join(contents) for tag, contents in self._tag_contents.items()}
+        self._default_content.clear()
+        for contents in self._tag_contents.values():
+            contents.clear()
+        return default_content, tag_contents
+
+
+_output_tokens: deque[int] = deque(maxlen=GENERATION_OUTPUT_WINDOW)
+_generation_stats = {"completed": 0, "cancelled": 0, "cancelled_streamed_tokens": 0, "tokens_saved": 0}
+
+
+def expected_output_tokens() -> int:
+    if len(_output_tokens) < GENERATION_MIN_SAMPLES:
+        return GENERATION_EXPECTED_OUTPUT_TOKENS
+    return round(sum(_output_tokens) / len(_output_tokens))
+
+
+def get_generation_stats() -> dict:
+    return {**_generation_stats, "expected_output_tokens": expected_output_tokens()}
+
+
+def stream_end_response(current_state: EditorGraphState):
+    return StreamResponse(type='stream_end',
+                        assistant_id=current_state.assistant_data.assistant_id,
+                        assistant_status='thinking',
+                        role='assistant',
+                        content_chunk='',
+                        think_content_chunk='',
+                        edited_article_chunk='',
+                        edited_article_related_to=current_state.article.file_name,
+                        other_data={})
+
+
+async def stream_graph_responses(current_state: EditorGraphState) -> AsyncIterator[StreamResponse]:
+    """
+    Runs the editor graph and yields the `stream` chunks sent to the client, independent of the transport.
+    The caller is responsible for sending the final `stream_end` chunk, see `stream_end_response`.
+    """
+    yield StreamResponse(type='stream',
+                        assistant_id=current_state.assistant_data.assistant_id,
+                        assistant_status='thinking',
+                        role='assistant',
+                        content_chunk='',
+                        think_content_chunk='',
+                        edited_article_chunk='',
+                        edited_article_related_to=current_state.article.file_name,
+                        other_data={})
+
+    parser = TagStreamParser(target_tags=['think', 'edited_content'], placeholder_tags=['edited_content'])
+
+    started_at = time.perf_counter()
+    llm_chunks = 0
+    # the llm output streamed so far, to estimate its tokens once the generation ends
+    streamed_text = []
 
     try:
-        target_tags = ['think', 'edited_content']
-        default_content = ""
-        tag_contents = {tag: "" for tag in target_tags}  # Initialize buffers for target tags
-        current_tag = None
-        chunk_leftover = ''
-
-        async for event, chunk in editor_graph.astream(current_state, stream_mode=["messages", "values"]):
-            if event == 'values':
-                current_state = EditorGraphState(**chunk)
-
-            if event == 'messages' and isinstance(chunk[0], AIMessageChunk):
-                # prepare the text chunk
-                text_chunk = chunk_leftover + chunk[0].content
-                chunk_leftover = ''
-
-                # process the text chunk
-                (default_content, 
-                    tag_contents, 
-                    current_tag, 
-                    chunk_leftover) = process_text_chunk(text_chunk=text_chunk, 
-                                                        target_tags=target_tags, 
-                                                        default_content=default_content, 
-                                                        tag_contents=tag_contents, 
-                                                        current_tag=current_tag, 
-                                                        chunk_leftover=chunk_leftover)
-                
-                # send the default content and tag contents here
-                data_to_send = StreamResponse(type='stream',
-                                            assistant_id=current_state.assistant_data.assistant_id,
-                                            assistant_status='thinking',
-                                            role='assistant',
-                                            content_chunk=default_content,
-                                            think_content_chunk=tag_contents['think'],
-                                            edited_article_chunk=tag_contents['edited_content'],
-                                            edited_article_related_to=current_state.article.file_name,
-                                            other_data={})
-                await websocket.send_json(data_to_send.model_dump())
-                default_content = ''
-                tag_contents['think'] = ''
-                tag_contents['edited_content'] = ''
-                
-        # finally handle the leftover chunk
-        if current_tag:
-            tag_contents[current_tag] += chunk_leftover
-        else:
-            default_content += chunk_leftover
-        
-        data_to_send = StreamResponse(type='stream',
-                                    assistant_id=current_state.assistant_data.assistant_id,
-                                    assistant_status='thinking',
-                                    role='assistant',
-                                    content_chunk=default_content,
-                                    think_content_chunk=tag_contents['think'],
-                                    edited_article_chunk=tag_contents['edited_content'],
-                                    edited_article_related_to=current_state.article.file_name,
-                                    other_data={})
-        await websocket.send_json(data_to_send.model_dump())
+        # aclosing makes sure the graph, and the llm request in it, stops as soon as this generator is closed
+        async with aclosing(editor_graph.astream(current_state, stream_mode=["messages", "values", "custom"])) as graph_stream:
+            async for event, chunk in graph_stream:
+                if event == 'values':
+                    current_state = EditorGraphState(**chunk)
 
-    except Exception as e:
-        await websocket.close(code=1000, reason=str(e))
+                if event == 'custom' and 'llm_queue' in chunk:
+                    # the llm request waits for a provider slot, see agent/llm_scheduler.py
+                    assistant_status = 'queued' if chunk['llm_queue']['status'] == 'queued' else 'thinking'
+                    yield StreamResponse(type='stream',
+                                        assistant_id=current_state.assistant_data.assistant_id,
+                                        assistant_status=assistant_status,
+                                        role='assistant',
+                                        content_chunk='',
+                                        think_content_chunk='',
+                                        edited_article_chunk='',
+                                        edited_article_related_to=current_state.article.file_name,
+                                        other_data=chunk)
+
+                if event == 'messages' and isinstance(chunk[0], AIMessageChunk):
+                    llm_chunks += 1
+                    streamed_text.append(chunk[0].content)
+                    parser.feed(chunk[0].content)
+                    default_content, tag_contents = parser.take()
+
+                    # send the default content and tag contents here, the fields are plain strings so validation is skipped
+                    yield StreamResponse.model_construct(type='stream',
+                                                        assistant_id=current_state.assistant_data.assistant_id,
+                                                        assistant_status='thinking',
+                                                        role='assistant',
+                                                        content_chunk=default_content,
+                                                        think_content_chunk=tag_contents['think'],
+                                                        edited_article_chunk=tag_contents['edited_content'],
+                                                        edited_article_related_to=current_state.article.file_name,
+                                                        other_data={})
+    except (asyncio.CancelledError, GeneratorExit):
+        streamed_tokens = estimate_tokens(''.join(streamed_text))
+        tokens_saved = max(expected_output_tokens() - streamed_tokens, 0)
+        _generation_stats["cancelled"] += 1
+        _generation_stats["cancelled_streamed_tokens"] += streamed_tokens
+        _generation_stats["tokens_saved"] += tokens_saved
+        print(f"    Generation cancelled for assistant {current_state.assistant_data.assistant_id} "
+              f"after {llm_chunks} streamed llm chunks, ~{streamed_tokens} tokens "
+              f"({time.perf_counter() - started_at:.1f}s), ~{tokens_saved} tokens saved")
+        raise
+
+    _generation_stats["completed"] += 1
+    _output_tokens.append(estimate_tokens(''.join(streamed_text)))
+
+    # finally handle the leftover chunk
+    parser.flush()
+    default_content, tag_contents = parser.take()
+    
+    yield StreamResponse(type='stream',
+                        assistant_id=current_state.assistant_data.assistant_id,
+                        assistant_status='thinking',
+                        role='assistant',
+                        content_chunk=default_content,
+                        think_content_chunk=tag_contents['think'],
+                        edited_article_chunk=tag_contents['edited_content'],
+                        edited_article_related_to=current_state.article.file_name,
+                        other_data={})
+
+
+def _pending_bytes(response: StreamResponse):
+    return (len(response.content_chunk.encode())
+            + len(response.think_content_chunk.encode())
+            + len(response.edited_article_chunk.encode()))
+
+
+async def coalesce_stream_responses(responses: AsyncIterator[StreamResponse],
+                                    flush_interval_ms: float = STREAM_FLUSH_INTERVAL_MS,
+                                    flush_bytes: int = STREAM_FLUSH_BYTES) -> AsyncIterator[StreamResponse]:
+    """
+    Merges consecutive `stream` chunks into one frame, which is flushed when `flush_interval_ms` has passed
+    since its first chunk or when it holds `flush_bytes` bytes of content. The chunk texts are concatenated
+    per field, so the client sees the same content in fewer frames. The first chunk, chunks carrying
+    `other_data` (e.g. the llm queue status) and chunks of other types are sent right away. The responses
+    are read in a separate task, so a frame is flushed on time even when the llm pauses between tokens.
+    """
+    if flush_interval_ms <= 0 and flush_bytes <= 0:
+        async with aclosing(responses) as responses:
+            async for response in responses:
+                yield response
+        return
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    end_of_stream = object()
+
+    async def read_responses():
+        try:
+            async with aclosing(responses) as stream:
+                async for response in stream:
+                    queue.put_nowait(response)
+        except Exception as e:
+            queue.put_nowait(e)
+        finally:
+            queue.put_nowait(end_of_stream)
+
+    reader_task = asyncio.create_task(read_responses())
+    pending = None
+    pending_bytes = 0
+    flush_at = None
+    first_chunk = True
+
+    try:
+        while True:
+            timeout = None if pending is None else max(0.0, flush_at - loop.time())
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                yield pending
+                pending = None
+                continue
+
+            if item is end_of_stream:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            if first_chunk or item.type != 'stream' or item.other_data:
+                first_chunk = False
+                if pending is not None:
+                    yield pending
+                    pending = None
+                yield item
+                continue
+
+            if pending is None:
+                pending = item.model_copy()
+                pending_bytes = _pending_bytes(item)
+                flush_at = loop.time() + flush_interval_ms / 1000
+            else:
+                pending.content_chunk += item.content_chunk
+                pending.think_content_chunk += item.think_content_chunk
+                pending.edited_article_chunk += item.edited_article_chunk
+                pending.assistant_status = item.assistant_status
+                pending.edited_article_related_to = item.edited_article_related_to
+                pending_bytes += _pending_bytes(item)
+
+            if flush_bytes > 0 and pending_bytes >= flush_bytes:
+                yield pending
+                pending = None
+
+        if pending is not None:
+            yield pending
     finally:
-        data_to_send = StreamResponse(type='stream_end',
-                                    assistant_id=current_state.assistant_data.assistant_id,
-                                    assistant_status='thinking',
-                                    role='assistant',
-                                    content_chunk='',
-                                    think_content_chunk='',
-                                    edited_article_chunk='',
-                                    edited_article_related_to=current_state.article.file_name,
-                                    other_data={})
-        await websocket.send_json(data_to_send.model_dump())
\ No newline at end of file
+        reader_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await reader_task
+
+
+# websocket close reasons are limited to 123 bytes
+MAX_CLOSE_REASON_BYTES = 123
+
+
+def close_reason(text: str) -> str:
+    return text.encode('utf-8')[:MAX_CLOSE_REASON_BYTES].decode('utf-8', errors='ignore')
+
+
+def error_response(current_state: EditorGraphState, error: HTTPException) -> dict:
+    """
+    The `error` chunk of a failed generation, e.g. the llm provider is unavailable or its queue is full.
+    It is followed by `stream_end`, and the client may retry after `retry_after` seconds.
+    """
+    retry_after = (error.headers or {}).get("Retry-After")
+    return {"type": "error",
+            "assistant_id": current_state.assistant_data.assistant_id,
+            "status_code": error.status_code,
+            "detail": error.detail,
+            "retry_after": int(retry_after) if retry_after else None}
+
+
+async def run_graph_and_stream(current_state, websocket: WebSocket, codec: WebSocketCodec = json_codec):
+    try:
+        async with aclosing(coalesce_stream_responses(stream_graph_responses(current_state))) as responses:
+            async for data_to_send in responses:
+                await codec.send(websocket, data_to_send.model_dump())
+
+    except asyncio.CancelledError:
+        # the generation was cancelled (stream_stop, new request or disconnect), end the stream if still possible
+        with suppress(Exception):
+            await codec.send(websocket, stream_end_response(current_state).model_dump())
+        raise
+    except HTTPException as e:
+        # expected failures, e.g. ProviderUnavailableError or LLMQueueFullError, the connection stays open
+        await codec.send(websocket, error_response(current_state, e))
+    except Exception as e:
+        with suppress(Exception):
+            await websocket.close(code=1011, reason=close_reason(str(e)))
+        return
+
+    await codec.send(websocket, stream_end_response(current_state).model_dump())
+
+
+async def run_graph_and_stream_http(current_state, stream_format: Literal['sse', 'ndjson']) -> AsyncIterator[str]:
+    """The HTTP counterpart of run_graph_and_stream, yields the same chunks as SSE events or NDJSON lines."""
+    def encode(data: dict):
+        if stream_format == 'sse':
+            return f"event: {data['type']}\ndata: {json_dumps(data)}\n\n"
+        return json_dumps(data) + "\n"
+
+    try:
+        async with aclosing(coalesce_stream_responses(stream_graph_responses(current_state))) as responses:
+            async for data_to_send in responses:
+                yield encode(data_to_send.model_dump())
+    except HTTPException as e:
+        # the status code has already been sent, so errors are reported in the stream
+        yield encode(error_response(current_state, e))
+    except Exception as e:
+        yield encode({'type': 'error', 'detail': str(e)})
+
+    yield encode(stream_end_response(current_state).model_dump())
@@ -0,0 +1,162 @@
+import os
+import hashlib
+from collections import OrderedDict
+from typing import Literal
+from pydantic import BaseModel, Field
+from fastapi import HTTPException, status
+
+from agent.agent_classes import Article
+
+
+DOCUMENT_STORE_MAX_BYTES = int(os.getenv("DOCUMENT_STORE_MAX_BYTES", 64 * 1024 * 1024))
+
+
+def content_hash(content: str) -> str:
+    """The hash clients use to refer to a document: hex sha256 of the utf-8 encoded content."""
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+class LineEdit(BaseModel):
+    # 1-based line numbers in the base document, the lines start_line..end_line (inclusive) are replaced by `lines`.
+    # Use end_line = start_line - 1 to insert `lines` before start_line without replacing anything.
+    start_line: int = Field(ge=1)
+    end_line: int = Field(ge=0)
+    lines: list[str]
+
+
+class ArticleRef(BaseModel):
+    """
+    Refers to an article the server has already received, instead of sending its content again.
+    Without `base_hash`, `content_hash` must be a document the server already has.
+    With `base_hash`, the document is the base document with `line_edits` applied, and `content_hash` is its new hash.
+    """
+    file_name: str
+    file_category: Literal["editable", "reference"]
+    content_hash: str
+    base_hash: str | None = None
+    line_edits: list[LineEdit] = Field(default_factory=list)
+
+
+class DocumentNotFoundError(HTTPException):
+    """Raised when referenced documents are not (or no longer) in the store, the client should send them in full."""
+
+    def __init__(self, content_hashes: list[str]):
+        self.content_hashes = content_hashes
+        super().__init__(status_code=status.HTTP_409_CONFLICT,
+                         detail={"message": "Documents not found, send their full content",
+                                 "missing_content_hashes": content_hashes})
+
+
+class DocumentStore:
+    """
+    In-process store of document contents keyed by (user_id, content_hash).
+    The total size of the stored documents is bounded, the least recently used ones are evicted first.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._documents: OrderedDict[tuple[str, str], str] = OrderedDict()
+        self._total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def put(self, user_id: str, content: str) -> str:
+        document_hash = content_hash(content)
+        key = (user_id, document_hash)
+        if key in self._documents:
+            self._documents.move_to_end(key)
+            return document_hash
+
+        size = len(content.encode('utf-8'))
+        if size > self.max_bytes:
+            return document_hash
+
+        self._documents[key] = content
+        self._total_bytes += size
+        while self._total_bytes > self.max_bytes:
+            _, evicted = self._documents.popitem(last=False)
+            self._total_bytes -= len(evicted.encode('utf-8'))
+            self.evictions += 1
+        return document_hash
+
+    def get(self, user_id: str, document_hash: str) -> str | None:
+        content = self._documents.get((user_id, document_hash))
+        if content is None:
+            self.misses += 1
+            return None
+        self._documents.move_to_end((user_id, document_hash))
+        self.hits += 1
+        return content
+
+    def stats(self) -> dict:
+        return {
+            "documents": len(self._documents),
+            "total_bytes": self._total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+document_store = DocumentStore(max_bytes=DOCUMENT_STORE_MAX_BYTES)
+
+
+def get_document_store_stats() -> dict:
+    return document_store.stats()
+
+
+def apply_line_edits(base_content: str, line_edits: list[LineEdit]) -> str:
+    lines = base_content.split('\n')
+
+    # apply from the bottom up, so the line numbers of the remaining edits stay valid
+    previous_start = len(lines) + 1
+    for line_edit in sorted(line_edits, key=lambda edit: edit.start_line, reverse=True):
+        if line_edit.end_line < line_edit.start_line - 1 or line_edit.end_line >= previous_start:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail="Line edits must not overlap and must have end_line >= start_line - 1")
+        if line_edit.start_line > len(lines) + 1:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail=f"Line edit starts after the end of the document: {line_edit.start_line}")
+        lines[line_edit.start_line - 1:line_edit.end_line] = line_edit.lines
+        previous_start = line_edit.start_line
+
+    return '\n'.join(lines)
+
+
+def resolve_articles(user_id: str, articles: list[Article | ArticleRef]) -> list[Article]:
+    """
+    Turns the articles of a request into full articles. Full articles are stored for later references,
+    references are looked up in the store. Raises DocumentNotFoundError listing every missing document.
+    """
+    resolved = []
+    missing_hashes = []
+    for article in articles:
+        if isinstance(article, Article):
+            document_store.put(user_id, article.content)
+            resolved.append(article)
+            continue
+
+        if article.base_hash:
+            base_content = document_store.get(user_id, article.base_hash)
+            if base_content is None:
+                missing_hashes.append(article.base_hash)
+                continue
+            content = apply_line_edits(base_content, article.line_edits)
+            if document_store.put(user_id, content) != article.content_hash:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                    detail=f"Content hash mismatch after applying line edits to {article.file_name}")
+        else:
+            content = document_store.get(user_id, article.content_hash)
+            if content is None:
+                missing_hashes.append(article.content_hash)
+                continue
+
+        resolved.append(Article(file_name=article.file_name,
+                                content=content,
+                                file_category=article.file_category))
+
+    if missing_hashes:
+        raise DocumentNotFoundError(content_hashes=missing_hashes)
+    return resolved
@@ -0,0 +1,122 @@
+import os
+import asyncio
+from datetime import datetime
+from langchain_core.messages import AnyMessage, HumanMessage, AIMessage, SystemMessage
+
+from agent.summarization.graph import summarization_graph
+from agent.summarization.state import SummarizationGraphState
+from database.db_classes import ConversationSummary
+from database.conversation_utils import (
+    append_conversation_messages, fetch_conversation_summary, messages_hash, save_conversation_summary)
+
+
+# the most recent messages are always sent to the editor graph verbatim, older ones are replaced by the summary
+CONVERSATION_WINDOW = int(os.getenv("CONVERSATION_WINDOW", 10))
+# older messages are only summarized once this many of them are not covered by the summary yet
+CONVERSATION_SUMMARY_BATCH = int(os.getenv("CONVERSATION_SUMMARY_BATCH", 4))
+
+# (user_id, assistant_id) of the summaries being generated, so each conversation has at most one at a time
+_summaries_in_progress: set[tuple[str, str]] = set()
+# keep references to the background tasks so they are not garbage collected
+_background_tasks: set[asyncio.Task] = set()
+
+
+def to_langchain_messages(messages: list[dict]) -> list[AnyMessage]:
+    # Convert the messages to a list of Langchain messages.
+    lang_messages = []
+    for msg in messages:
+        if msg['role'] == 'user':
+            lang_messages.append(HumanMessage(content=msg['content']))
+        elif msg['role'] == 'assistant':
+            lang_messages.append(AIMessage(content=msg['content']))
+    return lang_messages
+
+
+def summary_message(summary: str) -> SystemMessage:
+    return SystemMessage(f'''The earlier part of this conversation has been summarized as follows:
+<conversation-summary>
+{summary}
+</conversation-summary>''')
+
+
+async def summarize_conversation(user_id: str, assistant_id: str, messages: list[dict],
+                                 previous_summary: ConversationSummary | None):
+    """Folds `messages` after the previous summary into a new summary, and logs the folded messages once it is saved."""
+    try:
+        start = previous_summary.summarized_count if previous_summary else 0
+        new_messages = messages[start:]
+
+        result = await summarization_graph.ainvoke(
+            SummarizationGraphState(user_id=user_id,
+                                    messages=to_langchain_messages(new_messages),
+                                    previous_summary=previous_summary.summary if previous_summary else ''))
+
+        await save_conversation_summary(ConversationSummary(user_id=user_id,
+                                                            assistant_id=assistant_id,
+                                                            summary=result['summary'],
+                                                            summarized_count=len(messages),
+                                                            prefix_hash=messages_hash(messages),
+                                                            updated_at=datetime.now()))
+
+        # idempotent, a message logged before (e.g. as a recent turn) is not added again
+        await append_conversation_messages(user_id, assistant_id, messages, start=start)
+    except Exception as e:
+        print(f"    Failed to summarize conversation of assistant {assistant_id}: {e}")
+    finally:
+        _summaries_in_progress.discard((user_id, assistant_id))
+
+
+async def log_recent_messages(user_id: str, assistant_id: str, messages: list[dict]):
+    try:
+        await append_conversation_messages(user_id, assistant_id, messages,
+                                           start=max(0, len(messages) - CONVERSATION_WINDOW))
+    except Exception as e:
+        print(f"    Failed to log conversation messages of assistant {assistant_id}: {e}")
+
+
+def run_in_background(coroutine):
+    task = asyncio.create_task(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def schedule_summary(user_id: str, assistant_id: str, messages: list[dict],
+                     previous_summary: ConversationSummary | None):
+    key = (user_id, assistant_id)
+    if key in _summaries_in_progress:
+        return
+    _summaries_in_progress.add(key)
+
+    run_in_background(summarize_conversation(user_id, assistant_id, messages, previous_summary))
+
+
+async def prepare_conversation_messages(user_id: str, assistant_id: str, messages: list[dict]) -> list[AnyMessage]:
+    """
+    Returns the messages for the editor graph: the stored summary of the older messages plus the messages
+    it does not cover yet. When enough older messages are not covered, a new summary is generated in the
+    background, so it is used from one of the next requests on and never delays this one.
+    """
+    messages = [msg for msg in messages if msg['role'] in ('user', 'assistant')]
+    # every message passes through the window, so logging the window of each request logs the whole conversation
+    run_in_background(log_recent_messages(user_id, assistant_id, messages))
+    if len(messages) <= CONVERSATION_WINDOW:
+        return to_langchain_messages(messages)
+
+    older_messages = messages[:-CONVERSATION_WINDOW]
+    conversation_summary = await fetch_conversation_summary(user_id, assistant_id)
+
+    # the summary is only used if this request continues the conversation it summarizes
+    if (conversation_summary
+            and conversation_summary.summarized_count <= len(older_messages)
+            and conversation_summary.prefix_hash == messages_hash(messages[:conversation_summary.summarized_count])):
+        summarized_count = conversation_summary.summarized_count
+        head = [summary_message(conversation_summary.summary)]
+    else:
+        conversation_summary = None
+        summarized_count = 0
+        head = []
+
+    if len(older_messages) - summarized_count >= CONVERSATION_SUMMARY_BATCH:
+        schedule_summary(user_id, assistant_id, older_messages, conversation_summary)
+
+    return head + to_langchain_messages(messages[summarized_count:])
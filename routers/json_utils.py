@@ -0,0 +1,23 @@
+from typing import Any
+# orjson is much faster than the standard json module for the many small stream frames
+import orjson
+from fastapi.responses import JSONResponse
+
+
+def json_dumps_bytes(data: Any) -> bytes:
+    return orjson.dumps(data)
+
+
+def json_dumps(data: Any) -> str:
+    return orjson.dumps(data).decode("utf-8")
+
+
+def json_loads(data: str | bytes) -> Any:
+    return orjson.loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson."""
+
+    def render(self, content: Any) -> bytes:
+        return json_dumps_bytes(content)
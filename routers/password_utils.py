@@ -0,0 +1,75 @@
+import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from passlib.context import CryptContext
+
+
+# bcrypt 在C层释放GIL, 因此线程池即可让哈希计算不阻塞事件循环
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+# 同时等待或执行的哈希任务上限, 超出的请求在事件循环上排队, 不会占满线程池队列
+PASSWORD_HASH_MAX_CONCURRENCY = int(os.getenv("PASSWORD_HASH_MAX_CONCURRENCY", 8))
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+_executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS,
+                               thread_name_prefix="password-hash")
+_semaphore = asyncio.Semaphore(PASSWORD_HASH_MAX_CONCURRENCY)
+
+_stats = {
+    "waiting": 0,  # waiting for a concurrency slot
+    "running": 0,  # submitted to the worker pool
+    "completed": 0,
+    "max_queue_depth": 0,
+    "total_wait_seconds": 0.0,
+    "total_run_seconds": 0.0,
+}
+
+
+async def _run_in_pool(func, *args):
+    loop = asyncio.get_running_loop()
+    enqueued_at = time.perf_counter()
+
+    _stats["waiting"] += 1
+    _stats["max_queue_depth"] = max(_stats["max_queue_depth"], _stats["waiting"])
+    try:
+        await _semaphore.acquire()
+    finally:
+        _stats["waiting"] -= 1
+
+    started_at = time.perf_counter()
+    _stats["total_wait_seconds"] += started_at - enqueued_at
+    _stats["running"] += 1
+    try:
+        return await loop.run_in_executor(_executor, func, *args)
+    finally:
+        _stats["running"] -= 1
+        _stats["completed"] += 1
+        _stats["total_run_seconds"] += time.perf_counter() - started_at
+        _semaphore.release()
+
+
+async def hash_password(password: str) -> str:
+    return await _run_in_pool(pwd_context.hash, password)
+
+
+async def verify_password(password: str, hashed_password: str) -> bool:
+    return await _run_in_pool(pwd_context.verify, password, hashed_password)
+
+
+def get_password_hashing_stats() -> dict:
+    completed = _stats["completed"]
+    return {
+        "workers": PASSWORD_HASH_WORKERS,
+        "max_concurrency": PASSWORD_HASH_MAX_CONCURRENCY,
+        "queue_depth": _stats["waiting"],
+        "running": _stats["running"],
+        "completed": completed,
+        "max_queue_depth": _stats["max_queue_depth"],
+        "avg_wait_ms": _stats["total_wait_seconds"] / completed * 1000 if completed else 0.0,
+        "avg_run_ms": _stats["total_run_seconds"] / completed * 1000 if completed else 0.0,
+    }
+
+
+def shutdown_password_hashing():
+    _executor.shutdown(wait=True, cancel_futures=True)
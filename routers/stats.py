@@ -0,0 +1,52 @@
+import os
+import hmac
+from fastapi import APIRouter, Header, HTTPException, status
+from routers.auth_utils import get_user_profile_cache_stats, get_verified_token_cache_stats
+from routers.password_utils import get_password_hashing_stats
+from routers.document_store import get_document_store_stats
+from routers.chat_utils import get_generation_stats
+from agent.ai_models import get_llm_pool_stats
+from agent.llm_scheduler import get_llm_scheduler_stats
+from agent.resilience import get_resilience_stats
+from agent.hedging import get_hedge_stats
+from agent.response_cache import get_response_cache_stats
+from agent.editor.prompts.prompt_layout import get_prompt_cache_stats
+from agent.editor.retrieval import get_retrieval_cache_stats
+from agent.editor.context_packer import get_context_packer_stats
+from database.assistant_utils import get_assistant_cache_stats
+from database.usage_recorder import get_usage_recorder_stats
+
+
+# the stats endpoint is only served when this token is set, and must be sent in the X-Stats-Token header
+INTERNAL_STATS_TOKEN = os.getenv("INTERNAL_STATS_TOKEN", "")
+
+stats_router = APIRouter(tags=["Internal"])
+
+
+def collect_stats() -> dict:
+    """The counters of every cache, pool and queue of this worker."""
+    return {
+        "user_profile_cache": get_user_profile_cache_stats(),
+        "verified_token_cache": get_verified_token_cache_stats(),
+        "password_hashing": get_password_hashing_stats(),
+        "document_store": get_document_store_stats(),
+        "generations": get_generation_stats(),
+        "assistant_cache": get_assistant_cache_stats(),
+        "llm_pool": get_llm_pool_stats(),
+        "llm_scheduler": get_llm_scheduler_stats(),
+        "llm_resilience": get_resilience_stats(),
+        "llm_hedging": get_hedge_stats(),
+        "llm_response_cache": get_response_cache_stats(),
+        "prompt_cache": get_prompt_cache_stats(),
+        "retrieval_cache": get_retrieval_cache_stats(),
+        "context_packer": get_context_packer_stats(),
+        "usage_recorder": get_usage_recorder_stats(),
+    }
+
+
+@stats_router.get("/stats", include_in_schema=False)
+async def get_stats(x_stats_token: str = Header(default="")):
+    # every worker keeps its own counters, so the numbers are those of the worker that answers
+    if not INTERNAL_STATS_TOKEN or not hmac.compare_digest(x_stats_token, INTERNAL_STATS_TOKEN):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not Found")
+    return {"pid": os.getpid(), **collect_stats()}
@@ -0,0 +1,121 @@
+import os
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect, status
+from routers.json_utils import json_dumps, json_loads
+
+import msgpack
+
+# zstandard is the optional `zstd` extra, the msgpack+zstd encoding is only offered when it is installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# frames smaller than this are not worth compressing
+ZSTD_MIN_FRAME_BYTES = 256
+ZSTD_LEVEL = 3
+
+# limits of the frames read from the client, a small zstd frame can otherwise expand to gigabytes
+WS_MAX_FRAME_BYTES = int(os.getenv("WS_MAX_FRAME_BYTES", 4 * 1024 * 1024))
+WS_MAX_DECOMPRESSED_BYTES = int(os.getenv("WS_MAX_DECOMPRESSED_BYTES", 16 * 1024 * 1024))
+
+# the first byte of a `msgpack+zstd` frame tells whether the msgpack payload after it is compressed
+_RAW_FRAME = b'\x00'
+_ZSTD_FRAME = b'\x01'
+
+
+class FrameTooLargeError(HTTPException):
+    """Raised when a frame from the client, or its decompressed payload, is over the limits, the connection is closed."""
+
+    def __init__(self, size: int, limit: int):
+        super().__init__(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                         detail=f"Message too large: {size} bytes, the limit is {limit} bytes")
+
+
+class WebSocketCodec:
+    """
+    Encodes the messages of a chat websocket.
+
+    - `json`: JSON text frames, the default. permessage-deflate is negotiated by the websocket handshake itself
+      when the client offers it, so JSON frames are compressed on the wire in that case.
+    - `msgpack`: msgpack binary frames.
+    - `msgpack+zstd`: msgpack binary frames prefixed with one byte, 0x00 for a plain payload
+      and 0x01 for a payload compressed with zstd (frames of at least ZSTD_MIN_FRAME_BYTES bytes).
+
+    Text frames from the client are always read as JSON, so `ping` and `quit` can stay JSON.
+    Frames from the client are limited to WS_MAX_FRAME_BYTES, and to WS_MAX_DECOMPRESSED_BYTES once decompressed.
+    """
+
+    def __init__(self, encoding: str = 'json'):
+        self.encoding = encoding
+        if encoding == 'msgpack+zstd':
+            self._compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+            self._decompressor = zstandard.ZstdDecompressor()
+
+    def encode(self, data: dict) -> str | bytes:
+        if self.encoding == 'json':
+            return json_dumps(data)
+
+        payload = msgpack.packb(data)
+        if self.encoding == 'msgpack':
+            return payload
+        if len(payload) < ZSTD_MIN_FRAME_BYTES:
+            return _RAW_FRAME + payload
+        return _ZSTD_FRAME + self._compressor.compress(payload)
+
+    def decompress(self, payload: bytes) -> bytes:
+        # the declared size is checked before anything is allocated, frames without one are read up to the limit
+        content_size = zstandard.frame_content_size(payload)
+        if content_size > WS_MAX_DECOMPRESSED_BYTES:
+            raise FrameTooLargeError(content_size, WS_MAX_DECOMPRESSED_BYTES)
+        with self._decompressor.stream_reader(payload) as reader:
+            data = reader.read(WS_MAX_DECOMPRESSED_BYTES + 1)
+        if len(data) > WS_MAX_DECOMPRESSED_BYTES:
+            raise FrameTooLargeError(len(data), WS_MAX_DECOMPRESSED_BYTES)
+        return data
+
+    def decode(self, frame: bytes) -> dict:
+        if len(frame) > WS_MAX_FRAME_BYTES:
+            raise FrameTooLargeError(len(frame), WS_MAX_FRAME_BYTES)
+        if self.encoding == 'msgpack':
+            return msgpack.unpackb(frame)
+        if self.encoding == 'msgpack+zstd':
+            if frame[:1] == _ZSTD_FRAME:
+                return msgpack.unpackb(self.decompress(frame[1:]))
+            return msgpack.unpackb(frame[1:])
+        return json_loads(frame)
+
+    async def send(self, websocket: WebSocket, data: dict):
+        frame = self.encode(data)
+        if isinstance(frame, bytes):
+            await websocket.send_bytes(frame)
+        else:
+            await websocket.send_text(frame)
+
+    async def receive(self, websocket: WebSocket) -> dict:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(code=message.get("code", 1000), reason=message.get("reason"))
+        if message.get("text") is not None:
+            if len(message["text"]) > WS_MAX_FRAME_BYTES:
+                raise FrameTooLargeError(len(message["text"]), WS_MAX_FRAME_BYTES)
+            return json_loads(message["text"])
+        return self.decode(message["bytes"])
+
+
+def supported_encodings() -> list[str]:
+    if zstandard is not None:
+        return ['msgpack+zstd', 'msgpack', 'json']
+    return ['msgpack', 'json']
+
+
+def negotiate_codec(requested_encodings: list[str] | None) -> WebSocketCodec:
+    """Picks the first encoding in the client's order of preference that the server supports, JSON otherwise."""
+    available = supported_encodings()
+    for encoding in requested_encodings or []:
+        if encoding in available:
+            return WebSocketCodec(encoding)
+    return WebSocketCodec('json')
+
+
+json_codec = WebSocketCodec('json')
@@ -0,0 +1,69 @@
+import math
+import asyncio
+import random
+from types import SimpleNamespace
+from routers.auth_utils import RegistrationNumberAllocator
+from routers.id_utils import generate_user_id
+
+
+class FakeAppStatistics:
+    """The registration_count document of app_statistics, with a random delay before each atomic $inc."""
+
+    def __init__(self, registration_count: int, rng: random.Random):
+        self.value = registration_count
+        self.rng = rng
+        self.updates = 0
+
+    async def find_one_and_update(self, query, update, return_document):
+        await asyncio.sleep(self.rng.random() / 1000)
+        # the $inc itself is atomic, like in mongo
+        self.value += update['$inc']['value']
+        self.updates += 1
+        return {'name': 'registration_count', 'value': self.value}
+
+
+def allocate_concurrently(registration_count: int, workers: int, block_size: int, registrations: int):
+    app_statistics = FakeAppStatistics(registration_count, random.Random(0))
+    db = SimpleNamespace(app_statistics=app_statistics)
+    allocators = [RegistrationNumberAllocator(block_size=block_size) for _ in range(workers)]
+
+    async def allocate(index: int):
+        allocator = allocators[index % workers]
+        return allocator, await allocator.next_number(db)
+
+    async def run():
+        return await asyncio.gather(*(allocate(index) for index in range(registrations)))
+
+    return app_statistics, asyncio.run(run())
+
+
+def test_numbers_are_unique_across_workers():
+    app_statistics, results = allocate_concurrently(registration_count=0, workers=4, block_size=20, registrations=1000)
+    numbers = [number for _, number in results]
+
+    assert len(set(numbers)) == len(numbers)
+    assert len({generate_user_id(number) for number in numbers}) == len(numbers)
+    # one $inc per block, not per registration
+    assert app_statistics.updates == 4 * math.ceil(1000 / 4 / 20)
+
+
+def test_blocks_have_no_gaps():
+    _, results = allocate_concurrently(registration_count=0, workers=3, block_size=10, registrations=600)
+    numbers_by_worker = {}
+    for allocator, number in results:
+        numbers_by_worker.setdefault(id(allocator), []).append(number)
+
+    for numbers in numbers_by_worker.values():
+        # a worker hands out its blocks in order, each block is a contiguous range of block_size numbers
+        assert numbers == sorted(numbers)
+        for block_start in range(0, len(numbers), 10):
+            block = numbers[block_start:block_start + 10]
+            assert block == list(range(block[0], block[0] + 10))
+            assert block[0] % 10 == 1
+
+
+def test_continues_from_existing_registration_count():
+    _, results = allocate_concurrently(registration_count=12345, workers=2, block_size=20, registrations=40)
+    numbers = sorted(number for _, number in results)
+
+    assert numbers == list(range(12346, 12386))
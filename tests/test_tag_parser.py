@@ -0,0 +1,117 @@
+import re
+import random
+import pytest
+from routers.chat_utils import TagStreamParser
+
+
+TARGET_TAGS = ['think', 'edited_content']
+
+
+def process_text_chunk(text_chunk, target_tags, default_content, tag_contents, current_tag, chunk_leftover):
+    """The regex based parser TagStreamParser replaced, kept as the reference of its behavior."""
+    while text_chunk:
+        bracket_match = re.search(r'<([^<>]*)>', text_chunk)
+        if bracket_match:
+            text_inside_bracket = bracket_match.group(1)
+            if current_tag:
+                if text_inside_bracket == f"/{current_tag}":
+                    tag_contents[current_tag] += text_chunk[:bracket_match.start()]
+                    text_chunk = text_chunk[bracket_match.end():]
+                    current_tag = None
+                else:
+                    tag_contents[current_tag] += text_chunk[:bracket_match.end()]
+                    text_chunk = text_chunk[bracket_match.end():]
+            elif text_inside_bracket in target_tags:
+                default_content += text_chunk[:bracket_match.start()]
+                text_chunk = text_chunk[bracket_match.end():]
+                current_tag = text_inside_bracket
+                if text_inside_bracket == 'edited_content':
+                    default_content += "<edited_content></edited_content>"
+            else:
+                default_content += text_chunk[:bracket_match.end()]
+                text_chunk = text_chunk[bracket_match.end():]
+        else:
+            unfinished_bracket_match = re.search(r'<([^<>]*)$', text_chunk)
+            if unfinished_bracket_match and len(unfinished_bracket_match.group(1)) <= (max(len(tag) for tag in target_tags) + 1):
+                chunk_leftover = text_chunk[unfinished_bracket_match.start():]
+                if current_tag:
+                    tag_contents[current_tag] += text_chunk[:unfinished_bracket_match.start()]
+                else:
+                    default_content += text_chunk[:unfinished_bracket_match.start()]
+                text_chunk = ''
+            else:
+                if current_tag:
+                    tag_contents[current_tag] += text_chunk
+                else:
+                    default_content += text_chunk
+                text_chunk = ''
+    return default_content, tag_contents, current_tag, chunk_leftover
+
+
+def parse_with_reference(chunks: list[str]) -> list[tuple[str, str, str]]:
+    """The (default content, think, edited_content) sent for each chunk, and for the end of the stream."""
+    outputs = []
+    current_tag, chunk_leftover = None, ''
+    for chunk in chunks:
+        text_chunk, chunk_leftover = chunk_leftover + chunk, ''
+        default_content, tag_contents, current_tag, chunk_leftover = process_text_chunk(
+            text_chunk, TARGET_TAGS, '', {tag: '' for tag in TARGET_TAGS}, current_tag, chunk_leftover)
+        outputs.append((default_content, tag_contents['think'], tag_contents['edited_content']))
+    if current_tag:
+        outputs.append(('', chunk_leftover if current_tag == 'think' else '',
+                        chunk_leftover if current_tag == 'edited_content' else ''))
+    else:
+        outputs.append((chunk_leftover, '', ''))
+    return outputs
+
+
+def parse_with_stream_parser(chunks: list[str]) -> list[tuple[str, str, str]]:
+    parser = TagStreamParser(target_tags=TARGET_TAGS, placeholder_tags=['edited_content'])
+    outputs = []
+    for chunk in chunks:
+        parser.feed(chunk)
+        default_content, tag_contents = parser.take()
+        outputs.append((default_content, tag_contents['think'], tag_contents['edited_content']))
+    parser.flush()
+    default_content, tag_contents = parser.take()
+    outputs.append((default_content, tag_contents['think'], tag_contents['edited_content']))
+    return outputs
+
+
+PIECES = ['<', '>', '/', 'think', 'edited_content', '<think>', '</think>', '<edited_content>', '</edited_content>',
+          'a', 'b c', '\n', '<line_1>', '</line_1>', '<<', '>>', '<thin', 'k>', '</th', 'ink', 'x' * 20, '思考']
+
+
+def random_chunks(rng: random.Random) -> list[str]:
+    text = ''.join(rng.choice(PIECES) for _ in range(rng.randint(0, 30)))
+    cuts = sorted(rng.sample(range(len(text) + 1), min(len(text) + 1, rng.randint(0, 10))))
+    return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+
+@pytest.mark.parametrize("chunks", [
+    ["Hello ", "<think>", "let me see", "</think>", "answer"],
+    ["<thi", "nk>reason", "ing</th", "ink>done"],
+    ["text <edited_content>new article</edited_content> after"],
+    ["a < b and c > d"],
+    ["<line_3>keep</line_3>", "<think><line_1></think>"],
+    ["unfinished <thin"],
+    ["<think>never closed"],
+    ["<" + "x" * 40, "> is plain text"],
+])
+def test_known_streams_match_reference(chunks):
+    assert parse_with_stream_parser(chunks) == parse_with_reference(chunks)
+
+
+def test_random_streams_match_reference():
+    rng = random.Random(1)
+    for _ in range(20000):
+        chunks = random_chunks(rng)
+        assert parse_with_stream_parser(chunks) == parse_with_reference(chunks), chunks
+
+
+def test_any_target_tags():
+    parser = TagStreamParser(target_tags=['plan', 'answer'])
+    for chunk in ["<pl", "an>step 1</plan>", "<answer>42</ans", "wer><think>x</think>"]:
+        parser.feed(chunk)
+    parser.flush()
+    assert parser.take() == ("<think>x</think>", {'plan': "step 1", 'answer': "42"})